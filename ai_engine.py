@@ -1,10 +1,17 @@
 import os
+import math
+import time
+import threading
 import difflib
+from concurrent.futures import ThreadPoolExecutor, wait
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 import database
 import communication
+import metrics
+import response_cache
+import context_builder
 
 # Load environment variables
 load_dotenv()
@@ -12,6 +19,30 @@ load_dotenv()
 # Configure the Gemini API via the new Client architecture
 API_KEY = os.getenv("GEMINI_API_KEY")
 
+# Rolling per-channel summaries. /pulse sends each channel's stored summary plus
+# the messages that arrived after it; once more than SUMMARY_FOLD_AT new
+# messages have piled up, all but the newest SUMMARY_RAW_TAIL are folded into
+# the summary with one small call (at most SUMMARY_MAX_FOLD per fold), so a
+# pulse costs roughly the same however long the channels have been running.
+# Folding runs in the background (refresh_summaries), never inside a pulse:
+# a longer backlog is folded oldest page first, SUMMARY_MAX_PAGES folds per
+# refresh, and later refreshes carry on from where the summary stopped.
+SUMMARY_FOLD_AT = 20
+SUMMARY_RAW_TAIL = 10
+SUMMARY_MAX_FOLD = 200
+SUMMARY_MAX_PAGES = 3
+SUMMARY_MAX_WORDS = 150
+
+# Map-reduce /pulse: each channel is analysed by its own call on a pool of
+# PULSE_WORKERS threads, then one call merges the findings. A channel whose
+# analysis fails or takes longer than PULSE_CHANNEL_TIMEOUT seconds is reported
+# as unavailable instead of holding up the rest. A timed-out call keeps its
+# worker until its own HTTP timeout ends it, so the next pulse's deadline
+# counts those workers as busy.
+PULSE_WORKERS = int(os.getenv("TRC_PULSE_WORKERS", "4"))
+PULSE_CHANNEL_TIMEOUT = float(os.getenv("TRC_PULSE_CHANNEL_TIMEOUT", "30"))
+PULSE_FINDING_WORDS = 120
+
 PROJECT_ROOT = os.path.realpath(os.path.dirname(os.path.abspath(__file__)))
 
 # Sensitive paths Gemini must never read or write, even though they live
@@ -48,12 +79,12 @@ def _resolve_project_path(path: str):
 
     return candidate, None
 
-def read_channel_history(channel: str, limit: int = 50) -> str:
+def read_channel_history(channel: str, limit: int = 200) -> str:
     """Reads the local technical history for a specific relay channel.
     
     Args:
         channel: The channel name (e.g., 'general', 'production-logs').
-        limit: Number of recent messages to retrieve.
+        limit: Maximum number of recent messages to retrieve (the oldest are dropped if they don't fit the context budget).
     """
     # Import locally to avoid color code issues if any, using standard ANSI
     MAGENTA = "\033[35m"
@@ -63,11 +94,33 @@ def read_channel_history(channel: str, limit: int = 50) -> str:
     history = database.get_local_history(channel, limit=limit)
     if not history:
         return f"No history found for channel #{channel}."
-    
-    formatted = f"HISTORY FOR #{channel}:\n"
-    for m in history:
-        formatted += f"[{m['timestamp']}] {m['user']}: {m['message']}\n"
-    return formatted
+
+    context = context_builder.build_context(history, context_builder.BUDGETS["tool"])
+    return f"HISTORY FOR #{channel}:\n{context}\n"
+
+def search_channel_history(query: str, channel: str = "", limit: int = 10) -> str:
+    """Full-text searches the local relay history and returns the best-matching messages.
+    Prefer this over read_channel_history when looking for a specific error, service or keyword.
+
+    Args:
+        query: Words to search for (all must match; end a word with * for a prefix match).
+        channel: Optional channel name to restrict the search to. Empty searches all channels.
+        limit: Maximum number of matching messages to return.
+    """
+    MAGENTA = "\033[35m"
+    RESET = "\033[0m"
+    scope = f"#{channel}" if channel else "all channels"
+    print(f"{MAGENTA}🛠️  [Tool] Gemini is searching {scope} for '{query}'...{RESET}")
+
+    results = database.search_messages(query, channel=channel or None, limit=limit)
+    if not results:
+        return f"No messages matching '{query}' in {scope}."
+
+    context = context_builder.build_context(
+        results, context_builder.BUDGETS["tool"],
+        formatter=lambda m: f"[{m['timestamp']}] #{m['channel']} {m['user']}: {m['message']}"
+    )
+    return f"SEARCH RESULTS FOR '{query}' ({scope}):\n{context}\n"
 
 def get_active_relays() -> str:
     """Returns a list of all active relay channels currently monitored by TRC."""
@@ -165,9 +218,16 @@ class TRCAIEngine:
     def __init__(self, model_name="gemini-2.5-flash"):
         self.model_name = model_name
         self.client = genai.Client(api_key=API_KEY) if API_KEY else None
+        self.cache = response_cache.ResponseCache()
+        self.pulse_pool = ThreadPoolExecutor(max_workers=PULSE_WORKERS, thread_name_prefix="trc-pulse")
+        # Map tasks a pulse gave up on that are still running on pulse_pool
+        self._abandoned = set()
+        self._abandoned_lock = threading.Lock()
+        metrics.gauge_callback("trc_ai_cache_entries", lambda: len(self.cache))
         # Define available tools (Gemini 2.5/3 currently don't support combining search with custom functions)
         self.tools = [
             read_channel_history, 
+            search_channel_history,
             get_active_relays,
             read_local_file,
             write_local_file
@@ -184,71 +244,325 @@ class TRCAIEngine:
             "technical risk, an unhandled error, or a major blocker."
         )
 
-    def generate_response(self, prompt, channel="general", context_messages=None):
-        """Generate a response using the Gemini model with optional context"""
+    def _generate(self, call, **request):
+        """Run one generate_content request, recording its latency and outcome under `call`"""
+        metrics.inc("trc_ai_requests_total", call=call)
+        try:
+            with metrics.timer("trc_ai_request_seconds", call=call):
+                return self.client.models.generate_content(**request)
+        except Exception:
+            metrics.inc("trc_ai_errors_total", call=call)
+            raise
+
+    def _generate_stream(self, call, **request):
+        """Streaming _generate: yield text chunks as Gemini produces them, recording
+        time to first token. Closing the generator abandons the request."""
+        metrics.inc("trc_ai_requests_total", call=call)
+        start = time.perf_counter()
+        waiting = True
+        stream = self.client.models.generate_content_stream(**request)
+        try:
+            for chunk in stream:
+                text = chunk.text
+                if not text:
+                    continue # Tool-call turns carry no text
+                if waiting:
+                    metrics.observe("trc_ai_first_token_seconds", time.perf_counter() - start, call=call)
+                    waiting = False
+                yield text
+        except (GeneratorExit, KeyboardInterrupt):
+            metrics.inc("trc_ai_cancelled_total", call=call)
+            raise
+        except Exception:
+            metrics.inc("trc_ai_errors_total", call=call)
+            raise
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+            metrics.observe("trc_ai_request_seconds", time.perf_counter() - start, call=call)
+
+    def _cached(self, call, key, fresh=False):
+        """A live cached answer for key, or None (always None when fresh is set)"""
+        if not self.cache.cacheable(call):
+            return None
+        if fresh:
+            self.cache.bypass(call)
+            return None
+        return self.cache.get(key, call)
+
+    def _generate_text(self, call, key, fresh=False, **request):
+        """_generate through the response cache: reuse a live answer for key unless
+        fresh is set, and remember successful answers for the call's TTL"""
+        cached = self._cached(call, key, fresh)
+        if cached is not None:
+            return cached
+        text = self._generate(call, **request).text
+        self.cache.put(key, call, text)
+        return text
+
+    def _response_request(self, prompt, channel, context_messages):
+        """Build (cache key, generate_content kwargs) for a chat question"""
+        # Fetch channel topic for context
+        topic = database.get_channel_topic(channel)
+        topic_context = f"CURRENT OBJECTIVE (# {channel}): {topic}\n" if topic else ""
+
+        full_prompt = prompt
+        formatted_context = ""
+        if context_messages:
+            # Format context for the model
+            formatted_context = context_builder.build_context(context_messages, context_builder.BUDGETS["response"])
+            full_prompt = f"{topic_context}Relay Context:\n{formatted_context}\n\nUser Query: {prompt}"
+        else:
+            full_prompt = f"{topic_context}User Query: {prompt}"
+
+        key = response_cache.make_key(
+            "response", self.model_name, self.system_instruction, prompt,
+            context=f"#{channel}\n{topic_context}{formatted_context}"
+        )
+        request = dict(
+            model=self.model_name,
+            config=types.GenerateContentConfig(
+                system_instruction=self.system_instruction,
+                tools=self.tools,
+                automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=False)
+            ),
+            contents=full_prompt
+        )
+        return key, request
+
+    def generate_response(self, prompt, channel="general", context_messages=None, fresh=False):
+        """Generate a response using the Gemini model with optional context.
+        Answers are cached briefly; fresh=True forces a new one."""
         if not self.client:
             return "⚠️ Gemini API Key not found. Please set GEMINI_API_KEY in your .env file."
 
         try:
-            # Fetch channel topic for context
-            topic = database.get_channel_topic(channel)
-            topic_context = f"CURRENT OBJECTIVE (# {channel}): {topic}\n" if topic else ""
-            
-            full_prompt = prompt
-            if context_messages:
-                # Format context for the model
-                formatted_context = "\n".join([f"[{m['timestamp']}] {m['user']}: {m['message']}" for m in context_messages])
-                full_prompt = f"{topic_context}Relay Context:\n{formatted_context}\n\nUser Query: {prompt}"
-            else:
-                full_prompt = f"{topic_context}User Query: {prompt}"
-
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                config=types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    tools=self.tools,
-                    automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=False)
-                ),
-                contents=full_prompt
-            )
-            return response.text
+            key, request = self._response_request(prompt, channel, context_messages)
+            return self._generate_text("response", key, fresh, **request)
         except Exception as e:
             return f"❌ AI Engine Error: {str(e)}"
 
-    def get_pulse(self, multi_channel_history):
-        """Analyze multi-channel history and provide a high-level summary"""
+    def stream_response(self, prompt, channel="general", context_messages=None, fresh=False):
+        """generate_response as a generator of text chunks, yielded as they arrive.
+        A cached answer comes back as one chunk; close() cancels the request."""
+        if not self.client:
+            yield "⚠️ Gemini API Key not found. Please set GEMINI_API_KEY in your .env file."
+            return
+
+        try:
+            key, request = self._response_request(prompt, channel, context_messages)
+            cached = self._cached("response", key, fresh)
+            if cached is not None:
+                yield cached
+                return
+
+            parts = []
+            for text in self._generate_stream("response", **request):
+                parts.append(text)
+                yield text
+            # Only complete answers are cached; a cancelled stream never gets here
+            self.cache.put(key, "response", "".join(parts))
+        except Exception as e:
+            yield f"❌ AI Engine Error: {str(e)}"
+
+    def _fold_summary(self, channel, summary, messages):
+        """Ask Gemini to fold new messages into a channel's running summary"""
+        formatted = context_builder.build_context(messages, context_builder.BUDGETS["summary"])
+        prompt = (
+            f"You maintain a rolling summary of the #{channel} relay channel for later pulse reports. "
+            "Update the current summary with the new messages below. Keep open issues, errors, "
+            "decisions, owners and blockers; drop chatter and anything since resolved. "
+            f"Reply with the updated summary only, at most {SUMMARY_MAX_WORDS} words."
+        )
+        response = self._generate(
+            "summary",
+            model=self.model_name,
+            # Same bound as a pulse call, so a hung fold can't stall the refresh
+            config=types.GenerateContentConfig(
+                system_instruction=self.system_instruction,
+                http_options=types.HttpOptions(timeout=int(PULSE_CHANNEL_TIMEOUT * 1000))
+            ),
+            contents=f"{prompt}\n\nCURRENT SUMMARY:\n{summary or '(none yet)'}\n\nNEW MESSAGES:\n{formatted}"
+        )
+        return (response.text or "").strip()
+
+    def summarize_channel(self, channel):
+        """Bring a channel's rolling summary up to date.
+
+        Returns (summary, delta): the stored summary (None if there isn't one
+        yet) and the messages newer than it, oldest first. Only when the delta
+        has grown past SUMMARY_FOLD_AT is its older part folded into the
+        summary, a page of at most SUMMARY_MAX_FOLD at a time and the cursor
+        only advanced past rows actually folded. On failure, or with backlog
+        left after SUMMARY_MAX_PAGES folds, the summary so far is returned with
+        the channel's newest messages raw.
+        """
+        stored = database.get_channel_summary(channel)
+        summary = stored["summary"] if stored else None
+        delta = database.get_history_after(channel, stored["last_id"] if stored else 0, SUMMARY_MAX_FOLD)
+
+        def newest(delta):
+            # A full page is the oldest of a longer backlog, not the latest state
+            return delta if len(delta) < SUMMARY_MAX_FOLD else database.get_local_history(channel, SUMMARY_MAX_FOLD)
+
+        if not self.client:
+            return self._stored_state(channel)
+        for _ in range(SUMMARY_MAX_PAGES):
+            if len(delta) <= SUMMARY_FOLD_AT:
+                return summary, delta
+            fold = delta[:-SUMMARY_RAW_TAIL]
+            try:
+                updated = self._fold_summary(channel, summary, fold)
+            except Exception as e:
+                communication.add_log(f"Summary update for #{channel} failed: {e}", "WARNING", component="ai", channel=channel)
+                return summary, newest(delta)
+            if not updated:
+                return summary, newest(delta)
+
+            database.save_channel_summary(channel, updated, fold[-1]["id"], fold[-1]["timetoken"], folded=len(fold))
+            summary = updated
+            if len(delta) < SUMMARY_MAX_FOLD:
+                return summary, delta[-SUMMARY_RAW_TAIL:]
+            delta = database.get_history_after(channel, fold[-1]["id"], SUMMARY_MAX_FOLD)
+        return summary, newest(delta)
+
+    def refresh_summaries(self, channels):
+        """Fold each channel's backlog into its rolling summary (background work,
+        outside any pulse deadline). Returns how many channels were refreshed."""
+        if not self.client:
+            return 0
+        for channel in channels:
+            self.summarize_channel(channel)
+        return len(channels)
+
+    def _stored_state(self, channel):
+        """(summary, delta) as last folded, without calling Gemini"""
+        stored = database.get_channel_summary(channel)
+        summary = stored["summary"] if stored else None
+        delta = database.get_history_after(channel, stored["last_id"] if stored else 0, SUMMARY_MAX_FOLD)
+        if len(delta) >= SUMMARY_MAX_FOLD:
+            # The backlog hasn't been folded yet: show the latest state, not its oldest page
+            delta = database.get_local_history(channel, SUMMARY_MAX_FOLD)
+        return summary, delta
+
+    def _channel_state(self, channel):
+        """A channel's rolling summary plus its newest messages, within the pulse budget.
+        Never folds, so a pulse costs exactly one call per channel."""
+        summary, delta = self._stored_state(channel)
+        sections = []
+        budget = context_builder.BUDGETS["pulse"]
+        if summary:
+            sections.append(f"Summary of earlier discussion:\n{summary}")
+            budget -= context_builder.estimate_tokens(summary)
+        if delta:
+            newest = context_builder.build_context(delta, max(budget, context_builder.MAX_MESSAGE_TOKENS))
+            sections.append(f"Newest messages:\n{newest}" if summary else newest)
+        return "\n".join(sections)
+
+    def _analyze_channel(self, channel, fresh=False):
+        """Map step of /pulse: findings for one channel (None if it has no history).
+        Runs on the pulse pool, so no tools - they may prompt the operator."""
+        state = self._channel_state(channel)
+        if not state:
+            return None
+
+        prompt = (
+            f"Analyze the recent state of the #{channel} relay channel for a cross-channel pulse report. "
+            f"In at most {PULSE_FINDING_WORDS} words, list active technical discussions, errors or blockers "
+            "(with severity) and progress. Reply 'QUIET' if nothing is notable."
+        )
+        key = response_cache.make_key("pulse_channel", self.model_name, self.system_instruction, prompt, context=state)
+        return self._generate_text(
+            "pulse_channel", key, fresh,
+            model=self.model_name,
+            config=types.GenerateContentConfig(
+                system_instruction=self.system_instruction,
+                http_options=types.HttpOptions(timeout=int(PULSE_CHANNEL_TIMEOUT * 1000))
+            ),
+            contents=f"{prompt}\n\n{state}"
+        )
+
+    def _map_channels(self, channels, fresh=False):
+        """Run _analyze_channel for every channel concurrently.
+
+        Returns {channel: (findings, error)}; a channel that failed or missed
+        its deadline has findings None and the reason in error.
+        """
+        with self._abandoned_lock:
+            self._abandoned = {f for f in self._abandoned if not f.done()}
+            busy = len(self._abandoned)
+        futures = {channel: self.pulse_pool.submit(self._analyze_channel, channel, fresh) for channel in channels}
+        # Channels queue behind each other (and behind calls an earlier pulse
+        # gave up on) on the pool, so allow one timeout per wave
+        waves = math.ceil((busy + len(futures)) / PULSE_WORKERS) if futures else 0
+        wait(futures.values(), timeout=PULSE_CHANNEL_TIMEOUT * waves)
+
+        results = {}
+        for channel, future in futures.items():
+            if not future.done():
+                # cancel() only stops calls still queued; a running one holds its worker
+                if not future.cancel():
+                    with self._abandoned_lock:
+                        self._abandoned.add(future)
+                results[channel] = (None, "timed out")
+            elif future.exception() is not None:
+                results[channel] = (None, str(future.exception()))
+            else:
+                results[channel] = (future.result(), None)
+            if results[channel][1]:
+                metrics.inc("trc_ai_pulse_channel_failures_total", channel=channel)
+                communication.add_log(
+                    f"Pulse analysis of #{channel} failed: {results[channel][1]}", "WARNING", component="ai", channel=channel
+                )
+        return results
+
+    def get_pulse(self, channels, fresh=False):
+        """Pulse report across channels, map-reduce style: every channel's summary
+        and newest messages are analysed in parallel, then one call merges the
+        findings (each step cached briefly unless fresh)"""
         if not self.client:
             return "⚠️ Gemini API Key not found."
 
         try:
-            prompt = (
-                "Analyze the following multi-channel relay history and provide a 'Pulse Report'. "
-                "Summarize active technical discussions, identify potential blockers or errors, "
-                "and highlight team progress across all relayed channels."
-            )
-            
-            # Format multi-channel history
-            context_text = "MULTI-CHANNEL RELAY HISTORY:\n"
-            for channel, messages in multi_channel_history.items():
-                context_text += f"\n--- Channel: #{channel} ---\n"
-                for m in messages:
-                    context_text += f"[{m['timestamp']}] {m['user']}: {m['message']}\n"
-
-            response = self.client.models.generate_content(
+            results = self._map_channels(channels, fresh)
+
+            sections = ["PER-CHANNEL FINDINGS:"]
+            for channel in channels:
+                findings, error = results[channel]
+                sections.append(f"\n--- Channel: #{channel} ---")
+                if error:
+                    sections.append(f"(analysis unavailable: {error})")
+                else:
+                    sections.append(findings or "(no local history)")
+            findings_text = "\n".join(sections) + "\n"
+        except Exception as e:
+            return f"❌ Pulse Generation Error: {str(e)}"
+
+        prompt = (
+            "Merge the following per-channel findings into a 'Pulse Report'. "
+            "Summarize active technical discussions, identify potential blockers or errors "
+            "(and links between channels), and highlight team progress across all relayed channels. "
+            "Mention briefly any channel whose analysis was unavailable."
+        )
+        try:
+            key = response_cache.make_key("pulse", self.model_name, self.system_instruction, prompt, context=findings_text)
+            return self._generate_text(
+                "pulse", key, fresh,
                 model=self.model_name,
                 config=types.GenerateContentConfig(
                     system_instruction=self.system_instruction,
                     tools=self.tools,
                     automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=False)
                 ),
-                contents=f"{prompt}\n\n{context_text}"
+                contents=f"{prompt}\n\n{findings_text}"
             )
-            return response.text
         except Exception as e:
-            return f"❌ Pulse Generation Error: {str(e)}"
+            # The per-channel findings are still worth showing
+            return f"❌ Pulse Generation Error: {str(e)}\n\n{findings_text}"
 
-    def analyze_image(self, image_path, user_prompt=None):
-        """Analyze a local image file using multimodal capabilities"""
+    def analyze_image(self, image_path, user_prompt=None, fresh=False):
+        """Analyze a local image file using multimodal capabilities (cached by image bytes unless fresh)"""
         if not self.client:
             return "⚠️ Gemini API Key not found."
 
@@ -267,7 +581,11 @@ class TRCAIEngine:
             ext = os.path.splitext(image_path)[1].lower()
             mime_type = "image/png" if ext == ".png" else "image/jpeg"
 
-            response = self.client.models.generate_content(
+            key = response_cache.make_key(
+                "vision", self.model_name, self.system_instruction, prompt, blob=mime_type.encode() + image_data
+            )
+            return self._generate_text(
+                "vision", key, fresh,
                 model=self.model_name,
                 config=types.GenerateContentConfig(
                     system_instruction=self.system_instruction,
@@ -279,13 +597,13 @@ class TRCAIEngine:
                     types.Part.from_bytes(data=image_data, mime_type=mime_type)
                 ]
             )
-            return response.text
         except Exception as e:
             return f"❌ Vision Engine Error: {str(e)}"
 
     def detect_anomalies(self, messages, channel="general"):
         """Passively analyze a batch of messages for technical risks or errors."""
-        if not self.client or not messages:
+        # Carried-over context alone was already analyzed with its own window
+        if not self.client or not any(not m.get("context") for m in messages):
             return None
 
         try:
@@ -293,18 +611,23 @@ class TRCAIEngine:
             topic = database.get_channel_topic(channel)
             topic_context = f"CURRENT OBJECTIVE: {topic}\n" if topic else ""
 
-            # Format the messages for analysis
-            formatted_messages = "\n".join([f"[{m['user']}]: {m['message']}" for m in messages])
+            # Format the messages for analysis, previous-window lines labelled as such
+            formatted_messages = context_builder.build_window_context(
+                messages, context_builder.BUDGETS["anomaly"], formatter=lambda m: f"[{m['user']}]: {m['message']}"
+            )
             
             prompt = (
-                f"{topic_context}\"Analyze the following recent messages from #{channel}.\n"
-                "If you detect a high-severity technical anomaly, a recurring error, a security risk, "
+                f"{topic_context}\"Analyze the new messages below from #{channel}.\n"
+                "If they show a high-severity technical anomaly, a recurring error, a security risk, "
                 "or a critical blocker that prevents the team from reaching the objective, "
-                "return a response starting with 'ALERT:'. Otherwise, return 'STATUS: OK'.\n\n"
-                f"Messages:\n{formatted_messages}"
+                "return a response starting with 'ALERT:'. Otherwise, return 'STATUS: OK'. "
+                "Previous context is only there for continuity: it was already analyzed, so don't "
+                "alert on it unless the new messages show the problem continuing or getting worse.\n\n"
+                f"{formatted_messages}"
             )
 
-            response = self.client.models.generate_content(
+            response = self._generate(
+                "anomaly",
                 model=self.model_name,
                 config=types.GenerateContentConfig(
                     system_instruction=self.system_instruction,
@@ -315,6 +638,7 @@ class TRCAIEngine:
             
             text = response.text.strip()
             if text.upper().startswith("ALERT:"):
+                metrics.inc("trc_ai_alerts_total", channel=channel)
                 return text
             return None # No anomaly detected
         except Exception:
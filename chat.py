@@ -6,6 +6,8 @@ import time
 import os
 import database
 import ai_engine
+import context_builder
+import metrics
 import sys
 from datetime import datetime
 
@@ -24,10 +26,40 @@ RESET = '\033[0m'
 current_user = ""
 current_channel = "general"
 
+# How often the background retention/compaction pass runs (seconds)
+MAINTENANCE_INTERVAL = 3600
+
+# How often joined channels' rolling summaries are brought up to date (seconds)
+SUMMARY_INTERVAL = 300
+
+# Replayed messages shown after a reconnect (the rest are summarised)
+REPLAY_PREVIEW = 5
+
+# Longest message accepted from the prompt or /paste. Anything over the relay's
+# per-publish limit is chunked transparently by communication.send.
+MAX_INPUT_LEN = 16000
+
+# Gemini commands whose answers are cached; a trailing "!" (/trc!, /pulse!)
+# skips the cache and asks again
+AI_COMMANDS = ("trc", "whisper", "analyze", "pulse")
+
 def format_time():
     """Return current time as HH:MM"""
     return datetime.now().strftime("%H:%M")
 
+def format_last_seen(epoch):
+    """Describe an epoch-seconds timestamp relative to now (e.g. '5m ago')"""
+    if epoch is None:
+        return "last seen: unknown"
+    delta = max(0, int(time.time()) - epoch)
+    if delta < 60:
+        return "last seen: just now"
+    if delta < 3600:
+        return f"last seen: {delta // 60}m ago"
+    if delta < 86400:
+        return f"last seen: {delta // 3600}h ago"
+    return f"last seen: {delta // 86400}d ago"
+
 def show_history(channel, count=10):
     """Display message history for a channel"""
     print(f"\n{YELLOW}--- Last {count} messages in #{channel} ---{RESET}")
@@ -71,45 +103,291 @@ def show_local_history(channel, count=50):
         
     print(f"{GREEN}--- End of Local History ---{RESET}\n")
 
-def show_logs(count=20):
-    """Display internal technical logs"""
-    print(f"\n{RED}--- Technical Diagnostic Logs (Last {count}) ---{RESET}")
-    logs = communication.get_logs(count)
+def show_search_results(query, channel=None, include_archive=False):
+    """Display full-text search hits from the local SQLite history (and optionally the archive)"""
+    scope = f"#{channel}" if channel else "all channels"
+    print(f"\n{GREEN}--- Search '{query}' in {scope} ---{RESET}")
+    results = database.search_messages(query, channel=channel, limit=20)
+    if include_archive:
+        results += database.search_archive(query, channel=channel, limit=20)
+
+    if results:
+        for r in results:
+            snippet = r["snippet"].replace("«", f"{BOLD}{YELLOW}").replace("»", f"{RESET}{CYAN}")
+            marker = " (archived)" if r.get("archived") else ""
+            print(f"{CYAN}[{r['timestamp']}] #{r['channel']}{marker} [{r['user']}]: {snippet}{RESET}")
+    else:
+        print(f"{CYAN}No matching messages found.{RESET}")
+
+    print(f"{GREEN}--- End of Search ---{RESET}\n")
+
+def paste_message():
+    """Read a multi-line block (stack trace, log excerpt) and send it as one message"""
+    print(f"{YELLOW}Paste your text, then enter a line containing only '.' to send (Ctrl-D also ends).{RESET}")
+    lines = []
+    while True:
+        try:
+            line = input()
+        except EOFError:
+            break
+        if line == ".":
+            break
+        lines.append(line)
+
+    text = "\n".join(lines).rstrip()
+    if not text:
+        print(f"{YELLOW}Nothing to send.{RESET}")
+        return
+    if len(text) > MAX_INPUT_LEN:
+        print(f"{RED}❌ Paste too long! ({len(text)}/{MAX_INPUT_LEN} characters).{RESET}")
+        return
+
+    status = communication.send(current_channel, {"user": current_user, "message": text})
+    if status["success"]:
+        print(f"{GREEN}[{format_time()}] → sent {len(lines)} lines to #{current_channel}{RESET}")
+    elif status.get("queued"):
+        print(f"{YELLOW}⏳ Relay unreachable - paste saved to outbox, will send on reconnect.{RESET}")
+    else:
+        print(f"{RED}❌ Failed to send: {status['error']}{RESET}")
+
+def show_outbox():
+    """Display messages waiting in the offline outbox"""
+    pending = communication.getOutbox()
+    print(f"\n{YELLOW}--- Outbox ({len(pending)} pending) ---{RESET}")
+    if pending:
+        for entry in pending:
+            text = entry["payload"].get("message", "")
+            preview = text if len(text) <= 60 else text[:57] + "..."
+            print(f"{CYAN}[{entry['created_at']}] #{entry['channel']}: {preview}{RESET}")
+            if entry["attempts"] or entry["last_error"]:
+                print(f"    {RED}attempts: {entry['attempts']}, last error: {entry['last_error']}{RESET}")
+    else:
+        print(f"{CYAN}Nothing waiting - every message has been delivered.{RESET}")
+    print(f"{YELLOW}--- End of Outbox ---{RESET}\n")
+
+def handle_export(args):
+    """Stream a channel's local history to a JSONL or CSV file"""
+    usage = f"{RED}Usage: /export #channel path [--format jsonl|csv] [--gzip]{RESET}"
+    fmt = "jsonl"
+    compress = "--gzip" in args
+    args = [a for a in args if a != "--gzip"]
+    if "--format" in args:
+        idx = args.index("--format")
+        if idx + 1 >= len(args):
+            print(usage)
+            return
+        fmt = args[idx + 1].lower()
+        args = args[:idx] + args[idx + 2:]
+
+    if len(args) != 2 or fmt not in ("jsonl", "csv"):
+        print(usage)
+        return
+
+    channel, path = args[0].lstrip("#"), os.path.expanduser(args[1])
+    print(f"{YELLOW}Exporting #{channel} to {path}...{RESET}")
+    count = database.export_history(channel, path, fmt=fmt, compress=compress)
+    if count >= 0:
+        print(f"{GREEN}Exported {count} messages from #{channel} to {path}.{RESET}")
+    else:
+        print(f"{RED}❌ Export failed (see error above).{RESET}")
+
+def _parse_limit(value):
+    """Parse a retention limit argument: a positive integer, or '-' for no limit"""
+    if value == "-":
+        return None
+    limit = int(value)
+    if limit <= 0:
+        raise ValueError(value)
+    return limit
+
+def handle_retention(args):
+    """View, change or apply the local history retention policy"""
+    if not args:
+        policy = database.get_retention_policy(current_channel)
+        days = f"{policy['max_age_days']} days" if policy["max_age_days"] is not None else "forever"
+        rows = f"newest {policy['max_rows']} messages" if policy["max_rows"] is not None else "no row limit"
+        print(f"{YELLOW}#{current_channel} retention: {days}, {rows} (from: {policy['source']}){RESET}")
+        return
+
+    action = args[0].lower()
+    if action in ("set", "default") and len(args) == 3:
+        try:
+            days, rows = _parse_limit(args[1]), _parse_limit(args[2])
+        except ValueError:
+            print(f"{RED}❌ Limits must be positive numbers or '-' for no limit.{RESET}")
+            return
+        target = current_channel if action == "set" else "*"
+        if database.set_retention_policy(target, days, rows):
+            label = f"#{current_channel}" if action == "set" else "all channels (default)"
+            print(f"{GREEN}Retention updated for {label}.{RESET}")
+        else:
+            print(f"{RED}Failed to update retention policy.{RESET}")
+    elif action == "run":
+        print(f"{YELLOW}Applying retention and compacting local history...{RESET}")
+        archived, freed = database.run_maintenance()
+        if archived:
+            for ch, count in archived.items():
+                print(f"{GREEN}  #{ch}: archived {count} messages{RESET}")
+            print(f"{GREEN}  Released {freed} database pages.{RESET}")
+        else:
+            print(f"{CYAN}Nothing to archive.{RESET}")
+        if not database.incremental_vacuum_enabled():
+            print(f"{YELLOW}Free space isn't returned to disk until you run /retention vacuum once.{RESET}")
+    elif action == "vacuum":
+        if database.incremental_vacuum_enabled():
+            print(f"{CYAN}Incremental vacuum is already enabled; /retention run compacts as it goes.{RESET}")
+            return
+        print(f"{YELLOW}This rewrites the whole history file: TRC is blocked while it runs and it needs "
+              f"up to the file's size again in free disk space.{RESET}")
+        confirm = input(f"{RED}Convert {database.DB_NAME} to incremental vacuum now? (y/n): {RESET}").lower()
+        if confirm != "y":
+            print(f"{YELLOW}Vacuum cancelled.{RESET}")
+            return
+        freed = database.convert_to_incremental_vacuum()
+        if freed < 0:
+            print(f"{RED}Vacuum failed. See the output above.{RESET}")
+        else:
+            print(f"{GREEN}Converted. Released {freed} database pages.{RESET}")
+    else:
+        print(f"{RED}Usage: /retention [set DAYS|- ROWS|-] [default DAYS|- ROWS|-] [run] [vacuum]{RESET}")
+
+def run_maintenance_loop():
+    """Background thread: periodically archive expired history and compact the DB.
+    Never runs a full VACUUM - an older file only gets a one-time hint."""
+    hinted = False
+    while communication.running:
+        archived, _ = database.run_maintenance()
+        if archived:
+            communication.add_log(f"Retention archived {sum(archived.values())} messages", "INFO", component="maintenance")
+        if not hinted and not database.incremental_vacuum_enabled():
+            communication.add_log(
+                "History file predates incremental vacuum; run /retention vacuum during a quiet period to reclaim disk space",
+                "WARNING", component="maintenance"
+            )
+            hinted = True
+        time.sleep(MAINTENANCE_INTERVAL)
+
+def run_summary_loop():
+    """Background thread: fold new history into the rolling channel summaries,
+    so /pulse only reads them and never waits on a fold"""
+    while communication.running:
+        time.sleep(SUMMARY_INTERVAL)
+        channels = [ch for ch in communication.getActiveChannels() if not communication.isAggregate(ch)]
+        try:
+            ai_engine.ai_engine.refresh_summaries(channels)
+        except Exception as e:
+            communication.add_log(f"Summary refresh failed: {e}", "WARNING", component="ai")
+
+def show_logs(count=20, level=None):
+    """Display internal technical logs, optionally only those at or above level"""
+    label = f"Last {count}" + (f", {level.upper()}+" if level else "")
+    print(f"\n{RED}--- Technical Diagnostic Logs ({label}) ---{RESET}")
+    logs = communication.get_logs(count, level)
     if logs:
-        for log in logs:
-            if "ERROR" in log or "CRITICAL" in log:
-                print(f"{RED}{log}{RESET}")
-            elif "SUCCESS" in log:
-                print(f"{GREEN}{log}{RESET}")
+        for record in logs:
+            line = communication.format_log(record)
+            if record["level"] in ("ERROR", "CRITICAL"):
+                print(f"{RED}{line}{RESET}")
+            elif record["level"] == "SUCCESS":
+                print(f"{GREEN}{line}{RESET}")
+            elif record["level"] == "DEBUG":
+                print(f"{CYAN}{line}{RESET}")
             else:
-                print(f"{YELLOW}{log}{RESET}")
+                print(f"{YELLOW}{line}{RESET}")
     else:
         print(f"{CYAN}No diagnostic logs captured yet.{RESET}")
+    counts = communication.get_log_counts()
+    print(f"{CYAN}Totals: " + ", ".join(f"{lvl} {n}" for lvl, n in counts.items() if n) + f"{RESET}")
     print(f"{RED}--- End of Logs ---{RESET}\n")
     input(f"{YELLOW}Press Enter to continue...{RESET}")
 
+def handle_logs(args):
+    """/logs [N] [level]  |  /logs export <path> [level]"""
+    if args and args[0].lower() == "export":
+        if len(args) < 2:
+            print(f"{RED}Usage: /logs export <path> [level]{RESET}")
+            return
+        level = args[2] if len(args) > 2 else None
+        status = communication.export_logs(args[1], level)
+        if status["success"]:
+            print(f"{GREEN}Exported {status['count']} log records to {args[1]}{RESET}")
+        else:
+            print(f"{RED}❌ Export failed: {status['error']}{RESET}")
+        return
+
+    count, level = 20, None
+    for arg in args:
+        if arg.isdigit():
+            count = int(arg)
+        elif arg.upper() in communication.LOG_LEVELS:
+            level = arg
+        else:
+            print(f"{YELLOW}Unknown level '{arg}'. Use one of: {', '.join(communication.LOG_LEVELS)}{RESET}")
+            return
+    show_logs(count, level)
+
+def show_stats(prefix=None):
+    """Display runtime metrics, optionally only series whose name starts with prefix"""
+    snap = metrics.snapshot()
+
+    def wanted(key):
+        return prefix is None or key[0].startswith(prefix) or key[0].startswith(f"trc_{prefix}")
+
+    print(f"\n{CYAN}--- Runtime Stats ---{RESET}")
+    counters = sorted((k, v) for k, v in snap["counters"].items() if wanted(k))
+    gauges = sorted((k, v) for k, v in snap["gauges"].items() if wanted(k))
+    histograms = sorted((k, h) for k, h in snap["histograms"].items() if wanted(k))
+
+    if counters:
+        print(f"{YELLOW}Counters:{RESET}")
+        for key, value in counters:
+            print(f"  {metrics.format_key(key):<60} {value:g}")
+    if gauges:
+        print(f"{YELLOW}Gauges:{RESET}")
+        for key, value in gauges:
+            print(f"  {metrics.format_key(key):<60} {value:g}")
+    if histograms:
+        print(f"{YELLOW}Latency (count / avg / p95):{RESET}")
+        for key, h in histograms:
+            p95 = f"<={h['p95'] * 1000:g}ms" if h["p95"] is not None else "-"
+            print(f"  {metrics.format_key(key):<60} {h['count']:>6}  {h['avg'] * 1000:8.2f}ms  {p95}")
+    if not (counters or gauges or histograms):
+        print(f"{CYAN}No metrics recorded yet.{RESET}")
+    print(f"{CYAN}--- End of Stats ---{RESET}\n")
+
 def show_help():
     """Show the help menu"""
     print(f"\n{BOLD}{CYAN}TRC Command Suite - v1.2.0{RESET}")
     print(f"{YELLOW}--- Messaging ---{RESET}")
-    print(f"  /join #channel       Join and switch to a channel")
+    print(f"  /join #ch [#ch ...]  Join channels (also cg:<group>, prefix.*) and switch")
     print(f"  /leave #channel      Leave a channel")
     print(f"  /switch #channel     Switch active focus")
     print(f"  /broadcast [text]    Send message to ALL joined channels")
     print(f"  /channels            List all joined channels")
+    print(f"  /group cg:name ...   List/add/remove channel group members")
+    print(f"  /paste               Send a multi-line block (stack trace, logs)")
+    print(f"  /outbox [flush]      Show (or retry) messages queued while offline")
     print(f"{YELLOW}--- AI Orchestration ---{RESET}")
     print(f"  /trc [query]         Ask Gemini about current channel history")
     print(f"  /whisper [text]      Private brainstorm with Gemini (not relayed)")
     print(f"  /analyze [path]      Send an image/screenshot for AI diagnosis")
     print(f"  /pulse               Cross-channel technical health report")
+    print(f"  /trc! /pulse! ...    Same, but bypass the cached answer")
     print(f"{YELLOW}--- IRC & Context ---{RESET}")
     print(f"  /topic [text]        Set/View channel objective (Gemini-aware)")
     print(f"  /nick [name]         Change your identity (saved to DB)")
-    print(f"  /who                 List known technical participants")
+    print(f"  /who [minutes]       List participants by last activity")
     print(f"{YELLOW}--- Utilities ---{RESET}")
     print(f"  /history [N|local]   Show remote or local SQLite history")
-    print(f"  /logs [N]            View technical diagnostic logs")
+    print(f"  /search [#ch] text   Full-text search local history (--all: every channel)")
+    print(f"  /backfill #ch [N]    Pull missed relay history into SQLite (+N older)")
+    print(f"  /export #ch path     Export local history (--format jsonl|csv, --gzip)")
+    print(f"  /logs [N] [level]    View diagnostic logs (level: info, warning, error...)")
+    print(f"  /logs export path    Save buffered logs as JSONL")
+    print(f"  /stats [prefix]      Show runtime metrics (e.g. /stats db, /stats ai)")
     print(f"  /wipe                Clear local history for current channel")
+    print(f"  /retention [set|run] View/set history retention, or archive now")
+    print(f"  /retention vacuum    One-time full VACUUM so older files can compact")
     print(f"  /clear               Clear terminal screen")
     print(f"  /logout              Graceful exit")
     print(f"\n{MAGENTA}📡 [Monitor Mode]: TRC is passively watching background relays.{RESET}")
@@ -131,32 +409,69 @@ def clear_screen():
     """Clear the terminal screen"""
     print('\033[2J\033[H', end='')
 
-def join_channel(channel_name):
-    """Join a new channel"""
+def join_channels(channel_names):
+    """Join one or more channels (or cg:<group> / prefix.* subscriptions) in one subscribe"""
     global current_channel, current_user
     # Remove # if present
-    channel_name = channel_name.lstrip('#')
-    
-    if not channel_name:
-        print(f"{RED}Usage: /join #channel_name{RESET}")
+    names = [name.lstrip('#') for name in channel_names if name.lstrip('#')]
+
+    if not names:
+        print(f"{RED}Usage: /join #channel [#channel ...]  (also cg:<group>, prefix.*){RESET}")
         return
-    
-    channels = communication.getActiveChannels()
-    if channel_name in channels:
-        print(f"{YELLOW}Already in #{channel_name}{RESET}")
+
+    active = communication.getActiveChannels()
+    for name in names:
+        if name in active:
+            print(f"{YELLOW}Already in #{name}{RESET}")
+    names = [name for name in dict.fromkeys(names) if name not in active]
+    if not names:
         return
-    
-    communication.startStream(channel_name, on_message_received, on_anomaly_detected)
-    
+
+    communication.startStreams(names, on_message_received, on_anomaly_detected)
+
+    # Announce on plain channels concurrently; groups and wildcards are receive-only
     join_msg = {"user": "SYSTEM", "message": f"{current_user} has joined"}
-    status = communication.send(channel_name, join_msg)
-    
-    if status["success"]:
-        current_channel = channel_name
-        print(f"{GREEN}Joined #{channel_name} and switched to it{RESET}")
-        print(f"{MAGENTA}📡 [Monitor Mode]: Proactive AI watcher enabled for #{channel_name}{RESET}")
+    pending = {ch: communication.send_async(ch, join_msg) for ch in names if not communication.isAggregate(ch)}
+    for ch, future in pending.items():
+        status = future.result()
+        if not status["success"]:
+            print(f"{RED}⚠️ Could not notify #{ch} that you joined: {status['error']}{RESET}")
+
+    current_channel = names[0]
+    if len(names) == 1:
+        print(f"{GREEN}Joined #{current_channel} and switched to it{RESET}")
     else:
-        print(f"{RED}❌ Error joining #{channel_name}: {status['error']}{RESET}")
+        print(f"{GREEN}Joined {len(names)} channels (#{', #'.join(names)}), switched to #{current_channel}{RESET}")
+    if communication.isAggregate(current_channel):
+        print(f"{YELLOW}#{current_channel} is receive-only; /switch to a member channel to talk.{RESET}")
+    print(f"{MAGENTA}📡 [Monitor Mode]: Proactive AI watcher enabled for #{', #'.join(names)}{RESET}")
+
+def handle_group(args):
+    """/group cg:<name> [list | add ch ... | remove ch ...]"""
+    if not args:
+        print(f"{RED}Usage: /group cg:<name> [list | add #ch ... | remove #ch ...]{RESET}")
+        return
+    group = args[0]
+    action = args[1].lower() if len(args) > 1 else "list"
+    channels = [ch.lstrip('#') for ch in args[2:]]
+
+    if action == "list":
+        status = communication.listChannelGroup(group)
+        if status["success"]:
+            members = status["data"]
+            print(f"{CYAN}{group}: " + (f"#{', #'.join(members)}" if members else "(empty)") + f"{RESET}")
+        else:
+            print(f"{RED}❌ Could not list {group}: {status['error']}{RESET}")
+    elif action in ("add", "remove") and channels:
+        update = communication.addToChannelGroup if action == "add" else communication.removeFromChannelGroup
+        status = update(group, channels)
+        if status["success"]:
+            verb = "Added" if action == "add" else "Removed"
+            print(f"{GREEN}{verb} {len(channels)} channel(s) {'to' if action == 'add' else 'from'} {group}{RESET}")
+        else:
+            print(f"{RED}❌ Could not update {group}: {status['error']}{RESET}")
+    else:
+        print(f"{RED}Usage: /group cg:<name> [list | add #ch ... | remove #ch ...]{RESET}")
 
 def leave_channel(channel_name):
     """Leave a channel"""
@@ -178,10 +493,11 @@ def leave_channel(channel_name):
     
     # Leaving is a local action (unsubscribing) and must not be blocked by a
     # transient network/publish failure - the "has left" broadcast is best-effort.
-    leave_msg = {"user": "SYSTEM", "message": f"{current_user} has left"}
-    status = communication.send(channel_name, leave_msg)
-    if not status["success"]:
-        print(f"{RED}⚠️ Could not notify #{channel_name} that you left: {status['error']}{RESET}")
+    if not communication.isAggregate(channel_name):
+        leave_msg = {"user": "SYSTEM", "message": f"{current_user} has left"}
+        status = communication.send(channel_name, leave_msg)
+        if not status["success"]:
+            print(f"{RED}⚠️ Could not notify #{channel_name} that you left: {status['error']}{RESET}")
 
     communication.stopStream(channel_name)
     if current_channel == channel_name:
@@ -207,12 +523,28 @@ def switch_channel(channel_name):
     current_channel = channel_name
     print(f"{GREEN}Switched to #{channel_name}{RESET}")
 
+def stream_answer(chunks):
+    """Print a streamed Gemini answer as it arrives. Ctrl-C cancels the request
+    and returns to the prompt instead of exiting TRC."""
+    print(f"\n{CYAN}🤖 [Gemini]: ", end="", flush=True)
+    try:
+        for chunk in chunks:
+            print(chunk, end="", flush=True)
+    except KeyboardInterrupt:
+        chunks.close()
+        print(f"{RESET}\n{YELLOW}⏹  Cancelled.{RESET}\n")
+        return
+    print(f"{RESET}\n")
+
 def handle_command(command):
     """Process a command"""
     global current_user, current_channel
     parts = command[1:].split()
     cmd = parts[0].lower() if parts else ""
     args = parts[1:] if len(parts) > 1 else []
+    fresh = cmd.endswith("!") and cmd[:-1] in AI_COMMANDS
+    if fresh:
+        cmd = cmd[:-1]
     
     if cmd == "help":
         show_help()
@@ -221,7 +553,10 @@ def handle_command(command):
         show_channels()
     
     elif cmd == "join":
-        join_channel(args[0] if args else "")
+        join_channels(args)
+
+    elif cmd == "group":
+        handle_group(args)
     
     elif cmd == "leave":
         leave_channel(args[0] if args else "")
@@ -251,15 +586,64 @@ def handle_command(command):
         except ValueError:
             print(f"{RED}❌ Invalid argument: '{args[0]}'. Usage: /history [N|local]{RESET}")
     
+    elif cmd == "search":
+        # Scope defaults to the current channel; `#name` picks another, `--all` searches everything
+        channel = current_channel
+        include_archive = "--archive" in args
+        args = [a for a in args if a != "--archive"]
+        if args and args[0] == "--all":
+            channel = None
+            args = args[1:]
+        elif args and args[0].startswith("#"):
+            channel = args[0].lstrip("#")
+            args = args[1:]
+
+        if not args:
+            print(f"{RED}Usage: /search [#channel|--all] [--archive] words to find{RESET}")
+            return
+        show_search_results(" ".join(args), channel, include_archive)
+
+    elif cmd == "backfill":
+        channel = args[0].lstrip("#") if args else current_channel
+        older = 0
+        if len(args) > 1:
+            try:
+                older = int(args[1])
+            except ValueError:
+                print(f"{RED}❌ Invalid argument: '{args[1]}'. Usage: /backfill #channel [N]{RESET}")
+                return
+        print(f"{YELLOW}Backfilling #{channel} from relay history...{RESET}")
+        result = communication.backfillHistory(channel, older=older)
+        if result["success"]:
+            data = result["data"]
+            print(f"{GREEN}Fetched {data['fetched']} messages, stored {data['stored']} new in #{channel}.{RESET}")
+            if not data["gap_closed"]:
+                print(f"{YELLOW}⚠️ More than {communication.BACKFILL_GAP_LIMIT} messages were missed; only the newest were fetched.{RESET}")
+        else:
+            print(f"{RED}❌ Backfill failed: {result['error']}{RESET}")
+
+    elif cmd == "paste":
+        paste_message()
+
+    elif cmd == "outbox":
+        if args and args[0].lower() == "flush":
+            sent = communication.flushOutbox()
+            remaining = len(communication.getOutbox())
+            print(f"{GREEN}Sent {sent} queued messages ({remaining} still pending).{RESET}")
+            return
+        show_outbox()
+
+    elif cmd == "export":
+        handle_export(args)
+
+    elif cmd == "retention":
+        handle_retention(args)
+
     elif cmd == "pulse":
         print(f"\n{MAGENTA}🛸 [TRC Pulse] Gemini is reasoning over channel history...{RESET}")
-        # Fetch history for ALL joined channels
-        channels = communication.getActiveChannels()
-        multi_history = {}
-        for ch in channels:
-            multi_history[ch] = database.get_local_history(ch, limit=30)
-        
-        report = ai_engine.ai_engine.get_pulse(multi_history)
+        # Every joined channel: rolling summary plus what arrived since
+        channels = [ch for ch in communication.getActiveChannels() if not communication.isAggregate(ch)]
+        report = ai_engine.ai_engine.get_pulse(channels, fresh=fresh)
         print(f"\n{YELLOW}╔══════════ AI PULSE REPORT ══════════╗{RESET}")
         print(f"{report}")
         print(f"{YELLOW}╚═════════════════════════════════════╝{RESET}\n")
@@ -272,9 +656,8 @@ def handle_command(command):
         
         question = " ".join(args)
         print(f"\n{MAGENTA}🧠 [TRC Brain] Asking Gemini for context...{RESET}")
-        context = database.get_local_history(current_channel, limit=30)
-        answer = ai_engine.ai_engine.generate_response(question, current_channel, context)
-        print(f"\n{CYAN}🤖 [Gemini]: {answer}{RESET}\n")
+        context = database.get_local_history(current_channel, limit=context_builder.FETCH_LIMIT)
+        stream_answer(ai_engine.ai_engine.stream_response(question, current_channel, context, fresh=fresh))
         input(f"{YELLOW}Press Enter to continue...{RESET}")
 
     elif cmd == "analyze":
@@ -286,7 +669,7 @@ def handle_command(command):
         prompt = " ".join(args[1:]) if len(args) > 1 else None
         
         print(f"\n{MAGENTA}👁️ [Vision Engine] Gemini is analyzing the image...{RESET}")
-        report = ai_engine.ai_engine.analyze_image(path, prompt)
+        report = ai_engine.ai_engine.analyze_image(path, prompt, fresh=fresh)
         
         print(f"\n{YELLOW}╔══════════ VISION REPORT ══════════╗{RESET}")
         print(f"{report}")
@@ -304,13 +687,7 @@ def handle_command(command):
             print(f"{YELLOW}Wipe cancelled.{RESET}")
 
     elif cmd == "logs":
-        count = 20
-        if args:
-            try:
-                count = int(args[0])
-            except ValueError:
-                pass
-        show_logs(count)
+        handle_logs(args)
     
     elif cmd == "topic":
         if not args:
@@ -324,7 +701,8 @@ def handle_command(command):
             database.set_channel_topic(current_channel, new_topic)
             print(f"{GREEN}Topic updated! Gemini is now aware of this objective.{RESET}")
             # Announce to channel
-            topic_msg = {"user": "SYSTEM", "message": f"{current_user} changed the topic to: {new_topic}"}
+            # `topic` lets other TRC instances update their topic cache without parsing the text
+            topic_msg = {"user": "SYSTEM", "message": f"{current_user} changed the topic to: {new_topic}", "topic": new_topic}
             communication.send(current_channel, topic_msg)
 
     elif cmd == "nick":
@@ -352,20 +730,33 @@ def handle_command(command):
         question = " ".join(args)
         print(f"\n{MAGENTA}🤫 [Whisper] Consulting Gemini privately...{RESET}")
         # Direct response without public relay
-        answer = ai_engine.ai_engine.generate_response(question, current_channel)
-        print(f"\n{CYAN}🤖 [Gemini]: {answer}{RESET}\n")
+        stream_answer(ai_engine.ai_engine.stream_response(question, current_channel, fresh=fresh))
 
     elif cmd == "who":
-        users = database.get_known_users(current_channel)
-        print(f"\n{YELLOW}Known participants in #{current_channel}:{RESET}")
-        if not users:
+        # Optional N = only people active in the last N minutes
+        minutes = None
+        if args:
+            try:
+                minutes = int(args[0])
+            except ValueError:
+                print(f"{RED}❌ Invalid argument: '{args[0]}'. Usage: /who [minutes]{RESET}")
+                return
+        participants = database.get_participants(
+            current_channel, active_within=minutes * 60 if minutes else None
+        )
+        scope = f"active in the last {minutes}m" if minutes else "known"
+        print(f"\n{YELLOW}Participants {scope} in #{current_channel}:{RESET}")
+        if not participants:
             print(f"  {CYAN}No history of other users yet.{RESET}")
         else:
-            for u in users:
-                prefix = f"{GREEN}●{RESET}" if u == current_user else f"{CYAN}○{RESET}"
-                print(f"  {prefix} {u}")
+            for p in participants:
+                prefix = f"{GREEN}●{RESET}" if p["user"] == current_user else f"{CYAN}○{RESET}"
+                print(f"  {prefix} {p['user']:<20} {format_last_seen(p['last_seen'])}, {p['message_count']} msgs")
         print()
     
+    elif cmd == "stats":
+        show_stats(args[0] if args else None)
+
     elif cmd == "clear":
         clear_screen()
     
@@ -374,26 +765,27 @@ def handle_command(command):
             print(f"{RED}Usage: /broadcast your message here{RESET}")
             return
         broadcast_text = ' '.join(args)
-        success_count = 0
-        total_channels = 0
-        for ch in communication.getActiveChannels():
-            total_channels += 1
-            payload = {"user": current_user, "message": broadcast_text, "broadcast": True}
-            status = communication.send(ch, payload)
-            if status["success"]:
-                success_count += 1
+        payload = {"user": current_user, "message": broadcast_text, "broadcast": True}
+        # Fire every publish at once and then collect results, instead of one round trip per channel
+        targets = [ch for ch in communication.getActiveChannels() if not communication.isAggregate(ch)]
+        pending = {ch: communication.send_async(ch, payload) for ch in targets}
+        failed = [ch for ch, future in pending.items() if not future.result()["success"]]
+        success_count = len(pending) - len(failed)
+        total_channels = len(pending)
         
         time_str = format_time()
         if success_count == total_channels:
             print(f"{MAGENTA}[{time_str}] 📢 Broadcast to {success_count} channels: {broadcast_text}{RESET}")
         else:
-            print(f"{YELLOW}[{time_str}] 📢 Broadcast partially sent ({success_count}/{total_channels} channels).{RESET}")
+            print(f"{YELLOW}[{time_str}] 📢 Broadcast partially sent ({success_count}/{total_channels} channels). Failed: #{', #'.join(failed)}{RESET}")
     
     elif cmd == "logout":
-        # Leave all channels gracefully
+        # Leave all channels gracefully (published concurrently; update_running waits for them)
         for ch in communication.getActiveChannels():
+            if communication.isAggregate(ch):
+                continue
             leave_msg = {"user": "SYSTEM", "message": f"{current_user} has left"}
-            communication.send(ch, leave_msg)
+            communication.send_async(ch, leave_msg)
         communication.update_running(False)
         print(f"{GREEN}Goodbye! 👋{RESET}")
         sys.exit()
@@ -401,8 +793,30 @@ def handle_command(command):
     else:
         print(f"{RED}Unknown command: /{cmd}. Type /help for commands.{RESET}")
 
+def show_replayed(channel, messages):
+    """Compress a catch-up batch: a summary line plus the last few messages if in view"""
+    messages = [m for m in messages if m.get("user") != current_user]
+    if not messages:
+        return
+    in_view = channel == current_channel or communication.subscriptionOf(channel) == current_channel
+    if not in_view:
+        print(f"\n{YELLOW}↻ {len(messages)} missed messages replayed into #{channel}{RESET}")
+        return
+
+    print(f"\n{YELLOW}↻ {len(messages)} messages on #{channel} while you were disconnected:{RESET}")
+    hidden = len(messages) - REPLAY_PREVIEW
+    if hidden > 0:
+        print(f"{YELLOW}  ... {hidden} earlier (see /history local){RESET}")
+    for msg in messages[-REPLAY_PREVIEW:]:
+        epoch = database.timetoken_to_epoch(msg.get("timetoken"))
+        time_str = datetime.fromtimestamp(epoch).strftime("%H:%M") if epoch else "--:--"
+        print(f"{CYAN}  [{time_str}] ↻ [{msg.get('user', '')}]: {msg.get('message', '')}{RESET}")
+
 def on_message_received(channel, data):
     """Handle incoming messages from any channel"""
+    if data[0] and isinstance(data[0][0], dict) and data[0][0].get("replayed"):
+        show_replayed(channel, data[0])
+        return
     for msg in data[0]:
         if not isinstance(msg, dict):
             continue
@@ -416,17 +830,20 @@ def on_message_received(channel, data):
         if user == current_user:
             continue
         
-        # Only show messages from current channel (unless broadcast or system)
-        if channel != current_channel and not is_broadcast and "SYSTEM" not in user:
+        # Only show messages from current channel (unless broadcast or system).
+        # Viewing a group/wildcard shows every member channel it delivers.
+        in_view = channel == current_channel or communication.subscriptionOf(channel) == current_channel
+        if not in_view and not is_broadcast and "SYSTEM" not in user:
             continue
-        
+        origin = f"#{channel} " if channel != current_channel else ""
+
         # Format based on message type
         if "SYSTEM" in user:
-            print(f"\n{YELLOW}[{time_str}] ⚡ {text}{RESET}")
+            print(f"\n{YELLOW}[{time_str}] ⚡ {origin}{text}{RESET}")
         elif is_broadcast:
-            print(f"\n{MAGENTA}[{time_str}] 📢 [{user}]: {text}{RESET}")
+            print(f"\n{MAGENTA}[{time_str}] 📢 {origin}[{user}]: {text}{RESET}")
         else:
-            print(f"\n{CYAN}[{time_str}] ← [{user}]: {text}{RESET}")
+            print(f"\n{CYAN}[{time_str}] ← {origin}[{user}]: {text}{RESET}")
 
 def on_anomaly_detected(channel, messages):
     """Callback when the background AI watcher detects a technical anomaly"""
@@ -434,6 +851,14 @@ def on_anomaly_detected(channel, messages):
     if report:
         display_alert(channel, report)
 
+def report_send_failure(future):
+    """Done-callback for send_async: tell the user if a message didn't go out"""
+    status = future.result()
+    if status.get("queued"):
+        print(f"\n{YELLOW}⏳ Relay unreachable - message saved to outbox, will send on reconnect.{RESET}")
+    elif not status["success"]:
+        print(f"\n{RED}❌ Failed to send: {status['error']}{RESET}")
+
 def display_alert(channel, report):
     """Display a high-visibility AI alert in the terminal"""
     print(f"\n\n{RED}{BOLD}╔═══════════════════════════════════════════════════╗{RESET}")
@@ -454,6 +879,15 @@ if "--nick" in sys.argv:
     if idx + 1 < len(sys.argv):
         cli_nick = sys.argv[idx + 1]
 
+# Extra channels to follow from startup, e.g. a headless watcher's service
+# channels: TRC_CHANNELS="svc-a,svc-b,cg:services" or --channels svc-a,svc-b
+startup_channels = os.getenv("TRC_CHANNELS", "")
+if "--channels" in sys.argv:
+    idx = sys.argv.index("--channels")
+    if idx + 1 < len(sys.argv):
+        startup_channels = sys.argv[idx + 1]
+startup_channels = [ch.strip().lstrip('#') for ch in startup_channels.split(",") if ch.strip().lstrip('#')]
+
 # Welcome and handle identity
 print(f"{BOLD}{GREEN}Welcome to Chat!{RESET}")
 
@@ -500,8 +934,24 @@ else:
 print(f"{GREEN}Joined as {current_user}. Type /help for commands.{RESET}")
 print(f"{CYAN}Starting in #{current_channel}{RESET}\n")
 
-# Start listening on default channel
-communication.startStream(current_channel, on_message_received, on_anomaly_detected)
+# Start listening on the default channel plus any configured ones, in one subscribe
+startup_channels = list(dict.fromkeys([current_channel] + startup_channels))
+communication.startStreams(startup_channels, on_message_received, on_anomaly_detected)
+communication.flushSubscriptions()
+if len(startup_channels) > 1:
+    print(f"{CYAN}📡 Following {len(startup_channels)} channels{RESET}")
+
+# Keep local history within its retention policy while we run
+threading.Thread(target=run_maintenance_loop, daemon=True).start()
+# ...and the /pulse summaries current
+threading.Thread(target=run_summary_loop, daemon=True).start()
+
+# Optional Prometheus exporters (TRC_METRICS_PORT / TRC_METRICS_FILE)
+try:
+    for target in metrics.start_exporters():
+        print(f"{CYAN}📈 Exporting metrics to {target}{RESET}")
+except (OSError, ValueError) as e:
+    print(f"{RED}⚠️ Warning: Could not start metrics exporter ({e}){RESET}")
 
 # Announce that we joined
 join_msg = {"user": "SYSTEM", "message": f"{current_user} has joined"}
@@ -517,8 +967,8 @@ while True:
         continue
     
     # Check for excessive length
-    if len(message) > 1000:
-        print(f"{RED}❌ Message too long! ({len(message)}/1000 characters). Please shorten it.{RESET}")
+    if len(message) > MAX_INPUT_LEN:
+        print(f"{RED}❌ Message too long! ({len(message)}/{MAX_INPUT_LEN} characters). Please shorten it.{RESET}")
         continue
     
     # Check if it's a command
@@ -526,12 +976,11 @@ while True:
         handle_command(message)
         continue
     
-    # Send the message to current channel
+    # Send the message to current channel without waiting on the round trip;
+    # failures are reported when the publish finishes
     payload = {"user": current_user, "message": message}
-    status = communication.send(current_channel, payload)
+    pending = communication.send_async(current_channel, payload)
+    pending.add_done_callback(report_send_failure)
     
     time_str = format_time()
-    if status["success"]:
-        print(f"{GREEN}[{time_str}] → {message}{RESET}")
-    else:
-        print(f"{RED}❌ Failed to send: {status['error']}{RESET}")
+    print(f"{GREEN}[{time_str}] → {message}{RESET}")
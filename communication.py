@@ -1,159 +1,996 @@
 ## communication.py module
-## receive messages and send messages over the PubNub relay network
-## using the official pubnub SDK (real-time subscribe listener + sync publish/history calls)
+## receive messages and send messages over the relay network: PubNub by
+## default, or a local / socket relay (see transport.py) via TRC_TRANSPORT
 
 import os
+import re
 import json
+import time
+import zlib
+import base64
+import queue
+import uuid
+import random
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque
 from datetime import datetime
 
-from pubnub.pnconfiguration import PNConfiguration
-from pubnub.pubnub import PubNub
-from pubnub.callbacks import SubscribeCallback
-from pubnub.enums import PNStatusCategory, PNReconnectionPolicy
-from pubnub.exceptions import PubNubException
-
 import database
+import transport
+from transport import TransportError
+import metrics
 
 publishKey = os.getenv("PUBLISH_KEY", "demo")
 subscribeKey = os.getenv("SUBSCRIBE_KEY", "demo")
+# Relay backend: "pubnub", "local" (in-process) or "socket" (TRC_RELAY_ADDR,
+# host:port or unix:/path, served by `python transport.py`)
+TRANSPORT = os.getenv("TRC_TRANSPORT", "pubnub")
+RELAY_ADDR = os.getenv("TRC_RELAY_ADDR", transport.DEFAULT_RELAY_ADDR)
+RELAY_TOKEN = os.getenv(transport.RELAY_TOKEN_ENV)
 
 # Constraints
 MAX_MSG_LEN = 2000 # Backend limit higher than UI to allow for formatting
 
+# Chunking: a payload whose JSON exceeds MAX_MSG_LEN is sent as sequenced
+# parts {"user", "msg_id", "chunk": {"id", "seq", "total", "enc", "data"}}.
+# The serialized payload is base64 encoded (zlib-compressed first when that
+# helps) so each part's size is predictable. Receivers buffer parts for up
+# to CHUNK_REASSEMBLY_TIMEOUT seconds and handle the reassembled payload as
+# one message. MAX_PAYLOAD_LEN caps the size of a logical message.
+MAX_PAYLOAD_LEN = 64 * 1024
+CHUNK_DATA_LEN = 1500
+CHUNK_REASSEMBLY_TIMEOUT = 60.0
+MAX_PARTIAL_MESSAGES = 100 # Incomplete chunked messages buffered at once
+
+# History backfill: PubNub returns at most 100 messages per history call.
+# On join we page back through whatever was published since our high-water
+# mark, up to BACKFILL_GAP_LIMIT messages; /backfill N fetches N more
+# older messages beyond what we already hold.
+HISTORY_PAGE_SIZE = 100
+BACKFILL_GAP_LIMIT = 1000
+BACKFILL_DEFAULT = 100
+
+# Subscriptions: startStream/stopStream only record the change. Once the
+# first change lands, everything pending SUBSCRIBE_DEBOUNCE seconds later is
+# applied as one unsubscribe plus one subscribe call, since every call
+# restarts the SDK's long-poll loop. Names starting with CHANNEL_GROUP_PREFIX
+# are PubNub channel groups, names ending in ".*" are wildcard subscriptions;
+# both are receive-only and fan in messages from many channels. A failed
+# call puts its changes back and is retried SUBSCRIBE_RETRY_DELAY seconds later.
+SUBSCRIBE_DEBOUNCE = 0.1
+SUBSCRIBE_RETRY_DELAY = 2.0
+CHANNEL_GROUP_PREFIX = "cg:"
+
+# Dispatch: UI callbacks and AI watchers run on their own worker pools, off
+# the relay's delivery thread. Each channel has a bounded FIFO per pool;
+# when it overflows the oldest pending task is dropped and counted.
+UI_WORKERS = 2
+WATCHER_WORKERS = 2
+UI_QUEUE_LIMIT = 500
+WATCHER_QUEUE_LIMIT = 20
+DISPATCH_DRAIN_TIMEOUT = 5.0 # Seconds to let in-flight work finish on shutdown
+
+# Monitor Mode windowing. A channel's window is handed to its watcher when
+# it holds `target` new messages OR its oldest new message is
+# WINDOW_MAX_AGE seconds old, so a lone crash line on a quiet channel still
+# gets analyzed. `target` follows the channel's message rate: roughly
+# WINDOW_TARGET_SECONDS worth of traffic, clamped to [MIN, MAX], so busy
+# channels are analyzed in bigger, rarer batches. The last
+# WINDOW_CARRY_OVER messages of each batch are re-sent (flagged "context")
+# with the next one so an incident isn't cut in half.
+WINDOW_MIN_SIZE = 5
+WINDOW_MAX_SIZE = 50
+WINDOW_MAX_AGE = 30.0
+WINDOW_TARGET_SECONDS = 10.0
+WINDOW_CARRY_OVER = 2
+WINDOW_TICK = 1.0 # How often aged windows are checked
+WINDOW_RATE_SMOOTHING = 0.2 # EWMA weight of the newest inter-arrival rate
+
+# Outbound publishing: send_async() hands publishes to a small worker pool
+# with at most PUBLISH_QUEUE_LIMIT queued or in flight. Transient failures
+# (network errors, 429, 5xx) are retried with exponential backoff and full
+# jitter; client errors (bad keys, oversized payloads) fail immediately.
+PUBLISH_WORKERS = 4
+PUBLISH_QUEUE_LIMIT = 200
+PUBLISH_ENQUEUE_TIMEOUT = 5.0 # Seconds send_async waits for a queue slot
+PUBLISH_RETRIES = 3
+PUBLISH_BACKOFF_BASE = 0.25
+PUBLISH_BACKOFF_MAX = 4.0
+
+# Offline outbox: user messages whose publish fails transiently are kept in
+# SQLite and flushed in order, OUTBOX_BATCH_SIZE at a time, when the relay
+# connection comes back, after the next successful publish, and every
+# OUTBOX_RETRY_INTERVAL seconds while anything is waiting (a brief network
+# hiccup may never produce a reconnect event). Every outgoing payload carries
+# a "msg_id"; receivers remember the last SEEN_MSG_IDS_LIMIT ids and drop a
+# republished message they already got (e.g. the first publish landed but its
+# response was lost), and the messages table rejects a msg_id it already
+# stored. Timetokens of received messages share the same memory (see _accept).
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_RETRY_INTERVAL = 15.0
+SEEN_MSG_IDS_LIMIT = 20000
+
+# Catch-up replay: on reconnect, each joined channel's missed range (after
+# its newest stored timetoken) is paged from history and run through the
+# normal receive pipeline, up to REPLAY_MAX_MESSAGES per channel. Replayed
+# messages reach the UI as one batch marked "replayed". Only the newest
+# REPLAY_WATCH_LIMIT of them go to the AI watcher, as a single batch, and
+# only for the REPLAY_WATCH_CHANNELS busiest channels, so a long outage
+# can't turn into hundreds of Gemini calls.
+REPLAY_MAX_MESSAGES = 500
+REPLAY_WATCH_LIMIT = 30
+REPLAY_WATCH_CHANNELS = 5
+
 # flag to help with graceful shutdown
 running = True
 
-# Internal diagnostic logs
-logs = []
+# Internal diagnostic logs: a bounded ring of structured records, optionally
+# mirrored to a size-rotated JSONL file by a background writer
+LOG_CAPACITY = int(os.getenv("TRC_LOG_CAPACITY", "500"))
+LOG_FILE = os.getenv("TRC_LOG_FILE", "")
+LOG_FILE_MAX_BYTES = int(os.getenv("TRC_LOG_FILE_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_FILE_BACKUPS = int(os.getenv("TRC_LOG_FILE_BACKUPS", "3"))
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "SUCCESS": 25, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+logs = deque(maxlen=LOG_CAPACITY)
+_log_counts = dict.fromkeys(LOG_LEVELS, 0)
+_log_lock = threading.Lock()
+_log_sink = None
+
+class _JsonlSink:
+    """Appends log records to a JSONL file off the caller's thread, rotating
+    path -> path.1 -> ... -> path.N once the file passes max_bytes."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=LOG_CAPACITY * 4)
+        self._thread = threading.Thread(target=self._run, name="trc-log-sink", daemon=True)
+        self._thread.start()
+
+    def put(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1 # Never block a relay thread on disk I/O
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # Write whatever else is already waiting in the same open()
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [r for r in batch if r is not None]
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    for record in batch:
+                        f.write(json.dumps(record, default=str) + "\n")
+                if self.max_bytes and os.path.getsize(self.path) >= self.max_bytes:
+                    self._rotate()
+            except OSError:
+                self.dropped += len(batch)
 
-def add_log(event: str, level: str = "INFO"):
-    """Add a diagnostic event to the log buffer"""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    logs.append(f"[{timestamp}] {level}: {event}")
-    # Keep last 50 logs to prevent memory leak
-    if len(logs) > 50:
-        logs.pop(0)
+    def close(self, timeout=None):
+        self._queue.put(None)
+        self._thread.join(timeout)
 
-def get_logs(count: int = 20):
-    """Return the latest logs"""
-    return logs[-count:]
+def add_log(event: str, level: str = "INFO", component: str = "core", **fields):
+    """Add a diagnostic event to the log ring (and the JSONL sink, if enabled).
+
+    Extra keyword arguments are kept as structured fields, e.g. channel=...
+    """
+    level = level.upper()
+    record = {
+        "ts": time.time(),
+        "level": level,
+        "component": component,
+        "event": event,
+        "fields": fields,
+    }
+    with _log_lock:
+        logs.append(record)
+        _log_counts[level] = _log_counts.get(level, 0) + 1
+        sink = _log_sink
+    metrics.inc("trc_log_events_total", level=level)
+    if sink:
+        sink.put(record)
+
+def get_logs(count: int = 20, level: str = None, component: str = None):
+    """Return the latest log records, optionally only those at or above level
+    and/or from one component"""
+    threshold = LOG_LEVELS.get(level.upper(), 0) if level else 0
+    with _log_lock:
+        records = list(logs)
+    records = [
+        r for r in records
+        if LOG_LEVELS.get(r["level"], 0) >= threshold
+        and (component is None or r["component"] == component)
+    ]
+    return records[-count:] if count > 0 else []
+
+def get_log_counts():
+    """Return how many events were logged per level since startup"""
+    with _log_lock:
+        return dict(_log_counts)
+
+def format_log(record: dict):
+    """Render a log record as a single display line"""
+    timestamp = datetime.fromtimestamp(record["ts"]).strftime("%H:%M:%S")
+    line = f"[{timestamp}] {record['level']} {record['component']}: {record['event']}"
+    if record["fields"]:
+        line += " " + " ".join(f"{k}={v}" for k, v in record["fields"].items())
+    return line
 
 def clear_logs():
     """Clear all diagnostic logs"""
-    logs.clear()
+    with _log_lock:
+        logs.clear()
+
+def export_logs(path: str, level: str = None):
+    """Write the buffered log records to path as JSONL. Returns a status dict."""
+    records = get_logs(LOG_CAPACITY, level)
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + "\n")
+        return {"success": True, "count": len(records)}
+    except OSError as e:
+        return {"success": False, "error": str(e)}
+
+def enable_log_file(path: str, max_bytes: int = None, backups: int = None):
+    """Mirror log records to a rotating JSONL file (replaces any existing sink)"""
+    global _log_sink
+    sink = _JsonlSink(
+        path,
+        LOG_FILE_MAX_BYTES if max_bytes is None else max_bytes,
+        LOG_FILE_BACKUPS if backups is None else backups,
+    )
+    with _log_lock:
+        old, _log_sink = _log_sink, sink
+    if old:
+        old.close()
+
+def disable_log_file(timeout=None):
+    """Flush and stop the JSONL sink, if one is running"""
+    global _log_sink
+    with _log_lock:
+        sink, _log_sink = _log_sink, None
+    if sink:
+        sink.close(timeout)
+
+if LOG_FILE:
+    enable_log_file(LOG_FILE)
+
+class _ChannelDispatcher:
+    """Runs callbacks on a small worker pool while preserving per-channel order.
+
+    A channel is handed to at most one worker at a time, so its tasks run
+    strictly in submission order while different channels proceed in
+    parallel. After each task the channel goes to the back of the ready
+    queue, so one busy channel can't starve the rest.
+    """
+
+    def __init__(self, name: str, workers: int, queue_limit: int):
+        self.name = name
+        self.queue_limit = queue_limit
+        self.stats = {"dispatched": 0, "completed": 0, "dropped": 0, "failed": 0}
+        self._queues = {}            # channel -> deque of (fn, args)
+        self._scheduled = set()      # channels queued on _ready or being run
+        self._ready = queue.Queue()
+        self._pending = 0
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"trc-{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, channel: str, fn, *args):
+        """Queue fn(*args) for a channel. Returns False if this overflowed the queue."""
+        with self._cond:
+            if self._stopping:
+                return False
+            tasks = self._queues.setdefault(channel, deque())
+            overflowed = len(tasks) >= self.queue_limit
+            if overflowed:
+                tasks.popleft()
+                self._pending -= 1
+                self.stats["dropped"] += 1
+                dropped = self.stats["dropped"]
+            tasks.append((fn, args))
+            self._pending += 1
+            self.stats["dispatched"] += 1
+            if channel not in self._scheduled:
+                self._scheduled.add(channel)
+                self._ready.put(channel)
+
+        if overflowed and (dropped == 1 or dropped % 100 == 0):
+            add_log(f"{self.name} queue full for #{channel}: dropped oldest task ({dropped} total)", "WARNING", component="dispatch", channel=channel)
+        return not overflowed
+
+    def _run(self):
+        while True:
+            channel = self._ready.get()
+            if channel is None:
+                return
+            with self._cond:
+                tasks = self._queues.get(channel)
+                task = tasks.popleft() if tasks else None
+
+            if task:
+                fn, args = task
+                try:
+                    fn(*args)
+                except Exception as e:
+                    with self._cond:
+                        self.stats["failed"] += 1
+                    add_log(f"{self.name} callback failed for #{channel}: {e}", "ERROR", component="dispatch", channel=channel)
+
+            with self._cond:
+                if task:
+                    self._pending -= 1
+                    self.stats["completed"] += 1
+                if tasks:
+                    self._ready.put(channel)
+                else:
+                    self._scheduled.discard(channel)
+                    self._queues.pop(channel, None)
+                self._cond.notify_all()
+
+    def depth(self):
+        """Number of tasks queued or running"""
+        with self._cond:
+            return self._pending
+
+    def drain(self, timeout=None):
+        """Wait until every queued task has run. Returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def stop(self, timeout=None):
+        """Refuse new work, let queued work finish (up to timeout), then stop the workers"""
+        with self._cond:
+            self._stopping = True
+        drained = self.drain(timeout)
+        for _ in self._threads:
+            self._ready.put(None)
+        return drained
+
+
+class _AnomalyWindow:
+    """Size-or-age windowed batching of one channel's messages for the AI watcher"""
+
+    def __init__(self, min_size=None, max_size=None, max_age=None, target_seconds=None, carry_over=None):
+        self.min_size = min_size or WINDOW_MIN_SIZE
+        self.max_size = max(max_size or WINDOW_MAX_SIZE, self.min_size)
+        self.max_age = max_age or WINDOW_MAX_AGE
+        self.target_seconds = target_seconds or WINDOW_TARGET_SECONDS
+        self.carry_over = WINDOW_CARRY_OVER if carry_over is None else carry_over
+        self.messages = []
+        self.context = []
+        self.opened_at = None
+        self.last_arrival = None
+        self.rate = 0.0 # messages/second, smoothed
+
+    def target(self):
+        """Current flush size for this channel's message rate"""
+        return max(self.min_size, min(self.max_size, round(self.rate * self.target_seconds)))
+
+    def add(self, message: dict, now: float):
+        """Add a message; returns a batch if the window is now full"""
+        if self.last_arrival is not None:
+            instant = 1.0 / max(now - self.last_arrival, 0.01)
+            self.rate += WINDOW_RATE_SMOOTHING * (instant - self.rate)
+        self.last_arrival = now
+
+        if not self.messages:
+            self.opened_at = now
+        self.messages.append(message)
+        if len(self.messages) >= self.target():
+            return self.flush()
+        return None
+
+    def due(self, now: float):
+        """Returns a batch if the oldest pending message has waited max_age"""
+        if self.messages and now - self.opened_at >= self.max_age:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Emit carried-over context plus pending messages and start a new window"""
+        batch = [dict(m, context=True) for m in self.context] + self.messages
+        self.context = self.messages[-self.carry_over:] if self.carry_over else []
+        self.messages = []
+        self.opened_at = None
+        return batch
+
+
+def setWindowLimits(channel: str, **limits):
+    """Tune Monitor Mode windowing for one channel.
+
+    Accepts min_size, max_size, max_age, target_seconds and carry_over;
+    anything omitted uses the WINDOW_* defaults. Pending messages are kept.
+    """
+    with _lock:
+        _window_limits[channel] = limits
+        window = _windows.get(channel)
+        if window is not None:
+            updated = _AnomalyWindow(**limits)
+            updated.messages, updated.context = window.messages, window.context
+            updated.opened_at, updated.last_arrival, updated.rate = window.opened_at, window.last_arrival, window.rate
+            _windows[channel] = updated
+
+
+def _window_ticker():
+    """Background loop flushing windows that have aged out"""
+    while running:
+        time.sleep(WINDOW_TICK)
+        now = time.monotonic()
+        due = []
+        with _lock:
+            _reassembler.expire(now)
+            for channel, window in _windows.items():
+                watcher_callback = _channel_watchers.get(channel)
+                batch = window.due(now) if watcher_callback else None
+                if batch:
+                    due.append((channel, watcher_callback, batch))
+        for channel, watcher_callback, batch in due:
+            _watcher_dispatcher.submit(channel, watcher_callback, channel, batch)
+
+
+def _split_payload(payload: dict):
+    """Split an oversized payload into sequenced chunk parts (returns [payload] if it fits)"""
+    raw = json.dumps(payload).encode("utf-8")
+    if len(raw) <= MAX_MSG_LEN:
+        return [payload]
+
+    compressed = zlib.compress(raw, 9)
+    enc, data = ("zlib", compressed) if len(compressed) < len(raw) else ("raw", raw)
+    encoded = base64.b64encode(data).decode("ascii")
+    pieces = [encoded[i:i + CHUNK_DATA_LEN] for i in range(0, len(encoded), CHUNK_DATA_LEN)]
+    msg_id = payload["msg_id"]
+    return [{
+        "user": payload.get("user", "Unknown"),
+        # Each part needs its own idempotency key for outbox retries
+        "msg_id": f"{msg_id}:{seq}",
+        "chunk": {"id": msg_id, "seq": seq, "total": len(pieces), "enc": enc, "data": piece}
+    } for seq, piece in enumerate(pieces)]
+
+
+def _decode_chunks(enc: str, pieces):
+    """Rebuild the original payload dict from ordered chunk data (None if corrupt)"""
+    try:
+        data = base64.b64decode("".join(pieces))
+        if enc == "zlib":
+            # Bounded decompression - never inflate past the payload cap
+            inflater = zlib.decompressobj()
+            data = inflater.decompress(data, MAX_PAYLOAD_LEN + 1)
+            if len(data) > MAX_PAYLOAD_LEN or inflater.unconsumed_tail:
+                return None
+        payload = json.loads(data.decode("utf-8"))
+        return payload if isinstance(payload, dict) else None
+    except (ValueError, zlib.error):
+        return None
+
+
+class _Reassembler:
+    """Buffers chunk parts per (channel, message id) until every part has arrived"""
+
+    def __init__(self):
+        self._partial = {} # (channel, id) -> {"enc", "total", "parts": {seq: data}, "started"}
+
+    def add(self, channel: str, chunk: dict, now: float):
+        """Add one part; returns the reassembled payload once complete, else None"""
+        try:
+            key = (channel, str(chunk["id"]))
+            seq, total, enc, data = int(chunk["seq"]), int(chunk["total"]), chunk["enc"], chunk["data"]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if not 0 <= seq < total or total * CHUNK_DATA_LEN > MAX_PAYLOAD_LEN * 2 or not isinstance(data, str):
+            return None
+
+        entry = self._partial.get(key)
+        if entry is None:
+            if len(self._partial) >= MAX_PARTIAL_MESSAGES:
+                oldest = min(self._partial, key=lambda k: self._partial[k]["started"])
+                del self._partial[oldest]
+                add_log(f"Dropped incomplete chunked message on #{oldest[0]} (buffer full)", "WARNING", component="chunk", channel=oldest[0])
+            entry = self._partial[key] = {"enc": enc, "total": total, "parts": {}, "started": now}
+        entry["parts"][seq] = data
+
+        if len(entry["parts"]) < entry["total"]:
+            return None
+        del self._partial[key]
+        payload = _decode_chunks(entry["enc"], [entry["parts"][i] for i in range(entry["total"])])
+        if payload is None:
+            add_log(f"Discarded corrupt chunked message on #{channel}", "ERROR", component="chunk", channel=channel)
+        return payload
+
+    def expire(self, now: float):
+        """Drop messages whose parts haven't all arrived within CHUNK_REASSEMBLY_TIMEOUT"""
+        for key in [k for k, e in self._partial.items() if now - e["started"] >= CHUNK_REASSEMBLY_TIMEOUT]:
+            del self._partial[key]
+            add_log(f"Chunked message on #{key[0]} timed out waiting for parts", "WARNING", component="chunk", channel=key[0])
+
+
+def _reassemble_items(channel: str, items):
+    """Collapse chunk parts in a chronological (entry, timetoken) list into whole messages.
+
+    A reassembled message takes the timetoken of its final part; incomplete
+    ones are left out.
+    """
+    reassembler = _Reassembler()
+    result = []
+    for entry, timetoken in items:
+        if isinstance(entry, dict) and isinstance(entry.get("chunk"), dict):
+            entry = reassembler.add(channel, entry["chunk"], 0)
+            if entry is None:
+                continue
+        result.append((entry, timetoken))
+    return result
+
+
+_reassembler = _Reassembler() # live chunked messages, guarded by _lock
+_ui_dispatcher = _ChannelDispatcher("ui", UI_WORKERS, UI_QUEUE_LIMIT)
+_watcher_dispatcher = _ChannelDispatcher("watcher", WATCHER_WORKERS, WATCHER_QUEUE_LIMIT)
+for _dispatcher in (_ui_dispatcher, _watcher_dispatcher):
+    metrics.gauge_callback("trc_dispatch_queue", _dispatcher.depth, pool=_dispatcher.name)
+    metrics.gauge_callback("trc_dispatch_dropped", lambda d=_dispatcher: d.stats["dropped"], pool=_dispatcher.name)
+
+
+def getDispatchStats():
+    """Return counters and current queue depth for the UI and watcher pools"""
+    return {
+        d.name: dict(d.stats, queued=d.depth())
+        for d in (_ui_dispatcher, _watcher_dispatcher)
+    }
 
 ## update running flag
 def update_running(value: bool):
     global running
     running = value
     if not value:
-        pubnub.stop()
+        # Let queued publishes (e.g. "has left" notices) go out first
+        _publish_executor.shutdown(wait=True)
+        _subscriptions.cancel()
+        with _outbox_lock:
+            if _outbox_timer is not None:
+                _outbox_timer.cancel()
+        relay.stop()
+        # Deliver what's already been received before persistence shuts down
+        if not _ui_dispatcher.stop(DISPATCH_DRAIN_TIMEOUT):
+            add_log("UI dispatch queue not fully drained at shutdown", "WARNING", component="dispatch")
+        if not _watcher_dispatcher.stop(DISPATCH_DRAIN_TIMEOUT):
+            add_log("Watcher queue not fully drained at shutdown", "WARNING", component="dispatch")
+        _persist_high_water()
+        database.stop_writer()
+        database.close_connections()
+        disable_log_file(DISPATCH_DRAIN_TIMEOUT)
 
 # Per-channel registered callbacks, guarded by _lock since the SDK delivers
 # messages on its own background threads
 _channel_callbacks = {}   # channel -> callback(channel, data)
 _channel_watchers = {}    # channel -> watcher_callback(channel, messages)
-_accumulators = {}        # channel -> accumulated messages for anomaly detection
-ACCUMULATOR_LIMIT = 5      # Analyze every 5 messages
+_windows = {}             # channel -> _AnomalyWindow for anomaly detection
+_routes = {}              # member channel -> channel group / wildcard it arrived through
+_window_limits = {}       # channel -> per-channel overrides set via setWindowLimits
+# Channels whose local history is known to be contiguous with the relay
+# (backfilled and connected since). Live messages on these advance the
+# in-memory high-water mark, persisted on leave/disconnect/shutdown.
+_synced_channels = set()
+_live_high_water = {}     # channel -> newest live timetoken (int)
+# Catch-up replay starts after the last message received before an outage
+_last_received = {}       # channel -> newest timetoken received live (int)
+_replay_from = {}         # channel -> _last_received as of the (first) disconnect
+_seen_msg_ids = OrderedDict() # msg_id -> None, oldest first
 _lock = threading.Lock()
 
-pnconfig = PNConfiguration()
-pnconfig.publish_key = publishKey
-pnconfig.subscribe_key = subscribeKey
-pnconfig.uuid = f"trc-{os.getpid()}-{id(threading.current_thread())}"
-pnconfig.ssl = True
-pnconfig.reconnect_policy = PNReconnectionPolicy.EXPONENTIAL
-pnconfig.daemon = True # Background subscribe threads die with the main process
 
+# "<nick> changed the topic to: <topic>" - SYSTEM text from clients that
+# predate the structured `topic` field
+_TOPIC_ANNOUNCEMENT = re.compile(r" changed the topic to: (.+)$", re.DOTALL)
+
+
+def _apply_topic_announcement(channel: str, payload: dict):
+    """Keep our topic cache in sync when another instance changes a channel's topic"""
+    topic = payload.get("topic")
+    if not isinstance(topic, str):
+        match = _TOPIC_ANNOUNCEMENT.search(payload.get("message", ""))
+        topic = match.group(1) if match else None
+    if topic and topic != database.get_channel_topic(channel):
+        database.set_channel_topic(channel, topic)
+        add_log(f"Topic for #{channel} updated from relay", "INFO", component="relay", channel=channel)
+
+
+def _already_seen(msg_id):
+    """Record a message id; True if it was already seen recently"""
+    if not msg_id:
+        return False
+    with _lock:
+        if msg_id in _seen_msg_ids:
+            return True
+        _seen_msg_ids[msg_id] = None
+        if len(_seen_msg_ids) > SEEN_MSG_IDS_LIMIT:
+            _seen_msg_ids.popitem(last=False)
+    return False
+
+
+def _accept(channel: str, payload, timetoken, timestamp=None):
+    """Shared receive path: chunk reassembly, dedup and persistence.
+
+    Returns the complete payload to deliver, or None if there's nothing to
+    deliver (not a dict, waiting on more chunks, or a duplicate).
+    """
+    if not isinstance(payload, dict):
+        return None
+
+    if isinstance(payload.get("chunk"), dict):
+        if _already_seen(payload.get("msg_id")):
+            return None
+        with _lock:
+            payload = _reassembler.add(channel, payload["chunk"], time.monotonic())
+        if payload is None:
+            return None # still waiting for the rest of a chunked message
+
+    # msg_id catches outbox republishes of a message that got through; the
+    # timetoken catches a live message seen again by catch-up replay
+    if _already_seen(payload.get("msg_id")) or _already_seen(f"tt:{timetoken}"):
+        metrics.inc("trc_messages_duplicate_total")
+        return None
+    metrics.inc("trc_messages_received_total", channel=channel)
+
+    user = payload.get("user", "Unknown")
+
+    # Real, globally-unique relay timetoken - reliable dedup key across reconnects
+    # Queued for the group-commit writer so fsyncs never stall delivery
+    database.enqueue_message(
+        channel=channel,
+        user=user,
+        message=payload.get("message", ""),
+        timestamp=timestamp or datetime.now().strftime("%H:%M:%S"),
+        timetoken=str(timetoken),
+        msg_id=payload.get("msg_id")
+    )
 
-class _TRCListener(SubscribeCallback):
-    """Dispatches PubNub events to the channel-specific callbacks registered via startStream"""
+    if user == "SYSTEM":
+        _apply_topic_announcement(channel, payload)
+    return payload
 
-    def message(self, pn, message_result):
-        channel = message_result.channel
-        payload = message_result.message
-        if not isinstance(payload, dict):
+
+class _TRCListener:
+    """Dispatches relay events to the channel-specific callbacks registered via startStream"""
+
+    @metrics.timed("trc_receive_seconds")
+    def message(self, channel, subscription, payload, timetoken):
+        payload = _accept(channel, payload, timetoken)
+        if payload is None:
             return
 
         user = payload.get("user", "Unknown")
         text = payload.get("message", "")
 
-        # Real, globally-unique PubNub timetoken - reliable dedup key across reconnects
-        database.save_message(
-            channel=channel,
-            user=user,
-            message=text,
-            timestamp=datetime.now().strftime("%H:%M:%S"),
-            timetoken=str(message_result.timetoken)
-        )
-
         with _lock:
-            callback = _channel_callbacks.get(channel)
-            watcher_callback = _channel_watchers.get(channel)
+            route = _route(channel, subscription)
+            callback = _channel_callbacks.get(route)
+            watcher_callback = _channel_watchers.get(route)
+            if int(timetoken) > _last_received.get(channel, 0):
+                _last_received[channel] = int(timetoken)
+            if channel in _synced_channels:
+                if int(timetoken) > _live_high_water.get(channel, 0):
+                    _live_high_water[channel] = int(timetoken)
 
+        # Callbacks run on the dispatch pools - a slow UI or a multi-second
+        # Gemini call must never hold up delivery on the SDK thread
         if callback:
             # Preserve the historical `data[0]` = list-of-messages shape callers expect
-            callback(channel, [[payload], str(message_result.timetoken)])
+            _ui_dispatcher.submit(channel, callback, channel, [[payload], str(timetoken)])
 
         if watcher_callback and user != "SYSTEM":
             batch = None
             with _lock:
-                acc = _accumulators.setdefault(channel, [])
-                acc.append({"user": user, "message": text})
-                if len(acc) >= ACCUMULATOR_LIMIT:
-                    batch = list(acc)
-                    acc.clear()
+                window = _windows.get(channel)
+                if window is None and route != channel:
+                    # First message from a group/wildcard member: window it on its own
+                    limits = _window_limits.get(channel, _window_limits.get(route, {}))
+                    window = _windows[channel] = _AnomalyWindow(**limits)
+                if window is not None:
+                    batch = window.add({"user": user, "message": text}, time.monotonic())
             if batch:
-                watcher_callback(channel, batch)
+                _watcher_dispatcher.submit(channel, watcher_callback, channel, batch)
 
-    def status(self, pn, status):
-        if status.category == PNStatusCategory.PNConnectedCategory:
-            add_log("Connected to PubNub relay network", "SUCCESS")
-        elif status.category == PNStatusCategory.PNReconnectedCategory:
-            add_log("Reconnected to PubNub relay network", "SUCCESS")
+    def status(self, event, detail=None):
+        if event == transport.CONNECTED:
+            add_log(f"Connected to {relay.name} relay network", "SUCCESS", component="relay")
+            _start_outbox_flush()
+        elif event == transport.RECONNECTED:
+            add_log(f"Reconnected to {relay.name} relay network", "SUCCESS", component="relay")
             print("\n[+] Connection restored!")
-        elif status.category == PNStatusCategory.PNUnexpectedDisconnectCategory:
-            add_log("Unexpected disconnect from PubNub relay network", "ERROR")
+            _start_outbox_flush()
+            _start_replay()
+        elif event == transport.DISCONNECTED:
+            # Whatever is published while we're down is a gap in local history
+            _persist_high_water()
+            with _lock:
+                _synced_channels.clear()
+                for channel, timetoken in _last_received.items():
+                    _replay_from.setdefault(channel, timetoken)
+            add_log(f"Unexpected disconnect from {relay.name} relay network", "ERROR", component="relay")
             print("\n[!] Connection lost. Retrying in background...")
-        elif status.category == PNStatusCategory.PNAccessDeniedCategory:
-            add_log("Access denied: check your PUBLISH_KEY/SUBSCRIBE_KEY", "ERROR")
-        elif status.is_error():
-            add_log(f"Subscribe status error: {status.category}", "ERROR")
+        elif event == transport.ACCESS_DENIED:
+            hint = "TRC_RELAY_TOKEN" if relay.name == "socket" else "PUBLISH_KEY/SUBSCRIBE_KEY"
+            add_log(f"Access denied: check your {hint}", "ERROR", component="relay")
+        elif event == transport.ERROR:
+            add_log(f"Subscribe status error: {detail}", "ERROR", component="relay")
+
+
+_listener = _TRCListener()
+relay = transport.create_transport(
+    TRANSPORT,
+    publish_key=publishKey,
+    subscribe_key=subscribeKey,
+    uuid=f"trc-{os.getpid()}-{id(threading.current_thread())}",
+    address=RELAY_ADDR,
+    token=RELAY_TOKEN,
+)
+relay.add_listener(_listener)
+database.start_writer()
+threading.Thread(target=_window_ticker, name="trc-window-ticker", daemon=True).start()
+
+
+def useTransport(new_transport):
+    """Swap the relay backend at runtime (e.g. a transport.LocalTransport for
+    offline tests and benchmarks). Active subscriptions move to the new one."""
+    global relay
+    _subscriptions.flush()
+    with _lock:
+        active = list(_channel_callbacks)
+    old, relay = relay, new_transport
+    relay.add_listener(_listener)
+    old.stop()
+    if active:
+        relay.subscribe(*_split_names(active))
+
+
+def isAggregate(name: str):
+    """True for channel group and wildcard subscriptions (receive-only, no history)"""
+    return name.startswith(CHANNEL_GROUP_PREFIX) or name.endswith(".*")
+
+
+def _split_names(names):
+    """Separate subscription names into (channels, channel groups without prefix)"""
+    channels = [n for n in names if not n.startswith(CHANNEL_GROUP_PREFIX)]
+    groups = [n[len(CHANNEL_GROUP_PREFIX):] for n in names if n.startswith(CHANNEL_GROUP_PREFIX)]
+    return channels, groups
+
+
+def _route(channel: str, subscription):
+    """Name a message is registered under: the channel itself, or the wildcard /
+    channel group it arrived through. Caller holds _lock."""
+    if channel in _channel_callbacks or not subscription:
+        return channel
+    route = subscription if subscription in _channel_callbacks else CHANNEL_GROUP_PREFIX + subscription
+    _routes[channel] = route
+    return route
+
+
+def subscriptionOf(channel: str):
+    """Return the joined name that delivers a channel's messages (itself, or its group/wildcard)"""
+    with _lock:
+        if channel in _channel_callbacks:
+            return channel
+        return _routes.get(channel)
+
+
+class _SubscriptionBatcher:
+    """Coalesces subscribe/unsubscribe requests into one SDK call of each kind"""
+
+    def __init__(self, delay: float, retry_delay: float = None):
+        self.delay = delay
+        self.retry_delay = SUBSCRIBE_RETRY_DELAY if retry_delay is None else retry_delay
+        self._subscribe = set()
+        self._unsubscribe = set()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, names):
+        with self._lock:
+            for name in names:
+                self._unsubscribe.discard(name)
+                self._subscribe.add(name)
+            self._schedule()
+
+    def unsubscribe(self, names):
+        with self._lock:
+            for name in names:
+                self._subscribe.discard(name)
+                self._unsubscribe.add(name)
+            self._schedule()
+
+    def _schedule(self, delay=None):
+        if self._timer is None:
+            self._timer = threading.Timer(self.delay if delay is None else delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._subscribe.clear()
+            self._unsubscribe.clear()
+
+    def _restore(self, subscribe, unsubscribe):
+        """Put back changes a failed call didn't apply (unless a newer request
+        for the same name superseded them) and schedule a retry"""
+        with self._lock:
+            for name in subscribe:
+                if name not in self._unsubscribe:
+                    self._subscribe.add(name)
+            for name in unsubscribe:
+                if name not in self._subscribe:
+                    self._unsubscribe.add(name)
+            self._schedule(self.retry_delay)
+
+    def flush(self):
+        """Apply every pending change now"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            subscribe, self._subscribe = sorted(self._subscribe), set()
+            unsubscribe, self._unsubscribe = sorted(self._unsubscribe), set()
+        unsubscribe_done = False
+
+        try:
+            if unsubscribe:
+                relay.unsubscribe(*_split_names(unsubscribe))
+                unsubscribe_done = True
+            if subscribe:
+                relay.subscribe(*_split_names(subscribe))
+        except TransportError as e:
+            failed = (subscribe, []) if unsubscribe_done else (subscribe, unsubscribe)
+            self._restore(*failed)
+            add_log(f"Subscription update failed, retrying in {self.retry_delay:g}s: {str(e)}", "ERROR", component="relay")
+            return
+        if subscribe or unsubscribe:
+            metrics.inc("trc_subscribe_calls_total")
+            add_log(f"Subscriptions updated: +{len(subscribe)} -{len(unsubscribe)}", "INFO", component="relay")
+
+
+_subscriptions = _SubscriptionBatcher(SUBSCRIBE_DEBOUNCE)
+
+
+def flushSubscriptions():
+    """Apply pending subscribe/unsubscribe changes immediately instead of after the debounce"""
+    _subscriptions.flush()
+
 
-    def presence(self, pn, presence):
-        pass
+def startStreams(channels, callback, watcher_callback=None):
+    """Start receiving messages for several channels / groups / wildcards at once.
 
+    All of them are subscribed in a single SDK call. Returns the names that
+    weren't already active.
+    """
+    added = []
+    with _lock:
+        for channel in channels:
+            if channel not in _channel_callbacks:
+                added.append(channel)
+            _channel_callbacks[channel] = callback
+            _channel_watchers[channel] = watcher_callback
+            if channel not in _windows and not isAggregate(channel):
+                _windows[channel] = _AnomalyWindow(**_window_limits.get(channel, {}))
+
+    if not added:
+        return added
 
-pubnub = PubNub(pnconfig)
-pubnub.add_listener(_TRCListener())
+    plain = [c for c in added if not isAggregate(c)]
+    # Serve recent-history reads (/trc, /pulse, the history tool) from memory
+    for channel in plain:
+        database.prewarm_history(channel)
+    _subscriptions.subscribe(added)
+
+    # Pull in whatever was said while we weren't listening, off the caller's
+    # thread - one channel at a time so a big join doesn't stampede the relay
+    if plain:
+        threading.Thread(target=_auto_backfill, args=(plain,), daemon=True).start()
+    return added
 
 
 def startStream(channel: str, callback, watcher_callback=None):
     """Start receiving messages for a channel with an optional AI watcher"""
+    startStreams([channel], callback, watcher_callback)
+
+
+def stopStreams(channels):
+    """Stop streaming several channels at once. Returns the names that were active."""
+    removed = []
     with _lock:
-        already_active = channel in _channel_callbacks
-        _channel_callbacks[channel] = callback
-        _channel_watchers[channel] = watcher_callback
-        _accumulators.setdefault(channel, [])
+        for channel in channels:
+            if channel not in _channel_callbacks:
+                continue
+            removed.append(channel)
+            del _channel_callbacks[channel]
+            _channel_watchers.pop(channel, None)
+            _windows.pop(channel, None)
+            _last_received.pop(channel, None)
+            _replay_from.pop(channel, None)
+            # Forget windows of group/wildcard members we no longer receive
+            for member in [m for m, r in _routes.items() if r == channel]:
+                del _routes[member]
+                if member not in _channel_callbacks:
+                    _windows.pop(member, None)
 
-    if already_active:
-        return
+    if not removed:
+        return removed
 
-    pubnub.subscribe().channels([channel]).execute()
+    _subscriptions.unsubscribe(removed)
+    for channel in removed:
+        if isAggregate(channel):
+            continue
+        _persist_high_water(channel)
+        with _lock:
+            _synced_channels.discard(channel)
+        database.evict_hot_history(channel)
+    return removed
 
 
 def stopStream(channel: str):
     """Stop streaming a specific channel"""
-    with _lock:
-        if channel not in _channel_callbacks:
-            return False
-        del _channel_callbacks[channel]
-        _channel_watchers.pop(channel, None)
-        _accumulators.pop(channel, None)
+    return bool(stopStreams([channel]))
+
+
+def addToChannelGroup(group: str, channels):
+    """Add channels to a channel group (name with or without the cg: prefix)"""
+    group = group[len(CHANNEL_GROUP_PREFIX):] if group.startswith(CHANNEL_GROUP_PREFIX) else group
+    try:
+        relay.add_to_group(group, list(channels))
+        return {"success": True}
+    except TransportError as e:
+        add_log(f"Channel group update failed: {str(e)}", "ERROR", component="relay", channel=group)
+        return {"success": False, "error": str(e), "code": 0}
+
+
+def removeFromChannelGroup(group: str, channels):
+    """Remove channels from a channel group"""
+    group = group[len(CHANNEL_GROUP_PREFIX):] if group.startswith(CHANNEL_GROUP_PREFIX) else group
+    try:
+        relay.remove_from_group(group, list(channels))
+        return {"success": True}
+    except TransportError as e:
+        add_log(f"Channel group update failed: {str(e)}", "ERROR", component="relay", channel=group)
+        return {"success": False, "error": str(e), "code": 0}
 
-    pubnub.unsubscribe().channels([channel]).execute()
-    return True
+
+def listChannelGroup(group: str):
+    """Return the channels currently in a channel group"""
+    group = group[len(CHANNEL_GROUP_PREFIX):] if group.startswith(CHANNEL_GROUP_PREFIX) else group
+    try:
+        return {"success": True, "data": relay.list_group(group)}
+    except TransportError as e:
+        add_log(f"Channel group lookup failed: {str(e)}", "ERROR", component="relay", channel=group)
+        return {"success": False, "error": str(e), "code": 0}
 
 
 def getActiveChannels():
@@ -162,42 +999,495 @@ def getActiveChannels():
         return list(_channel_callbacks.keys())
 
 
-def send(channel: str, payload: dict):
-    """Send a message and return status dict"""
+_publish_executor = ThreadPoolExecutor(max_workers=PUBLISH_WORKERS, thread_name_prefix="trc-publish")
+_publish_slots = threading.BoundedSemaphore(PUBLISH_QUEUE_LIMIT)
+
+
+def _is_transient(error: TransportError):
+    """Network failures (no HTTP status), throttling and server errors are worth retrying"""
+    status_code = error.status_code
+    return status_code == 0 or status_code == 429 or status_code >= 500
+
+
+def _validate_payload(channel: str, payload: dict):
+    """Return an error status dict if the payload can't be published, else None"""
+    if isAggregate(channel):
+        return {"success": False, "error": f"#{channel} is receive-only (channel group / wildcard)", "code": 400}
     json_data = json.dumps(payload)
 
-    # Basic length validation fallback
-    if len(json_data) > MAX_MSG_LEN:
-        add_log(f"Send rejected: Payload too large ({len(json_data)} characters)", "WARNING")
-        return {"success": False, "error": f"Payload too large (Max {MAX_MSG_LEN})", "code": 413}
+    # Anything over MAX_MSG_LEN is chunked; this is the hard cap on the whole message
+    if len(json_data) > MAX_PAYLOAD_LEN:
+        add_log(f"Send rejected: Payload too large ({len(json_data)} characters)", "WARNING", component="publish")
+        return {"success": False, "error": f"Payload too large (Max {MAX_PAYLOAD_LEN})", "code": 413}
+    return None
+
+
+def _publish_with_retry(channel: str, payload: dict):
+    """Publish, retrying transient errors. Returns (status dict, failure_was_transient)."""
+    attempt = 0
+    while True:
+        try:
+            with metrics.timer("trc_publish_seconds"):
+                timetoken = relay.publish(channel, payload)
+            metrics.inc("trc_messages_sent_total")
+            return {"success": True, "data": timetoken}, False
+        except TransportError as e:
+            transient = _is_transient(e)
+            if attempt >= PUBLISH_RETRIES or not transient:
+                metrics.inc("trc_publish_failures_total")
+                add_log(f"Send failed: {str(e)}", "ERROR", component="publish", channel=channel)
+                return {"success": False, "error": str(e), "code": 0}, transient
+            delay = random.uniform(0, min(PUBLISH_BACKOFF_MAX, PUBLISH_BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            metrics.inc("trc_publish_retries_total")
+            add_log(f"Send to #{channel} failed ({str(e)}), retry {attempt}/{PUBLISH_RETRIES} in {delay:.2f}s", "WARNING", component="publish", channel=channel)
+            time.sleep(delay)
+        except Exception as e:
+            metrics.inc("trc_publish_failures_total")
+            add_log(f"Send unexpected error: {str(e)}", "CRITICAL", component="publish", channel=channel)
+            return {"success": False, "error": f"Unexpected Error: {str(e)}", "code": -1}, False
+
+
+_outbox_lock = threading.Lock()        # guards _outbox_pending and outbox inserts
+_outbox_flush_lock = threading.Lock()  # one flush at a time
+_outbox_pending = database.count_outbox()
+_outbox_timer = None                   # pending periodic retry, if any
+metrics.gauge_callback("trc_outbox_pending", lambda: _outbox_pending)
+
+
+def _queue_outbox(channel: str, payload: dict, error: str):
+    """Park a message in the durable outbox; returns the status dict send() reports"""
+    global _outbox_pending
+    with _outbox_lock:
+        stored = database.add_to_outbox(channel, payload, payload["msg_id"], error)
+        if stored:
+            _outbox_pending += 1
+    if not stored:
+        return {"success": False, "error": error, "code": 0}
+    metrics.inc("trc_outbox_queued_total")
+    add_log(f"Send to #{channel} queued in outbox: {error}", "WARNING", component="outbox", channel=channel)
+    _schedule_outbox_retry()
+    return {"success": False, "queued": True, "error": f"Queued in outbox ({error})", "code": 0}
 
+
+def _publish(channel: str, payload: dict):
+    """Publish a message, falling back to the outbox when the relay is unreachable.
+
+    SYSTEM notices (joins, leaves) aren't queued - they'd be misleading if
+    delivered late.
+    """
+    queueable = payload.get("user") != "SYSTEM"
+    if queueable:
+        with _outbox_lock:
+            behind = _outbox_pending > 0
+        if behind:
+            # Keep ordering: nothing overtakes messages already waiting
+            return _queue_outbox(channel, payload, "waiting for earlier outbox messages")
+
+    status, transient = _publish_with_retry(channel, payload)
+    if status["success"]:
+        # The relay is reachable again: deliver anything still waiting
+        _start_outbox_flush()
+    elif transient and queueable:
+        return _queue_outbox(channel, payload, status["error"])
+    return status
+
+
+def flushOutbox():
+    """Publish queued outbox messages in order. Returns the number sent.
+
+    Stops at the first transient failure (still offline) and leaves the rest
+    for the next reconnect. Messages rejected outright (e.g. access denied)
+    are dropped so they can't block the queue forever.
+    """
+    global _outbox_pending
+    if not _outbox_flush_lock.acquire(blocking=False):
+        return 0
+    sent = 0
     try:
-        envelope = pubnub.publish().channel(channel).message(payload).sync()
-        return {"success": True, "data": envelope.result.timetoken}
-    except PubNubException as e:
-        add_log(f"Send failed: {str(e)}", "ERROR")
-        return {"success": False, "error": str(e), "code": 0}
-    except Exception as e:
-        add_log(f"Send unexpected error: {str(e)}", "CRITICAL")
-        return {"success": False, "error": f"Unexpected Error: {str(e)}", "code": -1}
+        while True:
+            batch = database.get_outbox(limit=OUTBOX_BATCH_SIZE)
+            if not batch:
+                with _outbox_lock:
+                    # Re-check under the lock so a message queued just now isn't stranded
+                    _outbox_pending = database.count_outbox()
+                    if _outbox_pending == 0:
+                        break
+                continue
+
+            done = []
+            stalled = False
+            for entry in batch:
+                status, transient = _publish_with_retry(entry["channel"], entry["payload"])
+                if status["success"]:
+                    done.append(entry["id"])
+                    sent += 1
+                elif transient:
+                    database.record_outbox_attempt(entry["id"], status["error"])
+                    stalled = True
+                    break
+                else:
+                    add_log(f"Dropped outbox message for #{entry['channel']}: {status['error']}", "ERROR", component="outbox", channel=entry['channel'])
+                    done.append(entry["id"])
+            database.remove_from_outbox(done)
+            if stalled:
+                break
+    finally:
+        _outbox_flush_lock.release()
+
+    if sent:
+        add_log(f"Outbox flushed: {sent} queued messages sent", "SUCCESS", component="outbox")
+    return sent
+
+
+def _flush_and_reschedule():
+    flushOutbox()
+    _schedule_outbox_retry()
+
+
+def _start_outbox_flush():
+    """Flush the outbox in the background if anything is waiting"""
+    with _outbox_lock:
+        pending = _outbox_pending
+    if pending and not _outbox_flush_lock.locked():
+        threading.Thread(target=_flush_and_reschedule, name="trc-outbox-flush", daemon=True).start()
 
 
+def _on_outbox_timer():
+    global _outbox_timer
+    with _outbox_lock:
+        _outbox_timer = None
+    _flush_and_reschedule()
+
+
+def _schedule_outbox_retry():
+    """Retry the outbox in OUTBOX_RETRY_INTERVAL seconds unless it's empty or
+    a retry is already scheduled - the fallback when no reconnect event comes"""
+    global _outbox_timer
+    with _outbox_lock:
+        if _outbox_timer is not None or not _outbox_pending or not running:
+            return
+        _outbox_timer = threading.Timer(OUTBOX_RETRY_INTERVAL, _on_outbox_timer)
+        _outbox_timer.daemon = True
+        _outbox_timer.start()
+
+
+def getOutbox():
+    """Return messages waiting in the outbox, oldest first"""
+    return database.get_outbox()
+
+
+def _with_msg_id(payload: dict):
+    """Copy of payload carrying an idempotency key (kept if it already has one)"""
+    if payload.get("msg_id"):
+        return payload
+    return dict(payload, msg_id=uuid.uuid4().hex)
+
+
+def _completed(result: dict):
+    """A Future that's already resolved to `result`"""
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _publish_message(channel: str, payload: dict):
+    """Publish a payload, as sequenced chunk parts if it's over MAX_MSG_LEN"""
+    status = None
+    for part in _split_payload(payload):
+        status = _publish(channel, part)
+        if not status["success"] and not status.get("queued"):
+            return status
+    return status
+
+
+@metrics.timed("trc_send_seconds")
+def send(channel: str, payload: dict):
+    """Send a message and return status dict (blocks until published or failed)"""
+    payload = _with_msg_id(payload)
+    error = _validate_payload(channel, payload)
+    if error:
+        return error
+    return _publish_message(channel, payload)
+
+
+def send_async(channel: str, payload: dict):
+    """Queue a message for publishing; returns a Future resolving to send()'s status dict.
+
+    Waits up to PUBLISH_ENQUEUE_TIMEOUT for room in the outbound queue and
+    fails with code 429 if it stays full.
+    """
+    payload = _with_msg_id(payload)
+    error = _validate_payload(channel, payload)
+    if error:
+        return _completed(error)
+
+    if not _publish_slots.acquire(timeout=PUBLISH_ENQUEUE_TIMEOUT):
+        metrics.inc("trc_publish_rejected_total")
+        add_log(f"Send to #{channel} rejected: outbound queue full", "WARNING", component="publish", channel=channel)
+        return _completed({"success": False, "error": "Outbound queue full", "code": 429})
+
+    try:
+        future = _publish_executor.submit(_publish_message, channel, payload)
+    except RuntimeError as e:
+        # Executor already shut down (we're exiting)
+        _publish_slots.release()
+        return _completed({"success": False, "error": str(e), "code": -1})
+    future.add_done_callback(lambda _: _publish_slots.release())
+    return future
+
+
+@metrics.timed("trc_history_fetch_seconds")
 def getHistory(channel: str, count: int = 10):
     """Fetch recent messages and return status dict"""
     try:
-        envelope = pubnub.history().channel(channel).count(count).sync()
-        messages = [item.entry for item in envelope.result.messages]
+        items = relay.history(channel, count)
+        messages = [entry for entry, _ in _reassemble_items(channel, items)]
         return {"success": True, "data": messages}
-    except PubNubException as e:
-        add_log(f"History fetch failed: {str(e)}", "ERROR")
+    except TransportError as e:
+        add_log(f"History fetch failed: {str(e)}", "ERROR", component="history", channel=channel)
+        return {"success": False, "error": str(e), "code": 0}
+    except Exception as e:
+        add_log(f"History unexpected error: {str(e)}", "CRITICAL", component="history", channel=channel)
+        return {"success": False, "error": f"Unexpected Error: {str(e)}", "code": -1}
+
+def _persist_high_water(channel=None):
+    """Write live high-water marks (one channel, or all) to the sync_state table"""
+    with _lock:
+        marks = {ch: tt for ch, tt in _live_high_water.items() if channel is None or ch == channel}
+        for ch in marks:
+            _live_high_water.pop(ch, None)
+    for ch, timetoken in marks.items():
+        database.update_sync_state(ch, high_water=timetoken)
+
+
+def _fetch_history_pages(channel: str, limit: int, start=None, end=None):
+    """Page backwards through relay history, newest first.
+
+    `start` (exclusive) and `end` (inclusive) are timetoken bounds. Returns
+    (items, reached_end) where items are (entry, timetoken) pairs in
+    chronological order and reached_end is True once the range is exhausted.
+    """
+    pages = []
+    fetched = 0
+    while fetched < limit:
+        count = min(HISTORY_PAGE_SIZE, limit - fetched)
+        page = relay.history(channel, count, start=start, end=end)
+        if not page:
+            return _flatten_pages(pages), True
+        pages.append(page)
+        fetched += len(page)
+        if len(page) < count:
+            return _flatten_pages(pages), True
+        # Each page is chronological; continue from just before its oldest message
+        start = page[0][1]
+    return _flatten_pages(pages), False
+
+
+def _flatten_pages(pages):
+    """Pages were fetched newest-first; stitch them back into chronological order"""
+    return [item for page in reversed(pages) for item in page]
+
+
+def _history_rows(channel: str, items):
+    """Convert (entry, timetoken) history items into database.save_messages rows.
+
+    Duplicates are left to the database's unique timetoken/msg_id indexes:
+    marking backfilled ids as seen here would make _accept drop the live copy
+    of a message that is still on its way to the UI and watchers.
+    """
+    rows = []
+    for entry, timetoken in _reassemble_items(channel, items):
+        if not isinstance(entry, dict):
+            continue
+        epoch = database.timetoken_to_epoch(timetoken)
+        rows.append((
+            channel,
+            entry.get("user", "Unknown"),
+            entry.get("message", ""),
+            datetime.fromtimestamp(epoch).strftime("%H:%M:%S"),
+            str(timetoken),
+            entry.get("msg_id")
+        ))
+    return rows
+
+
+def backfillHistory(channel: str, older: int = 0):
+    """Backfill local SQLite history for a channel from relay history.
+
+    First fills the gap between our high-water mark and now (up to
+    BACKFILL_GAP_LIMIT messages); with no local history at all it fetches
+    the latest BACKFILL_DEFAULT. `older` additionally fetches that many
+    messages from before the oldest one we hold. Returns a status dict whose
+    data is {"fetched", "stored", "gap_closed"}.
+    """
+    try:
+        state = database.get_sync_state(channel)
+        items = []
+        gap_closed = True
+
+        if state["high_water"] is not None:
+            gap_items, gap_closed = _fetch_history_pages(channel, BACKFILL_GAP_LIMIT, end=state["high_water"])
+            items += gap_items
+        elif not older:
+            older = BACKFILL_DEFAULT
+
+        older_items = []
+        if older:
+            older_items, _ = _fetch_history_pages(channel, older, start=state["low_water"])
+
+        all_items = older_items + items
+        stored = database.save_messages(_history_rows(channel, all_items)) if all_items else 0
+        if stored > 0:
+            # Backfilled rows land out of order relative to the hot cache
+            database.invalidate_hot_history(channel)
+
+        timetokens = [int(tt) for _, tt in all_items]
+        if timetokens:
+            # Only claim completeness up to the newest message if the gap was fully closed
+            database.update_sync_state(
+                channel,
+                high_water=max(timetokens) if gap_closed else None,
+                low_water=min(timetokens)
+            )
+        if gap_closed:
+            with _lock:
+                if channel in _channel_callbacks:
+                    _synced_channels.add(channel)
+        else:
+            add_log(f"Backfill for #{channel} stopped after {BACKFILL_GAP_LIMIT} messages; older gap remains", "WARNING", component="backfill", channel=channel)
+
+        add_log(f"Backfilled #{channel}: fetched {len(all_items)}, stored {max(stored, 0)} new", "INFO", component="backfill", channel=channel)
+        return {"success": True, "data": {"fetched": len(all_items), "stored": max(stored, 0), "gap_closed": gap_closed}}
+    except TransportError as e:
+        add_log(f"Backfill failed: {str(e)}", "ERROR", component="backfill", channel=channel)
         return {"success": False, "error": str(e), "code": 0}
     except Exception as e:
-        add_log(f"History unexpected error: {str(e)}", "CRITICAL")
+        add_log(f"Backfill unexpected error: {str(e)}", "CRITICAL", component="backfill", channel=channel)
         return {"success": False, "error": f"Unexpected Error: {str(e)}", "code": -1}
 
+
+def _replay_channel(channel: str):
+    """Page in what was published on a channel after the last message we had
+    before the outage and run it through the receive pipeline.
+
+    Returns (replayed payloads in order, newest timetoken, gap_closed).
+    """
+    with _lock:
+        since = _replay_from.pop(channel, None)
+    if since is None:
+        # Nothing arrived live before the outage; fall back to what's stored
+        database.flush_writer()
+        since = database.get_latest_timetoken(channel)
+    if since is None:
+        return [], None, True # nothing stored yet; join-time backfill covers it
+
+    # `end` is inclusive, so the newest stored message comes back too and is skipped
+    items, gap_closed = _fetch_history_pages(channel, REPLAY_MAX_MESSAGES, end=since)
+    replayed = []
+    newest = None
+    for entry, timetoken in _reassemble_items(channel, items):
+        if int(timetoken) <= int(since):
+            continue
+        epoch = database.timetoken_to_epoch(timetoken)
+        payload = _accept(channel, entry, timetoken, datetime.fromtimestamp(epoch).strftime("%H:%M:%S"))
+        newest = timetoken
+        if payload is not None:
+            replayed.append(dict(payload, replayed=True, timetoken=str(timetoken)))
+    return replayed, newest, gap_closed
+
+
+def replayMissed(channels=None):
+    """Catch up on messages published while we were disconnected.
+
+    Each channel's missed range is stored, deduplicated against anything
+    that already arrived live, and delivered to its UI callback as one batch
+    of payloads marked {"replayed": True}. The busiest channels also get one
+    watcher batch of their newest replayed messages. Returns a status dict
+    whose data maps channel -> number of messages replayed.
+    """
+    with _lock:
+        targets = [c for c in (channels or _channel_callbacks) if c in _channel_callbacks and not isAggregate(c)]
+
+    replayed = {}
+    for channel in targets:
+        if not running:
+            break
+        try:
+            payloads, newest, gap_closed = _replay_channel(channel)
+        except TransportError as e:
+            add_log(f"Replay failed: {str(e)}", "ERROR", component="replay", channel=channel)
+            continue
+
+        if newest is not None and gap_closed:
+            database.update_sync_state(channel, high_water=newest)
+        if gap_closed:
+            with _lock:
+                if channel in _channel_callbacks:
+                    _synced_channels.add(channel)
+        else:
+            add_log(f"Replay for #{channel} stopped at {REPLAY_MAX_MESSAGES} messages; older part of the outage not replayed", "WARNING", component="replay", channel=channel)
+
+        if not payloads:
+            continue
+        # Replayed rows land after anything that arrived live since the
+        # reconnect; reload the hot cache so reads match what SQLite kept
+        database.flush_writer()
+        database.invalidate_hot_history(channel)
+        replayed[channel] = payloads
+        metrics.inc("trc_messages_replayed_total", len(payloads))
+        with _lock:
+            callback = _channel_callbacks.get(channel)
+        if callback:
+            _ui_dispatcher.submit(channel, callback, channel, [payloads, payloads[-1]["timetoken"]])
+
+    # One watcher batch per channel, busiest channels first
+    busiest = sorted(replayed, key=lambda c: len(replayed[c]), reverse=True)[:REPLAY_WATCH_CHANNELS]
+    for channel in busiest:
+        with _lock:
+            watcher_callback = _channel_watchers.get(channel)
+        batch = [
+            {"user": p.get("user", "Unknown"), "message": p.get("message", "")}
+            for p in replayed[channel] if p.get("user") != "SYSTEM"
+        ][-REPLAY_WATCH_LIMIT:]
+        if watcher_callback and batch:
+            _watcher_dispatcher.submit(channel, watcher_callback, channel, batch)
+
+    counts = {channel: len(payloads) for channel, payloads in replayed.items()}
+    if counts:
+        add_log(f"Replayed {sum(counts.values())} missed messages across {len(counts)} channels", "INFO", component="replay")
+    return {"success": True, "data": counts}
+
+
+_replay_lock = threading.Lock() # one catch-up pass at a time
+
+
+def _start_replay():
+    """Run catch-up replay in the background (skipped if one is already running)"""
+    def run():
+        if not _replay_lock.acquire(blocking=False):
+            return
+        try:
+            replayMissed()
+        finally:
+            _replay_lock.release()
+    threading.Thread(target=run, name="trc-replay", daemon=True).start()
+
+
+def _auto_backfill(channels):
+    """Background backfill run when channels are joined"""
+    for channel in channels:
+        if not running:
+            return
+        with _lock:
+            if channel not in _channel_callbacks:
+                continue # left again before we got to it
+        result = backfillHistory(channel)
+        if result["success"] and result["data"]["stored"]:
+            print(f"\n[+] Backfilled {result['data']['stored']} missed messages into #{channel}")
+
 ## Test for the module
 if __name__ == '__main__':
-    import time
     channel = 'chat'
     startStream(channel, callback=lambda ch, m: print(f"{ch}: {m}"))
     while True:
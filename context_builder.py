@@ -0,0 +1,102 @@
+## context_builder.py module
+## renders relay messages into prompt context under a token budget: newest
+## messages first, oversized ones elided, runs of identical lines collapsed
+
+import os
+
+# Rough chars-per-token for English/log text; close enough to budget prompts
+# without shipping a tokenizer
+CHARS_PER_TOKEN = 4
+
+# Token budgets per AI entry point. "pulse" applies to each channel (summary
+# included), "summary" to messages folded into a rolling summary, "tool" to
+# what the read/search history tools hand back to Gemini.
+BUDGETS = {
+    "response": int(os.getenv("TRC_CONTEXT_TOKENS", "4000")),
+    "pulse": int(os.getenv("TRC_PULSE_CONTEXT_TOKENS", "1200")),
+    "summary": 3000,
+    "anomaly": 1500,
+    "tool": 3000,
+}
+
+# A single message never takes more than this; longer ones keep their head
+# and tail (where stack traces put the useful lines) around an elision marker
+MAX_MESSAGE_TOKENS = 400
+
+# Messages fetched to fill a budget. Matches the hot history cache, so the
+# read is served from memory for prewarmed channels.
+FETCH_LIMIT = 200
+
+def estimate_tokens(text: str):
+    """Approximate token count of text"""
+    return -(-len(text) // CHARS_PER_TOKEN) if text else 0
+
+def elide(text: str, max_tokens: int = MAX_MESSAGE_TOKENS):
+    """Shorten text to about max_tokens by cutting out its middle"""
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    head = limit * 2 // 3
+    tail = limit - head
+    return f"{text[:head]} …[{len(text) - limit} chars elided]… {text[-tail:]}"
+
+def format_message(m: dict):
+    """Default context line: [timestamp] user: message"""
+    return f"[{m['timestamp']}] {m['user']}: {m['message']}"
+
+def _collapse(messages):
+    """Group consecutive messages with the same user and text as [newest message, count]"""
+    runs = []
+    for m in messages:
+        if runs and runs[-1][0]["user"] == m["user"] and runs[-1][0]["message"] == m["message"]:
+            runs[-1] = [m, runs[-1][1] + 1]
+        else:
+            runs.append([m, 1])
+    return runs
+
+def build_context(messages, budget: int, formatter=format_message, max_message_tokens: int = MAX_MESSAGE_TOKENS):
+    """Render messages (oldest first) as newline-separated lines within budget tokens.
+
+    The newest messages are kept; when older ones don't fit, a leading line
+    says how many were left out. A run of identical messages becomes one line
+    ending in "(xN identical)" stamped with the run's newest timestamp.
+    """
+    lines = []
+    used = 0
+    omitted = 0
+    runs = _collapse(messages)
+    while runs:
+        m, count = runs.pop()
+        line = formatter(dict(m, message=elide(str(m["message"]), max_message_tokens)))
+        if count > 1:
+            line += f" (x{count} identical)"
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            omitted = count + sum(n for _, n in runs)
+            break
+        lines.append(line)
+        used += cost
+
+    lines.reverse()
+    if omitted:
+        lines.insert(0, f"({omitted} older messages omitted to fit the context budget)")
+    return "\n".join(lines)
+
+def build_window_context(messages, budget: int, formatter=format_message):
+    """Render a Monitor Mode batch within budget tokens.
+
+    Lines carried over from the previous window (flagged context=True) go
+    under their own "already analyzed" header so they aren't alerted on a
+    second time; the new lines follow and get the budget first.
+    """
+    carried = [m for m in messages if m.get("context")]
+    new = build_context([m for m in messages if not m.get("context")], budget, formatter)
+    sections = []
+    remaining = budget - estimate_tokens(new)
+    if carried and remaining > 0:
+        sections.append(
+            "PREVIOUS CONTEXT (already analyzed - do not alert on these lines alone):\n"
+            + build_context(carried, remaining, formatter)
+        )
+    sections.append(f"NEW MESSAGES:\n{new}")
+    return "\n\n".join(sections)
@@ -1,14 +1,166 @@
 import sqlite3
 import os
-from datetime import datetime
+import re
+import csv
+import gzip
+import json
+import queue
+import shutil
+import threading
+import time
+import atexit
+from collections import deque
+from datetime import datetime, timezone
+
+import metrics
 
 DB_NAME = os.getenv("TRC_DB_PATH", "trc_history.db")
 
+# Connection tuning. WAL lets the input loop read while PubNub's SDK threads
+# write, and synchronous=NORMAL is durable across application crashes (only
+# an OS crash / power cut can lose the last few commits).
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 8192
+MMAP_SIZE = 64 * 1024 * 1024
+
+# One persistent connection per thread, reused across calls. Every handle is
+# also tracked in _connections so close_connections() can shut down the ones
+# owned by SDK threads; bumping _generation makes those threads reconnect
+# lazily if they're ever used again.
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+
+# Write-behind persistence: enqueue_message() hands rows to a single writer
+# thread that group-commits them. After the first row arrives it lingers up
+# to WRITE_LINGER seconds for more, then commits up to WRITE_BATCH_SIZE rows
+# in one transaction (one fsync instead of one per message).
+WRITE_BATCH_SIZE = 500
+WRITE_LINGER = 0.05
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_WRITER_STOP = object()
+# flush_writer() waits at most this long for its marker to be committed
+WRITE_FLUSH_TIMEOUT = 10.0
+metrics.gauge_callback("trc_db_write_queue", _write_queue.qsize)
+
+# Hot history cache: the newest HOT_HISTORY_SIZE messages of each prewarmed
+# channel live in memory, fed on ingest, so recent-history reads never touch
+# disk. Entries are {"messages": deque, "timetokens": set, "msg_ids": set,
+# "warm": bool, "complete": bool}; the two sets mirror SQLite's unique keys so
+# a redelivery or republish is never cached twice, and "complete" means the
+# deque holds the channel's whole local history, so any limit can be answered
+# from memory.
+HOT_HISTORY_SIZE = 200
+_hot_history = {}
+_hot_lock = threading.Lock()
+
+# Write-through caches for the small channels/settings tables. Misses are
+# cached too (as None), so asking for an unset topic on every AI call
+# doesn't hit SQLite each time. Only this process writes these tables, so
+# the caches can't go stale except via init_db() switching files.
+_topic_cache = {}      # channel -> topic
+_settings_cache = {}   # key -> value
+_meta_lock = threading.Lock()
+
+# Rows fetched per query by iter_history() / export_history()
+ITER_BATCH_SIZE = 500
+EXPORT_FIELDS = ("id", "channel", "user", "message", "timestamp", "timetoken", "epoch")
+
+# Rows per transaction when a migration backfills an existing table, so a
+# multi-GB history file upgrades in many short write locks instead of one
+MIGRATION_CHUNK_SIZE = 5000
+
+# Search result snippets: hit highlight markers and context window (tokens)
+SNIPPET_MARKS = ("«", "»")
+SNIPPET_TOKENS = 12
+
+# Retention / archival. Expired rows are appended to gzip JSONL segments at
+# <archive dir>/<channel>/<YYYY-MM-DD>.jsonl.gz (UTC day of the message)
+# before being deleted, RETENTION_BATCH_SIZE rows per transaction. The
+# archive dir defaults to "trc_archive" next to the database file.
+ARCHIVE_DIR = os.getenv("TRC_ARCHIVE_DIR")
+RETENTION_BATCH_SIZE = 2000
+DEFAULT_RETENTION_DAYS = os.getenv("TRC_RETENTION_DAYS")
+DEFAULT_RETENTION_ROWS = os.getenv("TRC_RETENTION_ROWS")
+# Pages released per compact_database() call once incremental vacuum is on
+# (None = all free pages)
+VACUUM_PAGES = None
+
+# PubNub timetokens count 100ns ticks since the Unix epoch
+TIMETOKEN_TICKS_PER_SECOND = 10_000_000
+
+def _connect(path):
+    """Open and tune a new connection to the database file"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    # Must precede the switch to WAL, which writes the header of a new file;
+    # on an existing file it's a no-op (see convert_to_incremental_vacuum)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    if path != ":memory:":
+        conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+def get_connection():
+    """Return this thread's connection to DB_NAME, opening it on first use.
+
+    Re-opens if DB_NAME has been changed (tests point it at temp files) or if
+    close_connections() ran since this thread last connected.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.path == DB_NAME and _local.generation == _generation:
+        return conn
+
+    if conn is not None:
+        _discard(conn)
+
+    conn = _connect(DB_NAME)
+    with _connections_lock:
+        _connections.append(conn)
+        _local.generation = _generation
+    _local.conn = conn
+    _local.path = DB_NAME
+    return conn
+
+def _discard(conn):
+    """Close a connection and stop tracking it"""
+    with _connections_lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+def close_connections():
+    """Close every pooled connection (all threads). Safe to call more than once."""
+    global _generation
+    with _connections_lock:
+        conns = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.conn = None
+
+@metrics.timed("trc_db_seconds")
 def init_db():
     """Initialize the SQLite database and create tables if they don't exist"""
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
-    
+
+    # New files get auto_vacuum=INCREMENTAL in _connect(); older databases are
+    # converted by convert_to_incremental_vacuum() (/retention vacuum)
+
     # Create messages table
     # timetoken is UNIQUE to prevent duplicate storage during reconnections
     cursor.execute('''
@@ -40,159 +192,1373 @@ def init_db():
     ''')
     
     conn.commit()
-    conn.close()
+    _run_migrations(conn)
+
+    # Cached state belongs to whichever file was open before
+    with _hot_lock:
+        _hot_history.clear()
+    with _meta_lock:
+        _topic_cache.clear()
+        _settings_cache.clear()
+
+def _column_exists(conn, table, column):
+    """Check whether a table already has a column (for re-runnable ALTERs)"""
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+def _backfill_in_chunks(conn, table, set_clause, where_clause="1"):
+    """Run an UPDATE over `table` in MIGRATION_CHUNK_SIZE id ranges, committing each"""
+    max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    low = 0
+    while low < max_id:
+        high = low + MIGRATION_CHUNK_SIZE
+        with conn:
+            conn.execute(
+                f"UPDATE {table} SET {set_clause} WHERE id > ? AND id <= ? AND ({where_clause})",
+                (low, high),
+            )
+        low = high
 
-def save_message(channel, user, message, timestamp, timetoken):
-    """Save a single message to the database. Returns True if saved, False if duplicate."""
+# Folds (channel, user, first_seen, last_seen, count) rows into the roster.
+# Scalar MIN/MAX return NULL if either side is NULL, hence the COALESCEs.
+_PARTICIPANT_UPSERT = '''
+    INSERT INTO participants (channel, user, first_seen, last_seen, message_count)
+    {source}
+    ON CONFLICT(channel, user) DO UPDATE SET
+        first_seen = COALESCE(MIN(participants.first_seen, excluded.first_seen),
+                              participants.first_seen, excluded.first_seen),
+        last_seen = COALESCE(MAX(participants.last_seen, excluded.last_seen),
+                             participants.last_seen, excluded.last_seen),
+        message_count = participants.message_count + excluded.message_count
+'''
+
+def _migrate_indexes_and_epoch(conn):
+    """v1: real epoch seconds per message plus indexes for per-channel queries"""
+    if not _column_exists(conn, "messages", "epoch"):
+        conn.execute("ALTER TABLE messages ADD COLUMN epoch INTEGER")
+        conn.commit()
+
+    # Only all-digit timetokens are real PubNub ones; anything else stays NULL
+    _backfill_in_chunks(
+        conn, "messages",
+        f"epoch = CAST(timetoken AS INTEGER) / {TIMETOKEN_TICKS_PER_SECOND}",
+        "epoch IS NULL AND timetoken != '' AND timetoken NOT GLOB '*[^0-9]*'",
+    )
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_channel_id ON messages (channel, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_channel_user ON messages (channel, user)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_channel_epoch ON messages (channel, epoch)")
+
+def _migrate_full_text_search(conn):
+    """v2: FTS5 index over message text, kept in sync with triggers"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO messages (channel, user, message, timestamp, timetoken)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (channel, user, message, timestamp, timetoken))
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                message, user, content='messages', content_rowid='id'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5 - search_messages() falls back to LIKE
+        print(f"Full-text search unavailable: {e}")
+        return
+
+    conn.executescript('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message, user) VALUES (new.id, new.message, new.user);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, user)
+            VALUES ('delete', old.id, old.message, old.user);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message, user ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, user)
+            VALUES ('delete', old.id, old.message, old.user);
+            INSERT INTO messages_fts (rowid, message, user) VALUES (new.id, new.message, new.user);
+        END;
+    ''')
+
+    # Index rows that already exist before the triggers take over new ones.
+    # The chunks commit one by one and user_version is only bumped after the
+    # last, so a rerun after an interruption starts again from an empty index
+    # rather than indexing the first chunks twice.
+    with conn:
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    low = 0
+    while low < max_id:
+        high = low + MIGRATION_CHUNK_SIZE
+        with conn:
+            conn.execute('''
+                INSERT INTO messages_fts (rowid, message, user)
+                SELECT id, message, user FROM messages WHERE id > ? AND id <= ?
+            ''', (low, high))
+        low = high
+
+def _migrate_retention_policies(conn):
+    """v3: per-channel retention policies ('*' row = default for every channel)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            channel TEXT PRIMARY KEY,
+            max_age_days INTEGER,
+            max_rows INTEGER
+        )
+    ''')
+
+def _migrate_participants(conn):
+    """v4: incrementally maintained per-channel participant roster"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS participants (
+            channel TEXT NOT NULL,
+            user TEXT NOT NULL,
+            first_seen INTEGER,
+            last_seen INTEGER,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (channel, user)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_participants_channel_seen ON participants (channel, last_seen)")
+
+    # Runs inside the message INSERT's own transaction, so the roster is
+    # updated in the same commit as each batch (and skipped for ignored duplicates)
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_participants_insert
+        AFTER INSERT ON messages WHEN new.user != 'SYSTEM' BEGIN
+            {_PARTICIPANT_UPSERT.format(source="VALUES (new.channel, new.user, new.epoch, new.epoch, 1)")};
+        END
+    ''')
+
+    # Rebuilt from scratch, so a rerun after an interrupted backfill doesn't
+    # count the chunks that had already committed twice
+    with conn:
+        conn.execute("DELETE FROM participants")
+    low = 0
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    while low < max_id:
+        high = low + MIGRATION_CHUNK_SIZE
+        with conn:
+            conn.execute(_PARTICIPANT_UPSERT.format(source='''
+                SELECT channel, user, MIN(epoch), MAX(epoch), COUNT(*) FROM messages
+                WHERE id > ? AND id <= ? AND user != 'SYSTEM'
+                GROUP BY channel, user
+            '''), (low, high))
+        low = high
+
+def _migrate_sync_state(conn):
+    """v5: per-channel remote history high/low-water marks for backfill"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            channel TEXT PRIMARY KEY,
+            high_water TEXT,
+            low_water TEXT,
+            updated_at TEXT
+        )
+    ''')
+
+def _migrate_outbox(conn):
+    """v6: durable queue of messages that couldn't be published yet"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            msg_id TEXT UNIQUE NOT NULL,
+            created_at TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+    ''')
+
+def _migrate_response_cache(conn):
+    """v7: persistent tier of the AI response cache"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ai_cache (
+            key TEXT PRIMARY KEY,
+            call TEXT NOT NULL,
+            response TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_expires ON ai_cache (expires_at)")
+
+def _migrate_channel_summaries(conn):
+    """v8: rolling per-channel AI summaries and how far into history they reach"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS channel_summaries (
+            channel TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_id INTEGER NOT NULL,
+            last_timetoken TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+def _migrate_message_ids(conn):
+    """v9: relay msg_id on messages, so an outbox republish of a message that
+    already got through is a duplicate even across restarts and backfills"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+    if "msg_id" not in columns:
+        conn.execute("ALTER TABLE messages ADD COLUMN msg_id TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_msg_id ON messages (msg_id) WHERE msg_id IS NOT NULL")
+
+# Ordered schema migrations. PRAGMA user_version records how many have been
+# applied, so each one runs exactly once per database file. Append only -
+# never reorder or edit a migration that has shipped.
+_MIGRATIONS = [
+    _migrate_indexes_and_epoch,
+    _migrate_full_text_search,
+    _migrate_retention_policies,
+    _migrate_participants,
+    _migrate_sync_state,
+    _migrate_outbox,
+    _migrate_response_cache,
+    _migrate_channel_summaries,
+    _migrate_message_ids,
+]
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+def _run_migrations(conn):
+    """Apply any migrations newer than the file's PRAGMA user_version"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        _MIGRATIONS[number - 1](conn)
+        conn.execute(f"PRAGMA user_version = {number}")
         conn.commit()
+
+def timetoken_to_epoch(timetoken):
+    """Convert a PubNub timetoken to whole epoch seconds (None if it isn't one)"""
+    try:
+        return int(timetoken) // TIMETOKEN_TICKS_PER_SECOND
+    except (TypeError, ValueError):
+        return None
+
+def _message_epoch(timetoken):
+    """Epoch for a message being stored now: from its timetoken, else the current time"""
+    epoch = timetoken_to_epoch(timetoken)
+    return epoch if epoch is not None else int(time.time())
+
+@metrics.timed("trc_db_seconds")
+def save_message(channel, user, message, timestamp, timetoken, msg_id=None):
+    """Save a single message to the database. Returns True if saved, False if duplicate
+    (same timetoken, or same msg_id when one is given)."""
+    try:
+        conn = get_connection()
+        # `with conn` commits on success and rolls back on error, so a failed
+        # write never leaves the persistent connection mid-transaction
+        with conn:
+            conn.execute('''
+                INSERT INTO messages (channel, user, message, timestamp, timetoken, epoch, msg_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (channel, user, message, timestamp, timetoken, _message_epoch(timetoken), msg_id))
+        _hot_append(channel, user, message, timestamp, timetoken, msg_id)
+        metrics.inc("trc_db_rows_written_total")
         return True
     except sqlite3.IntegrityError:
-        # This happens if timetoken already exists (duplicate prevention)
+        # This happens if timetoken or msg_id already exists (duplicate prevention)
+        metrics.inc("trc_db_duplicates_total")
         return False
     except Exception as e:
         print(f"Database error: {e}")
+        metrics.inc("trc_db_write_errors_total")
         return False
-    finally:
-        conn.close()
 
+@metrics.timed("trc_db_seconds")
+def save_messages(rows):
+    """Bulk-save (channel, user, message, timestamp, timetoken[, msg_id]) rows in one transaction.
+
+    Duplicate timetokens and msg_ids are skipped. Returns the number of rows actually
+    stored, or -1 if the batch failed. Doesn't feed the hot history cache -
+    callers inserting history out of order (backfills) should call
+    invalidate_hot_history() for the affected channels.
+    """
+    try:
+        conn = get_connection()
+        with conn:
+            # rowcount counts only rows this statement inserted (ignored
+            # duplicates and trigger side effects excluded)
+            cursor = conn.executemany('''
+                INSERT OR IGNORE INTO messages (channel, user, message, timestamp, timetoken, epoch, msg_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(*row[:5], _message_epoch(row[4]), row[5] if len(row) > 5 else None) for row in rows])
+            stored = max(cursor.rowcount, 0)
+        metrics.inc("trc_db_rows_written_total", stored)
+        metrics.inc("trc_db_duplicates_total", len(rows) - stored)
+        return stored
+    except Exception as e:
+        print(f"Database batch error: {e}")
+        metrics.inc("trc_db_write_errors_total")
+        return -1
+
+@metrics.timed("trc_db_seconds")
+def enqueue_message(channel, user, message, timestamp, timetoken, msg_id=None):
+    """Hand a message to the background writer.
+
+    Falls back to a synchronous save_message() when the writer isn't running
+    (tests, one-off scripts), so callers never need to care which mode is on.
+    """
+    if _writer_thread is None:
+        return save_message(channel, user, message, timestamp, timetoken, msg_id)
+    # Cache first so reads see the message before the writer commits it;
+    # the single FIFO writer keeps DB id order identical to cache order
+    _hot_append(channel, user, message, timestamp, timetoken, msg_id)
+    _write_queue.put((channel, user, message, timestamp, timetoken, msg_id))
+    return True
+
+def _writer_loop():
+    """Drain the write queue in size/time bounded batches until stopped"""
+    stopping = False
+    while not stopping:
+        item = _write_queue.get()
+        batch = []
+        # flush_writer() markers are set once the rows queued before them are committed
+        flushed = []
+        if item is _WRITER_STOP:
+            stopping = True
+        elif isinstance(item, threading.Event):
+            flushed.append(item)
+        else:
+            batch.append(item)
+            deadline = time.monotonic() + WRITE_LINGER
+            while len(batch) < WRITE_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = _write_queue.get(timeout=remaining) if remaining > 0 else _write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _WRITER_STOP:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    flushed.append(item)
+                    break
+                batch.append(item)
+
+        if batch and save_messages(batch) < 0:
+            # Salvage what we can row by row rather than dropping the whole batch
+            for row in batch:
+                save_message(*row)
+
+        for marker in flushed:
+            marker.set()
+        for _ in range(len(batch) + len(flushed) + (1 if stopping else 0)):
+            _write_queue.task_done()
+
+    _close_thread_connection()
+
+def _close_thread_connection():
+    """Close only the calling thread's pooled connection"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _discard(conn)
+        _local.conn = None
+
+def start_writer():
+    """Start the background write-behind thread (idempotent)"""
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is not None:
+            return
+        _writer_thread = threading.Thread(target=_writer_loop, name="trc-db-writer", daemon=True)
+        _writer_thread.start()
+
+@metrics.timed("trc_db_seconds")
+def flush_writer(timeout=WRITE_FLUSH_TIMEOUT):
+    """Block until every message queued before this call has been committed.
+
+    Messages enqueued after the call don't hold it up, so a busy channel can't
+    stall the caller. Returns False if the writer didn't get there within
+    `timeout` seconds.
+    """
+    if _writer_thread is None:
+        return True
+    marker = threading.Event()
+    _write_queue.put(marker)
+    return marker.wait(timeout)
+
+def stop_writer():
+    """Flush pending messages and stop the writer; later writes become synchronous"""
+    global _writer_thread
+    with _writer_lock:
+        thread = _writer_thread
+        if thread is None:
+            return
+        _write_queue.put(_WRITER_STOP)
+        thread.join()
+        _writer_thread = None
+
+    # Anything enqueued after the stop marker was queued while we were
+    # shutting down - persist it synchronously rather than dropping it
+    leftovers, flushed = [], []
+    while True:
+        try:
+            item = _write_queue.get_nowait()
+        except queue.Empty:
+            break
+        _write_queue.task_done()
+        (flushed if isinstance(item, threading.Event) else leftovers).append(item)
+    if leftovers:
+        save_messages(leftovers)
+    for marker in flushed:
+        marker.set()
+
+def _fts_available(conn):
+    """True if the FTS5 index was created for this database file"""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    ).fetchone() is not None
+
+def _fts_query(query):
+    """Turn free text into a safe FTS5 query: every word must match, `word*` is a prefix search.
+
+    Quoting each term stops relay text like `auth-service:` or `"x" OR` from
+    being parsed as FTS5 operators.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', "")
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return " ".join(terms)
+
+@metrics.timed("trc_db_seconds")
+def _like_escape(text):
+    """Escape LIKE wildcards so `%` and `_` in a search word match literally (ESCAPE '\\')"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def search_messages(query, channel=None, since=None, limit=20):
+    """Full-text search of local history, best matches first.
+
+    Args:
+        query: Words to look for (all must match; `word*` matches prefixes).
+        channel: Restrict to one channel (all channels if None).
+        since: Only messages at or after this epoch second.
+        limit: Maximum number of results.
+
+    Returns a list of dicts with the usual message fields plus `channel`,
+    `id` and `snippet` (the matching fragment with hits wrapped in SNIPPET_MARKS).
+    """
+    fts_query = _fts_query(query or "")
+    if not fts_query:
+        return []
+
+    filters = ""
+    params = []
+    if channel:
+        filters += " AND m.channel = ?"
+        params.append(channel)
+    if since is not None:
+        filters += " AND m.epoch >= ?"
+        params.append(int(since))
+
+    try:
+        conn = get_connection()
+        if _fts_available(conn):
+            open_mark, close_mark = SNIPPET_MARKS
+            rows = conn.execute(f'''
+                SELECT m.id, m.channel, m.user, m.message, m.timestamp, m.timetoken, m.epoch,
+                       snippet(messages_fts, 0, ?, ?, '…', {SNIPPET_TOKENS})
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ?{filters}
+                ORDER BY bm25(messages_fts)
+                LIMIT ?
+            ''', [open_mark, close_mark, fts_query, *params, limit]).fetchall()
+        else:
+            like_filters = "".join(" AND m.message LIKE ? ESCAPE '\\'" for _ in query.split())
+            like_params = [f"%{_like_escape(word.rstrip('*'))}%" for word in query.split()]
+            rows = conn.execute(f'''
+                SELECT m.id, m.channel, m.user, m.message, m.timestamp, m.timetoken, m.epoch, m.message
+                FROM messages m
+                WHERE 1{like_filters}{filters}
+                ORDER BY m.id DESC
+                LIMIT ?
+            ''', [*like_params, *params, limit]).fetchall()
+
+        return [{
+            "id": row[0],
+            "channel": row[1],
+            "user": row[2],
+            "message": row[3],
+            "timestamp": row[4],
+            "timetoken": row[5],
+            "epoch": row[6],
+            "snippet": row[7]
+        } for row in rows]
+    except Exception as e:
+        print(f"Database search error: {e}")
+        return []
+
+def _query_history(channel, limit):
+    """Read the latest `limit` messages for a channel straight from SQLite, oldest first"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT user, message, timestamp, timetoken, epoch, msg_id
+        FROM messages 
+        WHERE channel = ? 
+        ORDER BY id DESC 
+        LIMIT ?
+    ''', (channel, limit))
+    rows = cursor.fetchall()
+    
+    # Convert to list of dicts and reverse so they are in chronological order
+    messages = []
+    for row in rows:
+        messages.append({
+            "user": row[0],
+            "message": row[1],
+            "timestamp": row[2],
+            "timetoken": row[3],
+            "epoch": row[4],
+            "msg_id": row[5]
+        })
+    messages.reverse()
+    return messages
+
+def _hot_append(channel, user, message, timestamp, timetoken, msg_id=None):
+    """Record a newly ingested message in the channel's hot cache (if it has one).
+    Skips it, as the INSERT will, if its timetoken or msg_id is already cached."""
+    with _hot_lock:
+        entry = _hot_history.get(channel)
+        if entry is None or timetoken in entry["timetokens"] or (msg_id and msg_id in entry["msg_ids"]):
+            return
+        messages = entry["messages"]
+        if len(messages) == messages.maxlen:
+            entry["timetokens"].discard(messages[0]["timetoken"])
+            entry["msg_ids"].discard(messages[0]["msg_id"])
+            entry["complete"] = False
+        messages.append({
+            "user": user,
+            "message": message,
+            "timestamp": timestamp,
+            "timetoken": timetoken,
+            "epoch": _message_epoch(timetoken),
+            "msg_id": msg_id
+        })
+        entry["timetokens"].add(timetoken)
+        if msg_id:
+            entry["msg_ids"].add(msg_id)
+
+@metrics.timed("trc_db_seconds")
+def prewarm_history(channel):
+    """Load a channel's newest HOT_HISTORY_SIZE messages into the hot cache.
+
+    The entry is registered before SQLite is read so messages ingested (or
+    still sitting in the write queue) meanwhile are captured and merged in.
+    No-op if the channel is already cached.
+    """
+    with _hot_lock:
+        if channel in _hot_history:
+            return
+        entry = {"messages": deque(maxlen=HOT_HISTORY_SIZE), "timetokens": set(), "msg_ids": set(),
+                 "warm": False, "complete": False}
+        _hot_history[channel] = entry
+
+    try:
+        rows = _query_history(channel, HOT_HISTORY_SIZE)
+    except Exception as e:
+        print(f"Database prewarm error: {e}")
+        evict_hot_history(channel)
+        return
+
+    with _hot_lock:
+        if _hot_history.get(channel) is not entry:
+            return # invalidated while we were reading
+        stored = {m["timetoken"] for m in rows}
+        stored_ids = {m["msg_id"] for m in rows if m["msg_id"]}
+        merged = rows + [
+            m for m in entry["messages"] if m["timetoken"] not in stored and m["msg_id"] not in stored_ids
+        ]
+        entry["messages"].clear()
+        entry["messages"].extend(merged)
+        entry["timetokens"] = {m["timetoken"] for m in entry["messages"]}
+        entry["msg_ids"] = {m["msg_id"] for m in entry["messages"] if m["msg_id"]}
+        entry["complete"] = len(rows) < HOT_HISTORY_SIZE and len(merged) <= HOT_HISTORY_SIZE
+        entry["warm"] = True
+
+def evict_hot_history(channel):
+    """Drop a channel's hot cache entirely (e.g. when we stop following it)"""
+    with _hot_lock:
+        return _hot_history.pop(channel, None) is not None
+
+def invalidate_hot_history(channel):
+    """Rebuild a cached channel from SQLite after its stored history changed underneath"""
+    if evict_hot_history(channel):
+        prewarm_history(channel)
+
+@metrics.timed("trc_db_seconds")
 def get_local_history(channel, limit=50):
-    """Retrieve the latest messages for a channel from the local database"""
+    """Retrieve the latest messages for a channel, from the hot cache when it can answer"""
+    with _hot_lock:
+        entry = _hot_history.get(channel)
+        if entry is not None and entry["warm"] and (limit <= len(entry["messages"]) or entry["complete"]):
+            messages = list(entry["messages"])
+            return [dict(m) for m in messages[max(0, len(messages) - limit):]] if limit > 0 else []
+
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user, message, timestamp, timetoken 
-            FROM messages 
-            WHERE channel = ? 
-            ORDER BY id DESC 
+        return _query_history(channel, limit)
+    except Exception as e:
+        print(f"Database fetch error: {e}")
+        return []
+
+@metrics.timed("trc_db_seconds")
+def iter_history(channel, after_id=None, before_id=None, batch_size=None):
+    """Stream a channel's history oldest-first in constant memory.
+
+    Uses keyset pagination on the (channel, id) index - each batch resumes
+    after the last id seen instead of using OFFSET, so deep pages cost the
+    same as the first. Yields message dicts that also carry `id` and `channel`.
+
+    Args:
+        channel: Channel name.
+        after_id: Only messages with id greater than this.
+        before_id: Only messages with id less than this.
+        batch_size: Rows per query (defaults to ITER_BATCH_SIZE).
+    """
+    batch_size = batch_size or ITER_BATCH_SIZE
+    last_id = after_id if after_id is not None else 0
+    upper = "AND id < ?" if before_id is not None else ""
+
+    while True:
+        params = [channel, last_id] + ([before_id] if before_id is not None else []) + [batch_size]
+        rows = get_connection().execute(f'''
+            SELECT id, user, message, timestamp, timetoken, epoch
+            FROM messages
+            WHERE channel = ? AND id > ? {upper}
+            ORDER BY id
             LIMIT ?
-        ''', (channel, limit))
-        rows = cursor.fetchall()
-        
-        # Convert to list of dicts and reverse so they are in chronological order
-        messages = []
+        ''', params).fetchall()
+
         for row in rows:
-            messages.append({
-                "user": row[0],
-                "message": row[1],
-                "timestamp": row[2],
-                "timetoken": row[3]
-            })
-        messages.reverse()
-        return messages
+            yield {
+                "id": row[0],
+                "channel": channel,
+                "user": row[1],
+                "message": row[2],
+                "timestamp": row[3],
+                "timetoken": row[4],
+                "epoch": row[5]
+            }
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
+
+@metrics.timed("trc_db_seconds")
+def get_history_after(channel, after_id=0, limit=50):
+    """The first `limit` messages of a channel stored after row id `after_id`,
+    oldest first, so callers can page forward from the last id they consumed.
+    Dicts also carry `id` and `timetoken`."""
+    try:
+        flush_writer()
+        rows = get_connection().execute('''
+            SELECT id, user, message, timestamp, timetoken FROM messages
+            WHERE channel = ? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        ''', (channel, after_id or 0, limit)).fetchall()
+        return [{
+            "id": row[0],
+            "user": row[1],
+            "message": row[2],
+            "timestamp": row[3],
+            "timetoken": row[4]
+        } for row in rows]
     except Exception as e:
         print(f"Database fetch error: {e}")
         return []
-    finally:
-        conn.close()
 
+@metrics.timed("trc_db_seconds")
+def export_history(channel, path, fmt="jsonl", compress=False):
+    """Stream a channel's full local history to a JSONL or CSV file.
+
+    Written to `<path>.part` and renamed into place at the end, so a failed
+    export never leaves a truncated file behind. Returns the number of
+    messages written, or -1 on error.
+    """
+    if fmt not in ("jsonl", "csv"):
+        print(f"Export error: unsupported format '{fmt}'")
+        return -1
+
+    tmp_path = f"{path}.part"
+    opener = gzip.open if compress else open
+    count = 0
+    try:
+        flush_writer()
+        with opener(tmp_path, "wt", encoding="utf-8", newline="") as f:
+            writer = None
+            if fmt == "csv":
+                writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+                writer.writeheader()
+            for message in iter_history(channel):
+                if writer:
+                    writer.writerow(message)
+                else:
+                    f.write(json.dumps(message) + "\n")
+                count += 1
+        os.replace(tmp_path, path)
+        return count
+    except Exception as e:
+        print(f"Export error: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return -1
+
+@metrics.timed("trc_db_seconds")
 def clear_channel_history(channel):
-    """Delete all local history for a specific channel"""
+    """Delete all local history (and the participant roster and summary) for a specific channel"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM messages WHERE channel = ?', (channel,))
-        conn.commit()
+        # Commit anything still queued first, or it would land after the wipe
+        flush_writer()
+        conn = get_connection()
+        with conn:
+            conn.execute('DELETE FROM messages WHERE channel = ?', (channel,))
+            conn.execute('DELETE FROM participants WHERE channel = ?', (channel,))
+            conn.execute('DELETE FROM channel_summaries WHERE channel = ?', (channel,))
+        invalidate_hot_history(channel)
         return True
     except Exception as e:
         print(f"Database clear error: {e}")
         return False
+
+@metrics.timed("trc_db_seconds")
+def set_retention_policy(channel, max_age_days=None, max_rows=None):
+    """Set how long a channel's history is kept ('*' sets the default for all channels).
+
+    Either limit may be None (no limit of that kind). Returns True on success.
+    """
+    try:
+        conn = get_connection()
+        with conn:
+            conn.execute('''
+                INSERT INTO retention_policies (channel, max_age_days, max_rows)
+                VALUES (?, ?, ?)
+                ON CONFLICT(channel) DO UPDATE SET
+                    max_age_days=excluded.max_age_days, max_rows=excluded.max_rows
+            ''', (channel, max_age_days, max_rows))
+        return True
+    except Exception as e:
+        print(f"Database retention error: {e}")
+        return False
+
+@metrics.timed("trc_db_seconds")
+def get_retention_policy(channel):
+    """Get the effective retention policy for a channel.
+
+    Falls back from the channel's own row to the '*' default row, then to the
+    TRC_RETENTION_DAYS / TRC_RETENTION_ROWS environment variables. Returns
+    {"max_age_days": ..., "max_rows": ..., "source": ...}; limits are None
+    when history is kept forever.
+    """
+    try:
+        conn = get_connection()
+        for key in (channel, "*"):
+            row = conn.execute(
+                "SELECT max_age_days, max_rows FROM retention_policies WHERE channel = ?", (key,)
+            ).fetchone()
+            if row:
+                return {"max_age_days": row[0], "max_rows": row[1], "source": key}
+    except Exception as e:
+        print(f"Database fetch retention error: {e}")
+
+    return {
+        "max_age_days": int(DEFAULT_RETENTION_DAYS) if DEFAULT_RETENTION_DAYS else None,
+        "max_rows": int(DEFAULT_RETENTION_ROWS) if DEFAULT_RETENTION_ROWS else None,
+        "source": "env",
+    }
+
+def _archive_dir():
+    """Where archived segments live (TRC_ARCHIVE_DIR, else next to the DB file)"""
+    if ARCHIVE_DIR:
+        return ARCHIVE_DIR
+    return os.path.join(os.path.dirname(os.path.abspath(DB_NAME)), "trc_archive")
+
+def _archive_channel_dir(channel):
+    """Per-channel archive folder; the name is sanitized so it can't escape the archive dir"""
+    return os.path.join(_archive_dir(), re.sub(r"[^A-Za-z0-9._-]", "_", channel).lstrip("."))
+
+def _fsync_dir(path):
+    """Make renames inside a directory durable (skipped where directories can't be opened)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
     finally:
-        conn.close()
+        os.close(fd)
+
+def _archive_rows(channel, rows):
+    """Add (id, user, message, timestamp, timetoken, epoch) rows to per-day gzip segments.
+
+    Each segment is rewritten to a temp file, fsynced and renamed into place,
+    so a crash never leaves a torn segment. Rows whose timetoken a segment
+    already holds are skipped, so a batch that was archived but never deleted
+    (the process died in between) isn't archived twice by the next run.
+    """
+    by_day = {}
+    for row in rows:
+        day = datetime.fromtimestamp(row[5], timezone.utc).strftime("%Y-%m-%d") if row[5] is not None else "undated"
+        by_day.setdefault(day, []).append(row)
+
+    folder = _archive_channel_dir(channel)
+    os.makedirs(folder, exist_ok=True)
+    for day, day_rows in by_day.items():
+        path = os.path.join(folder, f"{day}.jsonl.gz")
+        existing = os.path.exists(path)
+        archived = set()
+        if existing:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                archived = {json.loads(line).get("timetoken") for line in f if line.strip()}
+        lines = [json.dumps({
+            "channel": channel,
+            "user": row[1],
+            "message": row[2],
+            "timestamp": row[3],
+            "timetoken": row[4],
+            "epoch": row[5]
+        }) + "\n" for row in day_rows if row[4] not in archived]
+        if not lines:
+            continue
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as out:
+            if existing:
+                with open(path, "rb") as src:
+                    shutil.copyfileobj(src, out)
+            # A new gzip member after the old ones; gzip.open reads them back as one stream
+            out.write(gzip.compress("".join(lines).encode("utf-8")))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, path)
+    _fsync_dir(folder)
+
+@metrics.timed("trc_db_seconds")
+def apply_retention(channel=None, now=None):
+    """Archive and delete history that falls outside the retention policy.
+
+    Runs for one channel, or every channel with local history if None.
+    Each batch is durably archived before it's deleted, in RETENTION_BATCH_SIZE
+    transactions so live writes are never locked out for long; a batch left
+    behind by an interrupted run is deleted without being archived again. Returns
+    {channel: rows_archived} for channels that had anything expire.
+    """
+    now = int(now if now is not None else time.time())
+    archived = {}
+    try:
+        conn = get_connection()
+        channels = [channel] if channel else [
+            row[0] for row in conn.execute("SELECT DISTINCT channel FROM messages")
+        ]
+
+        for ch in channels:
+            policy = get_retention_policy(ch)
+            conditions = []
+            params = []
+            if policy["max_age_days"] is not None:
+                conditions.append("epoch < ?")
+                params.append(now - int(policy["max_age_days"]) * 86400)
+            if policy["max_rows"] is not None:
+                # Everything at or below the id of the first row past the newest max_rows
+                boundary = conn.execute(
+                    "SELECT id FROM messages WHERE channel = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                    (ch, int(policy["max_rows"])),
+                ).fetchone()
+                if boundary:
+                    conditions.append("id <= ?")
+                    params.append(boundary[0])
+            if not conditions:
+                continue
+
+            expired = f"channel = ? AND ({' OR '.join(conditions)})"
+            total = 0
+            while True:
+                rows = conn.execute(
+                    f"SELECT id, user, message, timestamp, timetoken, epoch FROM messages "
+                    f"WHERE {expired} ORDER BY id LIMIT ?",
+                    (ch, *params, RETENTION_BATCH_SIZE),
+                ).fetchall()
+                if not rows:
+                    break
+                _archive_rows(ch, rows)
+                with conn:
+                    conn.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows])
+                total += len(rows)
+
+            if total:
+                archived[ch] = total
+                invalidate_hot_history(ch)
+    except Exception as e:
+        print(f"Database retention error: {e}")
+    return archived
 
+@metrics.timed("trc_db_seconds")
+def search_archive(query, channel=None, since=None, limit=20):
+    """Case-insensitive search of archived segments, newest day first.
+
+    Every word in `query` must appear in the message. Returns message dicts
+    shaped like search_messages() results, flagged with "archived": True.
+    """
+    words = [w.rstrip("*").lower() for w in (query or "").split() if w.rstrip("*")]
+    root = _archive_dir()
+    if not words or not os.path.isdir(root):
+        return []
+
+    folders = [_archive_channel_dir(channel)] if channel else [
+        os.path.join(root, name) for name in sorted(os.listdir(root))
+    ]
+    since_day = datetime.fromtimestamp(since, timezone.utc).strftime("%Y-%m-%d") if since is not None else None
+
+    segments = []
+    for folder in folders:
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                if name.endswith(".jsonl.gz"):
+                    segments.append((name, os.path.join(folder, name)))
+    # Newest day first; "undated" sorts last
+    segments.sort(key=lambda s: (s[0] != "undated.jsonl.gz", s[0]), reverse=True)
+
+    results = []
+    for name, path in segments:
+        if since_day and name[:10] < since_day:
+            continue
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    if since is not None and (record.get("epoch") or 0) < since:
+                        continue
+                    text = record.get("message", "").lower()
+                    if all(w in text for w in words):
+                        record["snippet"] = record.get("message", "")
+                        record["archived"] = True
+                        results.append(record)
+                        if len(results) >= limit:
+                            return results
+        except (OSError, ValueError) as e:
+            print(f"Archive read error ({path}): {e}")
+    return results
+
+@metrics.timed("trc_db_seconds")
+def incremental_vacuum_enabled():
+    """True if the database file is in auto_vacuum=INCREMENTAL mode"""
+    try:
+        return get_connection().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    except Exception as e:
+        print(f"Database pragma error: {e}")
+        return False
+
+@metrics.timed("trc_db_seconds")
+def compact_database(max_pages=VACUUM_PAGES):
+    """Give free pages back to the filesystem after deletes.
+
+    Only ever runs incremental vacuum (short, bounded), so it's safe from the
+    background maintenance thread. Files created before incremental mode
+    need convert_to_incremental_vacuum() first; until then this releases
+    nothing. Returns the number of pages released.
+    """
+    try:
+        if not incremental_vacuum_enabled():
+            return 0
+        conn = get_connection()
+        before = conn.execute("PRAGMA page_count").fetchone()[0]
+        pages = "" if max_pages is None else f"({int(max_pages)})"
+        # incremental_vacuum frees one page per step and execute() only steps
+        # once when there's no result row; executescript runs it to completion
+        conn.executescript(f"PRAGMA incremental_vacuum{pages};")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return before - conn.execute("PRAGMA page_count").fetchone()[0]
+    except Exception as e:
+        print(f"Database compaction error: {e}")
+        return 0
+
+@metrics.timed("trc_db_seconds")
+def convert_to_incremental_vacuum():
+    """Switch an older file to incremental vacuum with one full VACUUM.
+
+    This rewrites the whole database: it holds an exclusive lock for the
+    duration and needs up to the file's size again in free disk space, so
+    only run it on an operator's request during a quiet period. Returns
+    the number of pages released, or -1 on error.
+    """
+    try:
+        flush_writer()
+        conn = get_connection()
+        before = conn.execute("PRAGMA page_count").fetchone()[0]
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return before - conn.execute("PRAGMA page_count").fetchone()[0]
+    except Exception as e:
+        print(f"Database vacuum error: {e}")
+        return -1
+
+@metrics.timed("trc_db_seconds")
+def run_maintenance():
+    """Apply retention to every channel, then compact. Returns (archived, pages_freed)."""
+    archived = apply_retention()
+    purge_cached_responses()
+    freed = compact_database() if archived else 0
+    return archived, freed
+
+@metrics.timed("trc_db_seconds")
+def get_sync_state(channel):
+    """Get a channel's backfill watermarks as {"high_water", "low_water"} timetoken strings.
+
+    high_water is the newest remote timetoken up to which local history is
+    known to be complete; low_water the oldest we've fetched. Channels
+    never backfilled fall back to the newest/oldest real timetokens already
+    stored (None if there are none).
+    """
+    try:
+        conn = get_connection()
+        row = conn.execute(
+            "SELECT high_water, low_water FROM sync_state WHERE channel = ?", (channel,)
+        ).fetchone()
+        if row:
+            return {"high_water": row[0], "low_water": row[1]}
+
+        row = conn.execute('''
+            SELECT MAX(CAST(timetoken AS INTEGER)), MIN(CAST(timetoken AS INTEGER)) FROM messages
+            WHERE channel = ? AND timetoken != '' AND timetoken NOT GLOB '*[^0-9]*'
+        ''', (channel,)).fetchone()
+        return {
+            "high_water": str(row[0]) if row[0] is not None else None,
+            "low_water": str(row[1]) if row[1] is not None else None
+        }
+    except Exception as e:
+        print(f"Database fetch sync state error: {e}")
+        return {"high_water": None, "low_water": None}
+
+@metrics.timed("trc_db_seconds")
+def get_latest_timetoken(channel):
+    """Return the newest real relay timetoken stored for a channel (string), or None"""
+    try:
+        conn = get_connection()
+        row = conn.execute('''
+            SELECT MAX(CAST(timetoken AS INTEGER)) FROM messages
+            WHERE channel = ? AND timetoken != '' AND timetoken NOT GLOB '*[^0-9]*'
+        ''', (channel,)).fetchone()
+        return str(row[0]) if row[0] is not None else None
+    except Exception as e:
+        print(f"Database fetch latest timetoken error: {e}")
+        return None
+
+@metrics.timed("trc_db_seconds")
+def update_sync_state(channel, high_water=None, low_water=None):
+    """Advance a channel's watermarks; they only ever move outward (newer high, older low)"""
+    try:
+        current = get_sync_state(channel)
+        high = current["high_water"]
+        low = current["low_water"]
+        if high_water is not None and (high is None or int(high_water) > int(high)):
+            high = str(high_water)
+        if low_water is not None and (low is None or int(low_water) < int(low)):
+            low = str(low_water)
+
+        conn = get_connection()
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with conn:
+            conn.execute('''
+                INSERT INTO sync_state (channel, high_water, low_water, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(channel) DO UPDATE SET
+                    high_water=excluded.high_water, low_water=excluded.low_water,
+                    updated_at=excluded.updated_at
+            ''', (channel, high, low, now))
+        return True
+    except Exception as e:
+        print(f"Database sync state error: {e}")
+        return False
+
+@metrics.timed("trc_db_seconds")
+def add_to_outbox(channel, payload, msg_id, error=None):
+    """Queue an unpublished message. Re-adding the same msg_id is a no-op. Returns True if stored."""
+    try:
+        conn = get_connection()
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with conn:
+            conn.execute('''
+                INSERT OR IGNORE INTO outbox (channel, payload, msg_id, created_at, last_error)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (channel, json.dumps(payload), msg_id, now, error))
+        return True
+    except Exception as e:
+        print(f"Database outbox error: {e}")
+        return False
+
+@metrics.timed("trc_db_seconds")
+def get_outbox(limit=None):
+    """Pending outbox entries, oldest first, as dicts (payload decoded)"""
+    try:
+        conn = get_connection()
+        rows = conn.execute('''
+            SELECT id, channel, payload, msg_id, created_at, attempts, last_error
+            FROM outbox ORDER BY id LIMIT ?
+        ''', (-1 if limit is None else limit,)).fetchall()
+        return [{
+            "id": row[0],
+            "channel": row[1],
+            "payload": json.loads(row[2]),
+            "msg_id": row[3],
+            "created_at": row[4],
+            "attempts": row[5],
+            "last_error": row[6]
+        } for row in rows]
+    except Exception as e:
+        print(f"Database fetch outbox error: {e}")
+        return []
+
+@metrics.timed("trc_db_seconds")
+def count_outbox():
+    """Number of messages waiting in the outbox"""
+    try:
+        return get_connection().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    except Exception as e:
+        print(f"Database fetch outbox error: {e}")
+        return 0
+
+@metrics.timed("trc_db_seconds")
+def remove_from_outbox(entry_ids):
+    """Delete outbox entries (after they've been published)"""
+    try:
+        conn = get_connection()
+        with conn:
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in entry_ids])
+        return True
+    except Exception as e:
+        print(f"Database outbox error: {e}")
+        return False
+
+@metrics.timed("trc_db_seconds")
+def record_outbox_attempt(entry_id, error):
+    """Note a failed flush attempt on an outbox entry"""
+    try:
+        conn = get_connection()
+        with conn:
+            conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (error, entry_id),
+            )
+        return True
+    except Exception as e:
+        print(f"Database outbox error: {e}")
+        return False
+
+@metrics.timed("trc_db_seconds")
 def set_channel_topic(channel, topic):
-    """Set the topic for a channel"""
+    """Set the topic for a channel (written through to the topic cache)"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+        conn = get_connection()
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute('''
-            INSERT INTO channels (name, topic, updated_at) 
-            VALUES (?, ?, ?)
-            ON CONFLICT(name) DO UPDATE SET topic=excluded.topic, updated_at=excluded.updated_at
-        ''', (channel, topic, now))
-        conn.commit()
+        with conn:
+            conn.execute('''
+                INSERT INTO channels (name, topic, updated_at) 
+                VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET topic=excluded.topic, updated_at=excluded.updated_at
+            ''', (channel, topic, now))
+        with _meta_lock:
+            _topic_cache[channel] = topic
         return True
     except Exception as e:
         print(f"Database topic error: {e}")
         return False
-    finally:
-        conn.close()
 
+@metrics.timed("trc_db_seconds")
 def get_channel_topic(channel):
     """Get the current topic for a channel"""
+    with _meta_lock:
+        if channel in _topic_cache:
+            return _topic_cache[channel]
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT topic FROM channels WHERE name = ?', (channel,))
         row = cursor.fetchone()
-        return row[0] if row else None
+        topic = row[0] if row else None
+        with _meta_lock:
+            # setdefault: don't clobber a topic written while we were reading
+            return _topic_cache.setdefault(channel, topic)
     except Exception as e:
         print(f"Database fetch topic error: {e}")
         return None
-    finally:
-        conn.close()
 
+@metrics.timed("trc_db_seconds")
 def update_setting(key, value):
-    """Update a local setting (e.g., 'nick')"""
+    """Update a local setting (e.g., 'nick'), written through to the settings cache"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO settings (key, value) 
-            VALUES (?, ?)
-            ON CONFLICT(key) DO UPDATE SET value=excluded.value
-        ''', (key, str(value)))
-        conn.commit()
+        conn = get_connection()
+        with conn:
+            conn.execute('''
+                INSERT INTO settings (key, value) 
+                VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value=excluded.value
+            ''', (key, str(value)))
+        with _meta_lock:
+            _settings_cache[key] = str(value)
         return True
     except Exception as e:
         print(f"Database setting error: {e}")
         return False
-    finally:
-        conn.close()
 
+@metrics.timed("trc_db_seconds")
 def get_setting(key, default=None):
     """Get a local setting"""
+    with _meta_lock:
+        if key in _settings_cache:
+            value = _settings_cache[key]
+            return value if value is not None else default
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
         row = cursor.fetchone()
-        return row[0] if row else default
+        with _meta_lock:
+            value = _settings_cache.setdefault(key, row[0] if row else None)
+        return value if value is not None else default
     except Exception as e:
         print(f"Database fetch setting error: {e}")
         return default
-    finally:
-        conn.close()
 
-def get_known_users(channel):
-    """Get every user who has ever posted in a channel's local history.
+@metrics.timed("trc_db_seconds")
+def get_participants(channel, active_within=None):
+    """Get the participant roster for a channel, most recently active first.
+
+    Maintained on every ingest, so this is an indexed lookup rather than a
+    scan of history. The roster is all-time: retention archiving doesn't
+    remove people, only /wipe does.
 
-    Not a recency filter - the 'timestamp' column is HH:MM:SS with no date,
-    so "active in the last N minutes" isn't answerable without a schema
-    change. This returns all-time known participants instead.
+    Args:
+        channel: Channel name.
+        active_within: Only users seen in the last N seconds (None = everyone).
+
+    Returns a list of {"user", "first_seen", "last_seen", "message_count"}
+    dicts (seen times are epoch seconds, None for undated legacy rows).
     """
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT DISTINCT user FROM messages 
-            WHERE channel = ? AND user != 'SYSTEM'
-        ''', (channel,))
-        rows = cursor.fetchall()
-        return [row[0] for row in rows]
-    except Exception as e:
-        print(f"Database active users error: {e}")
+        conn = get_connection()
+        query = '''
+            SELECT user, first_seen, last_seen, message_count FROM participants
+            WHERE channel = ?
+        '''
+        params = [channel]
+        if active_within is not None:
+            query += " AND last_seen >= ?"
+            params.append(int(time.time()) - int(active_within))
+        query += " ORDER BY last_seen IS NULL, last_seen DESC, user"
+
+        return [{
+            "user": row[0],
+            "first_seen": row[1],
+            "last_seen": row[2],
+            "message_count": row[3]
+        } for row in conn.execute(query, params)]
+    except Exception as e:
+        print(f"Database participants error: {e}")
         return []
-    finally:
-        conn.close()
+
+@metrics.timed("trc_db_seconds")
+def get_known_users(channel, active_within=None):
+    """Get the names of users who have posted in a channel, most recently active first.
+
+    `active_within` (seconds) limits this to users seen recently; by default
+    it returns all-time known participants. See get_participants().
+    """
+    return [p["user"] for p in get_participants(channel, active_within)]
+
+@metrics.timed("trc_db_seconds")
+def get_cached_response(key, now=None):
+    """A stored AI response as (response, expires_at), or None if missing or expired"""
+    try:
+        conn = get_connection()
+        row = conn.execute(
+            "SELECT response, expires_at FROM ai_cache WHERE key = ? AND expires_at > ?",
+            (key, time.time() if now is None else now)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+    except Exception as e:
+        print(f"Database cache error: {e}")
+        return None
+
+@metrics.timed("trc_db_seconds")
+def put_cached_response(key, call, response, expires_at):
+    """Store (or replace) an AI response until expires_at (epoch seconds). Returns True if stored."""
+    try:
+        conn = get_connection()
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO ai_cache (key, call, response, expires_at)
+                VALUES (?, ?, ?, ?)
+            ''', (key, call, response, expires_at))
+        return True
+    except Exception as e:
+        print(f"Database cache error: {e}")
+        return False
+
+@metrics.timed("trc_db_seconds")
+def purge_cached_responses(now=None, everything=False):
+    """Delete expired AI responses (all of them with everything=True). Returns the number removed."""
+    try:
+        conn = get_connection()
+        with conn:
+            if everything:
+                cursor = conn.execute("DELETE FROM ai_cache")
+            else:
+                cursor = conn.execute("DELETE FROM ai_cache WHERE expires_at <= ?", (time.time() if now is None else now,))
+        return cursor.rowcount
+    except Exception as e:
+        print(f"Database cache error: {e}")
+        return 0
+
+@metrics.timed("trc_db_seconds")
+def get_channel_summary(channel):
+    """A channel's rolling summary as a dict (summary, last_id, last_timetoken,
+    message_count, updated_at), or None if it has never been summarized"""
+    try:
+        row = get_connection().execute('''
+            SELECT summary, last_id, last_timetoken, message_count, updated_at
+            FROM channel_summaries WHERE channel = ?
+        ''', (channel,)).fetchone()
+        if not row:
+            return None
+        return {
+            "summary": row[0],
+            "last_id": row[1],
+            "last_timetoken": row[2],
+            "message_count": row[3],
+            "updated_at": row[4]
+        }
+    except Exception as e:
+        print(f"Database summary error: {e}")
+        return None
+
+@metrics.timed("trc_db_seconds")
+def save_channel_summary(channel, summary, last_id, last_timetoken=None, folded=0):
+    """Replace a channel's rolling summary, now covering history up to row id
+    last_id; `folded` new messages are added to its message count. Returns True if saved."""
+    try:
+        conn = get_connection()
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with conn:
+            conn.execute('''
+                INSERT INTO channel_summaries (channel, summary, last_id, last_timetoken, message_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(channel) DO UPDATE SET
+                    summary = excluded.summary,
+                    last_id = excluded.last_id,
+                    last_timetoken = excluded.last_timetoken,
+                    message_count = channel_summaries.message_count + excluded.message_count,
+                    updated_at = excluded.updated_at
+            ''', (channel, summary, last_id, last_timetoken, folded, now))
+        return True
+    except Exception as e:
+        print(f"Database summary error: {e}")
+        return False
 
 # Initialize on import
 init_db()
+
+# The writer is a daemon thread and would be killed at exit, so make sure
+# queued rows hit disk first
+atexit.register(stop_writer)
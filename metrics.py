@@ -0,0 +1,269 @@
+## metrics.py module
+## in-process counters, gauges and latency histograms for TRC, shown by /stats
+## and optionally exported in Prometheus text format (file and/or localhost HTTP)
+
+import os
+import time
+import inspect
+import functools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Exporters are off unless configured. The HTTP endpoint only ever binds to
+# localhost; the file is rewritten atomically every METRICS_FILE_INTERVAL
+# seconds for node_exporter's textfile collector.
+METRICS_PORT = os.getenv("TRC_METRICS_PORT")
+METRICS_FILE = os.getenv("TRC_METRICS_FILE")
+METRICS_FILE_INTERVAL = 15.0
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Series are keyed by (name, sorted label items)
+_counters = {}         # key -> float
+_gauges = {}           # key -> float
+_gauge_callbacks = {}  # key -> fn() evaluated at snapshot/scrape time
+_histograms = {}       # key -> {"buckets": [int], "sum": float, "count": int}
+_help = {}             # name -> help text
+_lock = threading.Lock()
+
+def _key(name: str, labels: dict):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def describe(name: str, text: str):
+    """Attach a HELP line to a metric family"""
+    _help[name] = text
+
+def inc(name: str, value: float = 1, **labels):
+    """Increment a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name: str, value: float, **labels):
+    """Set a gauge to an absolute value"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def gauge_callback(name: str, fn, **labels):
+    """Register a gauge whose value is read from fn() whenever metrics are collected"""
+    with _lock:
+        _gauge_callbacks[_key(name, labels)] = fn
+
+def observe(name: str, seconds: float, **labels):
+    """Record one latency sample in a histogram"""
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+                break
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+class timer:
+    """Context manager recording the elapsed time of its block in a histogram"""
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+def timed(name: str, **labels):
+    """Decorator: time every call into histogram `name` labelled op=<function name>,
+    and count calls that raise in `<name>_errors_total`. Generator functions are
+    timed until exhausted."""
+    errors = name[:-len("_seconds")] if name.endswith("_seconds") else name
+    errors += "_errors_total"
+
+    def decorate(fn):
+        series = dict(labels, op=fn.__name__)
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def gen_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    yield from fn(*args, **kwargs)
+                except Exception:
+                    inc(errors, **series)
+                    raise
+                finally:
+                    observe(name, time.perf_counter() - start, **series)
+            return gen_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                inc(errors, **series)
+                raise
+            finally:
+                observe(name, time.perf_counter() - start, **series)
+        return wrapper
+
+    return decorate
+
+def _quantile(hist: dict, q: float):
+    """Estimate a quantile from bucket counts (upper bound of the bucket it falls in)"""
+    if not hist["count"]:
+        return None
+    rank = q * hist["count"]
+    seen = 0
+    for bound, n in zip(LATENCY_BUCKETS, hist["buckets"]):
+        seen += n
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+def _read_callbacks():
+    with _lock:
+        callbacks = list(_gauge_callbacks.items())
+    values = {}
+    for key, fn in callbacks:
+        try:
+            values[key] = float(fn())
+        except Exception:
+            continue # A failing probe (e.g. DB closed at shutdown) just skips a sample
+    return values
+
+def snapshot():
+    """Return a point-in-time copy of every series for display:
+    {"counters": {key: v}, "gauges": {key: v}, "histograms": {key: {...}}}"""
+    gauges = _read_callbacks()
+    with _lock:
+        counters = dict(_counters)
+        gauges.update(_gauges)
+        histograms = {
+            key: {
+                "count": h["count"],
+                "sum": h["sum"],
+                "avg": h["sum"] / h["count"] if h["count"] else 0.0,
+                "p50": _quantile(h, 0.5),
+                "p95": _quantile(h, 0.95),
+                "p99": _quantile(h, 0.99),
+            }
+            for key, h in _histograms.items()
+        }
+    return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+def format_key(key):
+    """Render a series key as name{label="value",...}"""
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _family_header(lines, name, kind, emitted):
+    if name in emitted:
+        return
+    emitted.add(name)
+    if name in _help:
+        lines.append(f"# HELP {name} {_help[name]}")
+    lines.append(f"# TYPE {name} {kind}")
+
+def render_prometheus():
+    """Render all series in the Prometheus text exposition format"""
+    gauges = _read_callbacks()
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges.update(_gauges)
+        histograms = sorted((k, dict(h, buckets=list(h["buckets"]))) for k, h in _histograms.items())
+    gauges = sorted(gauges.items())
+
+    lines = []
+    emitted = set()
+    for key, value in counters:
+        _family_header(lines, key[0], "counter", emitted)
+        lines.append(f"{format_key(key)} {value}")
+    for key, value in gauges:
+        _family_header(lines, key[0], "gauge", emitted)
+        lines.append(f"{format_key(key)} {value}")
+    for (name, labels), hist in histograms:
+        _family_header(lines, name, "histogram", emitted)
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, hist["buckets"]):
+            cumulative += n
+            lines.append(f"{format_key((name + '_bucket', labels + (('le', str(bound)),)))} {cumulative}")
+        lines.append(f"{format_key((name + '_bucket', labels + (('le', '+Inf'),)))} {hist['count']}")
+        lines.append(f"{format_key((name + '_sum', labels))} {hist['sum']}")
+        lines.append(f"{format_key((name + '_count', labels))} {hist['count']}")
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path: str):
+    """Atomically write the Prometheus text output to path. Returns a status dict."""
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(render_prometheus())
+        os.replace(tmp, path)
+        return {"success": True}
+    except OSError as e:
+        return {"success": False, "error": str(e)}
+
+def reset():
+    """Drop every recorded series (gauge callbacks and help text are kept)"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep scrapes out of the chat terminal
+
+def start_http_exporter(port: int, host: str = "127.0.0.1"):
+    """Serve /metrics on host:port from a daemon thread. Returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="trc-metrics-http", daemon=True).start()
+    return server
+
+def start_file_exporter(path: str, interval: float = None):
+    """Rewrite the Prometheus text file at path every interval seconds (daemon thread)"""
+    interval = interval or METRICS_FILE_INTERVAL
+
+    def loop():
+        while True:
+            write_prometheus(path)
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name="trc-metrics-file", daemon=True).start()
+
+def start_exporters():
+    """Start whichever exporters TRC_METRICS_PORT / TRC_METRICS_FILE enable.
+    Returns a list of human-readable descriptions of what was started."""
+    started = []
+    if METRICS_PORT:
+        start_http_exporter(int(METRICS_PORT))
+        started.append(f"http://127.0.0.1:{METRICS_PORT}/metrics")
+    if METRICS_FILE:
+        start_file_exporter(METRICS_FILE)
+        started.append(METRICS_FILE)
+    return started
@@ -0,0 +1,115 @@
+## response_cache.py module
+## LRU/TTL cache of Gemini answers, so teammates asking the same question over
+## the same history within a minute don't each pay for a generate_content call
+
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import database
+import metrics
+
+# In-memory entries kept (least recently used evicted first)
+CACHE_SIZE = int(os.getenv("TRC_AI_CACHE_SIZE", "256"))
+
+# Also keep answers in the local SQLite file so they survive a restart
+CACHE_PERSIST = os.getenv("TRC_AI_CACHE_PERSIST", "0").lower() in ("1", "true", "yes", "on")
+
+# Seconds an answer stays valid, per call type. Chat answers go stale as the
+# channel moves on; an image doesn't change. Call types missing here (anomaly
+# scans) are never cached.
+TTL = {
+    "response": 60.0,
+    "pulse": 120.0,
+    "pulse_channel": 120.0,
+    "vision": 3600.0,
+}
+
+metrics.describe("trc_ai_cache_total", "AI response cache lookups by call and result (hit, miss, bypass)")
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_prompt(prompt: str):
+    """Collapse whitespace and case so trivially different phrasings share an entry"""
+    return _WHITESPACE.sub(" ", prompt or "").strip().casefold()
+
+def make_key(call: str, model: str, system_instruction: str, prompt: str, context=None, blob: bytes = None):
+    """Cache key for one request: the model and system instruction, the normalized
+    prompt, and the exact context text and/or attachment bytes it was asked over"""
+    digest = hashlib.sha256()
+    for part in (call, model, system_instruction, normalize_prompt(prompt), context or ""):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    if blob is not None:
+        digest.update(hashlib.sha256(blob).digest())
+    return digest.hexdigest()
+
+class ResponseCache:
+    """In-memory LRU of answers with per-call TTLs, optionally backed by SQLite"""
+
+    def __init__(self, max_entries: int = CACHE_SIZE, persist: bool = CACHE_PERSIST, ttl: dict = None):
+        self.max_entries = max_entries
+        self.persist = persist
+        self.ttl = dict(TTL if ttl is None else ttl)
+        self._entries = OrderedDict()  # key -> (expires_at, response)
+        self._lock = threading.Lock()
+
+    def cacheable(self, call: str):
+        return self.ttl.get(call, 0) > 0 and self.max_entries > 0
+
+    def get(self, key: str, call: str):
+        """The cached answer for key, or None. Counts a hit or miss for call."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                metrics.inc("trc_ai_cache_total", call=call, result="hit")
+                return entry[1]
+            if entry:
+                del self._entries[key]
+
+        if self.persist:
+            stored = database.get_cached_response(key, now)
+            if stored:
+                response, expires_at = stored
+                self._remember(key, response, expires_at)
+                metrics.inc("trc_ai_cache_total", call=call, result="hit")
+                return response
+
+        metrics.inc("trc_ai_cache_total", call=call, result="miss")
+        return None
+
+    def put(self, key: str, call: str, response: str):
+        """Cache a successful answer for call's TTL (no-op for uncached call types)"""
+        if not response or not self.cacheable(call):
+            return
+        expires_at = time.time() + self.ttl[call]
+        self._remember(key, response, expires_at)
+        if self.persist:
+            database.put_cached_response(key, call, response, expires_at)
+
+    def bypass(self, call: str):
+        """Record a lookup skipped because a fresh answer was requested"""
+        metrics.inc("trc_ai_cache_total", call=call, result="bypass")
+
+    def _remember(self, key, response, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forget every cached answer, in memory and (if persisted) on disk"""
+        with self._lock:
+            self._entries.clear()
+        if self.persist:
+            database.purge_cached_responses(everything=True)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
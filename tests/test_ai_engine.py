@@ -0,0 +1,202 @@
+import importlib
+import re
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+# The engine needs the Gemini SDK installed; only its client is stubbed here
+pytest.importorskip("google.genai")
+pytest.importorskip("dotenv")
+
+import database
+import response_cache
+
+
+class _FakeModels:
+    """Stands in for client.models: `respond(contents)` returns the answer text
+    (or raises); streams yield `chunks` one at a time"""
+
+    def __init__(self, respond=None, chunks=()):
+        self.respond = respond
+        self.chunks = list(chunks)
+        self.requests = []
+        self.streams = 0
+
+    def generate_content(self, **request):
+        self.requests.append(request)
+        return SimpleNamespace(text=self.respond(request["contents"]))
+
+    def generate_content_stream(self, **request):
+        self.streams += 1
+        return iter([SimpleNamespace(text=chunk) for chunk in self.chunks])
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """A TRCAIEngine on a fresh temp database and an in-process relay, with a
+    fake Gemini client (set engine.client.models.respond / .chunks per test)"""
+    monkeypatch.setenv("TRC_TRANSPORT", "local")
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "test_trc_history.db"))
+    database.init_db()
+    ai_engine = importlib.import_module("ai_engine")
+    database.stop_writer()
+
+    monkeypatch.setattr(ai_engine, "API_KEY", None)
+    engine = ai_engine.TRCAIEngine(model_name="gemini-test")
+    engine.cache = response_cache.ResponseCache(persist=False)
+    engine.client = SimpleNamespace(models=_FakeModels())
+    yield ai_engine, engine
+    engine.pulse_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def test_only_complete_streams_are_cached(engine):
+    _, engine = engine
+    models = engine.client.models
+    models.chunks = ["Disk ", "is ", "full."]
+
+    # Cancelled after the first chunk: nothing is cached
+    stream = engine.stream_response("what broke?", "ops")
+    assert next(stream) == "Disk "
+    stream.close()
+    assert len(engine.cache) == 0
+
+    assert list(engine.stream_response("what broke?", "ops")) == ["Disk ", "is ", "full."]
+    # The repeat question is answered from the cache in one chunk
+    assert list(engine.stream_response("what broke?", "ops")) == ["Disk is full."]
+    assert models.streams == 2
+
+
+def _post(channel, *messages):
+    for i, text in enumerate(messages):
+        database.save_message(channel, "alice", text, "10:00:00", f"{channel}-{i}")
+
+
+def test_pulse_reports_failed_and_slow_channels_as_unavailable(engine, monkeypatch):
+    ai_engine, engine = engine
+    monkeypatch.setattr(ai_engine, "PULSE_CHANNEL_TIMEOUT", 0.2)
+    release = threading.Event()
+
+    def respond(contents):
+        if contents.startswith("Merge"):
+            return "REPORT\n" + contents
+        if "#broken" in contents:
+            raise RuntimeError("quota exceeded")
+        if "#slow" in contents:
+            release.wait(5)
+        return "db failover finished"
+
+    engine.client.models.respond = respond
+    for channel in ("ops", "broken", "slow"):
+        _post(channel, "failing over the primary db")
+    try:
+        report = engine.get_pulse(["ops", "broken", "slow"])
+    finally:
+        release.set()
+
+    assert report.startswith("REPORT")
+    assert "--- Channel: #ops ---\ndb failover finished" in report
+    assert "--- Channel: #broken ---\n(analysis unavailable: quota exceeded)" in report
+    assert "--- Channel: #slow ---\n(analysis unavailable: timed out)" in report
+
+
+def test_pulse_keeps_findings_when_the_reduce_call_fails(engine):
+    _, engine = engine
+
+    def respond(contents):
+        if contents.startswith("Merge"):
+            raise RuntimeError("503 unavailable")
+        return "error rate back to normal"
+
+    engine.client.models.respond = respond
+    _post("ops", "rolled back the deploy")
+
+    report = engine.get_pulse(["ops"])
+
+    assert report.startswith("❌ Pulse Generation Error: 503 unavailable")
+    assert "--- Channel: #ops ---\nerror rate back to normal" in report
+
+
+def test_summary_backlog_is_folded_oldest_page_first(engine, monkeypatch):
+    ai_engine, engine = engine
+    monkeypatch.setattr(ai_engine, "SUMMARY_FOLD_AT", 20)
+    monkeypatch.setattr(ai_engine, "SUMMARY_RAW_TAIL", 10)
+    monkeypatch.setattr(ai_engine, "SUMMARY_MAX_FOLD", 30)
+    folded = []
+
+    def respond(contents):
+        new = contents.split("NEW MESSAGES:", 1)[1]
+        folded.append([int(n) for n in re.findall(r"line (\d+)", new)])
+        return f"summary after {len(folded)} folds"
+
+    engine.client.models.respond = respond
+    _post("ops", *[f"line {i}" for i in range(70)])
+
+    summary, delta = engine.summarize_channel("ops")
+
+    # Every pending row was folded once, in order, and the newest stay raw
+    assert folded == [list(range(0, 20)), list(range(20, 40)), list(range(40, 60))]
+    assert summary == "summary after 3 folds"
+    assert [m["message"] for m in delta] == [f"line {i}" for i in range(60, 70)]
+    assert database.get_channel_summary("ops")["message_count"] == 60
+
+
+def test_pulse_never_folds_and_reads_the_stored_summary(engine, monkeypatch):
+    ai_engine, engine = engine
+    monkeypatch.setattr(ai_engine, "SUMMARY_FOLD_AT", 20)
+    monkeypatch.setattr(ai_engine, "SUMMARY_RAW_TAIL", 10)
+    calls = []
+
+    def respond(contents):
+        calls.append(contents)
+        if contents.startswith("Merge"):
+            return "REPORT"
+        if "NEW MESSAGES:" in contents:
+            return "deploy was rolled back"
+        return "quiet since the rollback"
+
+    engine.client.models.respond = respond
+    _post("ops", *[f"line {i}" for i in range(40)])
+
+    # A backlog doesn't cost the pulse extra calls: one per channel plus the merge
+    engine.get_pulse(["ops"])
+    assert len(calls) == 2 and database.get_channel_summary("ops") is None
+
+    assert engine.refresh_summaries(["ops"]) == 1
+    calls.clear()
+    engine.get_pulse(["ops"], fresh=True)
+    assert len(calls) == 2
+    assert "Summary of earlier discussion:\ndeploy was rolled back" in calls[0]
+    assert "line 39" in calls[0] and "line 5\n" not in calls[0]
+
+
+def test_pulse_deadline_counts_workers_held_by_abandoned_calls(engine, monkeypatch):
+    ai_engine, engine = engine
+    monkeypatch.setattr(ai_engine, "PULSE_CHANNEL_TIMEOUT", 0.2)
+    release = threading.Event()
+
+    def respond(contents):
+        if contents.startswith("Merge"):
+            return "REPORT\n" + contents
+        if "#stuck" in contents:
+            release.wait(5)
+        return "all green"
+
+    engine.client.models.respond = respond
+    stuck = [f"stuck{i}" for i in range(ai_engine.PULSE_WORKERS)]
+    for channel in stuck + ["ops"]:
+        _post(channel, "checking the pager")
+
+    try:
+        # Every worker is left running a call this pulse gave up on
+        assert engine.get_pulse(stuck).count("(analysis unavailable: timed out)") == len(stuck)
+
+        # The next pulse allows a wave for the busy workers: they are only
+        # freed after one timeout, yet #ops still gets analysed
+        monkeypatch.setattr(ai_engine, "PULSE_CHANNEL_TIMEOUT", 1.0)
+        threading.Timer(1.4, release.set).start()
+        report = engine.get_pulse(["ops"])
+    finally:
+        release.set()
+
+    assert "--- Channel: #ops ---\nall green" in report
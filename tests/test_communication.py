@@ -0,0 +1,522 @@
+import collections
+import importlib
+import json
+import threading
+import time
+
+import pytest
+
+import database
+import transport
+
+
+@pytest.fixture
+def relay(tmp_path, monkeypatch):
+    """Import communication.py on an in-process relay with a fresh temp database.
+
+    Yields (communication module, a second LocalTransport on the same bus that
+    plays the part of other TRC clients).
+    """
+    monkeypatch.setenv("TRC_TRANSPORT", "local")
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "test_trc_history.db"))
+    database.init_db()
+    communication = importlib.import_module("communication")
+    # Persist synchronously so assertions see rows without waiting on the writer
+    database.stop_writer()
+
+    # Join-time backfill runs on its own thread; tests call backfillHistory directly
+    monkeypatch.setattr(communication, "_auto_backfill", lambda channels: None)
+
+    bus = transport.LocalBus()
+    communication.useTransport(transport.LocalTransport(bus))
+    yield communication, transport.LocalTransport(bus)
+
+    communication.stopStreams(communication.getActiveChannels())
+    communication.flushSubscriptions()
+
+
+@pytest.fixture
+def communication(relay):
+    """Just the module, for tests of its in-process parts"""
+    return relay[0]
+
+
+def _collector(expected=1):
+    """UI callback recording (channel, payload) and signalling after `expected` calls"""
+    received = []
+    done = threading.Event()
+
+    def callback(channel, data):
+        received.extend((channel, msg) for msg in data[0])
+        if len(received) >= expected:
+            done.set()
+
+    return callback, received, done
+
+
+def test_message_is_delivered_and_persisted(relay):
+    communication, peer = relay
+    callback, received, done = _collector()
+    communication.startStreams(["general"], callback)
+    communication.flushSubscriptions()
+
+    peer.publish("general", {"user": "alice", "message": "deploy finished"})
+
+    assert done.wait(5)
+    assert received == [("general", {"user": "alice", "message": "deploy finished"})]
+    history = database.get_local_history("general", limit=10)
+    assert [(m["user"], m["message"]) for m in history] == [("alice", "deploy finished")]
+
+
+def test_oversized_message_is_chunked_and_reassembled(relay):
+    communication, peer = relay
+    callback, received, done = _collector()
+    communication.startStreams(["general"], callback)
+    communication.flushSubscriptions()
+
+    trace = "\n".join(f"  at frame {i} in module_{i}.py" for i in range(400))
+    status = communication.send("general", {"user": "bob", "message": trace})
+
+    assert status["success"]
+    # The relay carried several parts, each under the per-publish limit...
+    parts = peer.history("general", 100)
+    assert len(parts) > 1
+    assert all("chunk" in payload for payload, _ in parts)
+    # ...but subscribers and local history see one message
+    assert done.wait(5)
+    assert [msg["message"] for _, msg in received] == [trace]
+    assert [m["message"] for m in database.get_local_history("general", limit=10)] == [trace]
+
+
+def test_backfill_pulls_messages_published_while_away(relay):
+    communication, peer = relay
+    for i in range(3):
+        peer.publish("ops", {"user": "carol", "message": f"missed {i}"})
+
+    result = communication.backfillHistory("ops")
+
+    assert result["success"]
+    assert result["data"]["stored"] == 3
+    assert [m["message"] for m in database.get_local_history("ops", limit=10)] == ["missed 0", "missed 1", "missed 2"]
+
+
+def test_wildcard_subscription_routes_member_channels(relay):
+    communication, peer = relay
+    callback, received, done = _collector()
+    communication.startStreams(["svc.*"], callback)
+    communication.flushSubscriptions()
+
+    peer.publish("svc.api", {"user": "api", "message": "5xx rate up"})
+
+    assert done.wait(5)
+    assert received == [("svc.api", {"user": "api", "message": "5xx rate up"})]
+    assert communication.subscriptionOf("svc.api") == "svc.*"
+    assert communication.send("svc.*", {"user": "bob", "message": "hi"})["code"] == 400
+
+
+def test_failed_subscription_change_is_kept_and_retried(relay, monkeypatch):
+    communication, _ = relay
+    calls = []
+    failures = [transport.TransportError("network unreachable")]
+
+    def subscribe(channels, groups=()):
+        if failures:
+            raise failures.pop()
+        calls.append(sorted(channels))
+
+    monkeypatch.setattr(communication.relay, "subscribe", subscribe)
+    monkeypatch.setattr(communication._subscriptions, "retry_delay", 30.0)
+
+    communication.startStreams(["alpha"], lambda ch, data: None)
+    communication.flushSubscriptions()
+    assert calls == []
+    # The change is still pending, with a retry scheduled
+    assert communication._subscriptions._timer is not None
+
+    communication.startStreams(["beta"], lambda ch, data: None)
+    communication.flushSubscriptions()
+    assert calls == [["alpha", "beta"]]
+    assert communication._subscriptions._timer is None
+
+
+def test_reconnect_replays_missed_messages_once(relay, monkeypatch):
+    communication, peer = relay
+    reloaded = []
+    invalidate = database.invalidate_hot_history
+    monkeypatch.setattr(database, "invalidate_hot_history", lambda ch: (reloaded.append(ch), invalidate(ch)))
+    callback, received, done = _collector()
+    watched = []
+    communication.startStreams(["general"], callback, lambda ch, batch: watched.append(batch))
+    communication.flushSubscriptions()
+
+    peer.publish("general", {"user": "alice", "message": "before outage", "msg_id": "m0"})
+    assert done.wait(5)
+
+    # Outage: our subscription drops while the team keeps talking
+    communication._listener.status(transport.DISCONNECTED)
+    communication.relay.unsubscribe(["general"])
+    for i in range(1, 4):
+        peer.publish("general", {"user": "bob", "message": f"during outage {i}", "msg_id": f"m{i}"})
+    communication.relay.subscribe(["general"])
+    # One message arrives live right after reconnecting, before replay runs
+    peer.publish("general", {"user": "carol", "message": "just after", "msg_id": "m4"})
+
+    received.clear()
+    done.clear()
+    result = communication.replayMissed()
+    assert done.wait(5)
+    communication._ui_dispatcher.drain(5)
+    communication._watcher_dispatcher.drain(5)
+
+    assert result["data"] == {"general": 3}
+    replayed = [msg for _, msg in received if msg.get("replayed")]
+    assert [m["message"] for m in replayed] == ["during outage 1", "during outage 2", "during outage 3"]
+    # Everything stored exactly once, including the message seen both live and in history
+    history = database.get_local_history("general", limit=10)
+    assert sorted(m["message"] for m in history) == [
+        "before outage", "during outage 1", "during outage 2", "during outage 3", "just after"
+    ]
+    assert [m["message"] for m in watched[-1]] == ["during outage 1", "during outage 2", "during outage 3"]
+    # The hot cache was reloaded from SQLite after the replay
+    assert reloaded == ["general"]
+    assert history == database._query_history("general", 10)
+
+
+def test_replay_is_capped_per_channel(relay, monkeypatch):
+    communication, peer = relay
+    monkeypatch.setattr(communication, "REPLAY_MAX_MESSAGES", 2)
+    monkeypatch.setattr(communication, "HISTORY_PAGE_SIZE", 2)
+    communication.startStreams(["ops"], lambda ch, data: None)
+    communication.flushSubscriptions()
+    peer.publish("ops", {"user": "alice", "message": "stored"})
+
+    communication._listener.status(transport.DISCONNECTED)
+    communication.relay.unsubscribe(["ops"])
+    for i in range(5):
+        peer.publish("ops", {"user": "bob", "message": f"missed {i}"})
+
+    result = communication.replayMissed(["ops"])
+
+    # Only the newest REPLAY_MAX_MESSAGES are replayed; the channel isn't marked synced
+    assert result["data"] == {"ops": 2}
+    assert sorted(m["message"] for m in database.get_local_history("ops", limit=10)) == ["missed 3", "missed 4", "stored"]
+    assert "ops" not in communication._synced_channels
+
+
+def test_outbox_retries_without_a_reconnect_event(relay, monkeypatch):
+    communication, peer = relay
+    monkeypatch.setattr(communication, "PUBLISH_RETRIES", 0)
+    monkeypatch.setattr(communication, "OUTBOX_RETRY_INTERVAL", 0.05)
+    real_publish = communication.relay.publish
+    failures = [transport.TransportError("network unreachable")]
+
+    def flaky_publish(channel, payload):
+        if failures:
+            raise failures.pop()
+        return real_publish(channel, payload)
+
+    monkeypatch.setattr(communication.relay, "publish", flaky_publish)
+
+    first = communication.send("general", {"user": "bob", "message": "first"})
+    second = communication.send("general", {"user": "bob", "message": "second"})
+    assert first["queued"] and second["queued"]
+
+    # No CONNECTED/RECONNECTED status ever arrives; the periodic retry drains it
+    deadline = time.monotonic() + 5
+    while database.count_outbox() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert database.count_outbox() == 0
+    assert [p["message"] for p, _ in peer.history("general", 10)] == ["first", "second"]
+
+
+def test_republished_msg_id_is_stored_once_across_restarts(relay):
+    communication, peer = relay
+    peer.publish("ops", {"user": "bob", "message": "deploying", "msg_id": "m-1"})
+    assert communication.backfillHistory("ops")["data"]["stored"] == 1
+
+    # A restart forgets the in-memory seen ids; the outbox then republishes the
+    # same message, which gets a new timetoken
+    communication._seen_msg_ids.clear()
+    peer.publish("ops", {"user": "bob", "message": "deploying", "msg_id": "m-1"})
+    result = communication.backfillHistory("ops")
+
+    assert result["data"]["fetched"] >= 1 and result["data"]["stored"] == 0
+
+    assert [m["message"] for m in database.get_local_history("ops", limit=10)] == ["deploying"]
+
+
+def test_backfilled_message_is_still_delivered_live(relay):
+    communication, peer = relay
+    payload = {"user": "bob", "message": "db is read-only", "msg_id": "m-2"}
+    timetoken = peer.publish("ops", payload)
+    # Backfill on join fetches the message before its live delivery arrives
+    assert communication.backfillHistory("ops")["data"]["stored"] == 1
+
+    callback, received, done = _collector()
+    communication.startStreams(["ops"], callback)
+    communication._listener.message("ops", None, dict(payload), timetoken)
+
+    assert done.wait(5)
+    assert [msg["message"] for _, msg in received] == ["db is read-only"]
+    assert [m["message"] for m in database.get_local_history("ops", limit=10)] == ["db is read-only"]
+
+
+def test_dispatcher_keeps_per_channel_order_across_workers(communication):
+    dispatcher = communication._ChannelDispatcher("test", workers=4, queue_limit=1000)
+    seen = {"a": [], "b": []}
+    try:
+        for i in range(200):
+            dispatcher.submit("a", seen["a"].append, i)
+            dispatcher.submit("b", seen["b"].append, i)
+        assert dispatcher.drain(5)
+    finally:
+        dispatcher.stop(5)
+
+    assert seen["a"] == list(range(200))
+    assert seen["b"] == list(range(200))
+    assert dispatcher.stats["completed"] == 400
+
+
+def test_dispatcher_drops_oldest_when_a_channel_overflows(communication):
+    dispatcher = communication._ChannelDispatcher("test", workers=1, queue_limit=3)
+    started, gate = threading.Event(), threading.Event()
+    ran = []
+
+    def block():
+        started.set()
+        gate.wait(5)
+
+    try:
+        # The worker is stuck on the first task, so the rest pile up behind it
+        dispatcher.submit("ops", block)
+        assert started.wait(5)
+        results = [dispatcher.submit("ops", ran.append, i) for i in range(5)]
+        # Other channels have their own queue and aren't affected
+        assert dispatcher.submit("general", ran.append, "other")
+        gate.set()
+        assert dispatcher.drain(5)
+    finally:
+        dispatcher.stop(5)
+
+    assert results == [True, True, True, False, False]
+    assert [x for x in ran if x != "other"] == [2, 3, 4]
+    assert "other" in ran
+    assert dispatcher.stats["dropped"] == 2
+
+
+def _line(i):
+    return {"user": "svc", "message": f"line {i}"}
+
+
+def test_anomaly_window_flushes_on_size_and_carries_context(communication):
+    window = communication._AnomalyWindow(min_size=3, max_size=3, max_age=60, carry_over=1)
+
+    assert window.add(_line(0), 0.0) is None
+    assert window.add(_line(1), 1.0) is None
+    first = window.add(_line(2), 2.0)
+    assert [m["message"] for m in first] == ["line 0", "line 1", "line 2"]
+    assert not any(m.get("context") for m in first)
+
+    for i in range(3, 5):
+        assert window.add(_line(i), float(i)) is None
+    second = window.add(_line(5), 5.0)
+    # The last line of the previous batch comes along, flagged as already analyzed
+    assert [(m["message"], m.get("context", False)) for m in second] == [
+        ("line 2", True), ("line 3", False), ("line 4", False), ("line 5", False)
+    ]
+
+
+def test_anomaly_window_flushes_on_age_and_grows_with_rate(communication):
+    window = communication._AnomalyWindow(min_size=5, max_size=50, max_age=30, target_seconds=10, carry_over=0)
+
+    window.add(_line(0), 100.0)
+    assert window.due(129.0) is None
+    assert [m["message"] for m in window.due(130.0)] == ["line 0"]
+    assert window.due(200.0) is None
+
+    # A burst of ~10 msg/s raises the flush size above the minimum
+    now = 300.0
+    for i in range(40):
+        now += 0.1
+        window.add(_line(i), now)
+    assert window.target() > 5
+
+
+@pytest.mark.parametrize("status_code, transient", [(0, True), (429, True), (503, True), (400, False), (403, False)])
+def test_publish_errors_are_classified(relay, status_code, transient):
+    communication, _ = relay
+    assert communication._is_transient(transport.TransportError("x", status_code)) is transient
+
+
+def test_publish_retries_transient_errors_with_capped_backoff(relay, monkeypatch):
+    communication, peer = relay
+    monkeypatch.setattr(communication, "PUBLISH_BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(communication, "PUBLISH_BACKOFF_MAX", 0.003)
+    windows = []
+    monkeypatch.setattr(communication.random, "uniform", lambda low, high: windows.append((low, high)) or 0)
+    real_publish = communication.relay.publish
+    failures = [transport.TransportError("busy", 503), transport.TransportError("throttled", 429), transport.TransportError("reset")]
+
+    def flaky_publish(channel, payload):
+        if failures:
+            raise failures.pop()
+        return real_publish(channel, payload)
+
+    monkeypatch.setattr(communication.relay, "publish", flaky_publish)
+    status, _ = communication._publish_with_retry("general", {"user": "bob", "message": "hi"})
+
+    assert status["success"]
+    # Full jitter over an exponentially growing window, capped at PUBLISH_BACKOFF_MAX
+    assert windows == [(0, 0.001), (0, 0.002), (0, 0.003)]
+    assert [p["message"] for p, _ in peer.history("general", 10)] == ["hi"]
+
+
+def test_publish_does_not_retry_client_errors(relay, monkeypatch):
+    communication, _ = relay
+    calls = []
+
+    def denied(channel, payload):
+        calls.append(channel)
+        raise transport.TransportError("forbidden", 403)
+
+    monkeypatch.setattr(communication.relay, "publish", denied)
+    status, transient = communication._publish_with_retry("general", {"user": "bob", "message": "hi"})
+
+    assert not status["success"] and not transient
+    assert calls == ["general"]
+
+
+def test_send_async_rejects_with_429_when_the_queue_is_full(relay, monkeypatch):
+    communication, peer = relay
+    monkeypatch.setattr(communication, "_publish_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(communication, "PUBLISH_ENQUEUE_TIMEOUT", 0.05)
+    real_publish = communication.relay.publish
+    gate = threading.Event()
+
+    def slow_publish(channel, payload):
+        gate.wait(5)
+        return real_publish(channel, payload)
+
+    monkeypatch.setattr(communication.relay, "publish", slow_publish)
+    first = communication.send_async("general", {"user": "bob", "message": "first"})
+    second = communication.send_async("general", {"user": "bob", "message": "second"})
+
+    assert second.result(1) == {"success": False, "error": "Outbound queue full", "code": 429}
+    gate.set()
+    assert first.result(5)["success"]
+    # The slot is free again once the first publish finished
+    monkeypatch.setattr(communication, "PUBLISH_ENQUEUE_TIMEOUT", 5)
+    assert communication.send_async("general", {"user": "bob", "message": "third"}).result(5)["success"]
+
+
+def _trace(frames=400):
+    return "\n".join(f"  at frame {i} in module_{i}.py" for i in range(frames))
+
+
+def test_oversized_payload_is_split_and_reassembled_in_any_order(communication):
+    payload = {"user": "bob", "message": _trace(), "msg_id": "m1"}
+    parts = communication._split_payload(payload)
+
+    assert len(parts) > 1
+    assert all(len(json.dumps(part)) <= communication.MAX_MSG_LEN for part in parts)
+    assert [part["msg_id"] for part in parts] == [f"m1:{i}" for i in range(len(parts))]
+
+    reassembler = communication._Reassembler()
+    results = [reassembler.add("general", part["chunk"], 0.0) for part in reversed(parts)]
+    assert results[:-1] == [None] * (len(parts) - 1)
+    assert results[-1] == payload
+    # A payload that fits goes out as is
+    assert communication._split_payload({"user": "bob", "message": "hi", "msg_id": "m2"}) == [
+        {"user": "bob", "message": "hi", "msg_id": "m2"}
+    ]
+
+
+def test_incomplete_or_corrupt_chunked_messages_are_dropped(communication):
+    parts = communication._split_payload({"user": "bob", "message": _trace(), "msg_id": "m1"})
+    reassembler = communication._Reassembler()
+
+    assert reassembler.add("general", parts[0]["chunk"], 0.0) is None
+    reassembler.expire(communication.CHUNK_REASSEMBLY_TIMEOUT)
+    # The first part timed out, so the rest can't complete the message
+    assert all(reassembler.add("general", part["chunk"], 100.0) is None for part in parts[1:])
+
+    corrupt = dict(parts[0]["chunk"], total=1, data="not base64!")
+    assert reassembler.add("ops", corrupt, 0.0) is None
+
+
+def test_log_ring_is_bounded_and_filterable(communication, monkeypatch):
+    monkeypatch.setattr(communication, "logs", collections.deque(maxlen=3))
+    for i in range(4):
+        communication.add_log(f"event {i}", "INFO", component="test", n=i)
+    communication.add_log("boom", "ERROR", component="other")
+
+    assert [r["event"] for r in communication.get_logs(10)] == ["event 2", "event 3", "boom"]
+    assert [r["event"] for r in communication.get_logs(10, level="warning")] == ["boom"]
+    assert [r["fields"] for r in communication.get_logs(10, component="test")] == [{"n": 2}, {"n": 3}]
+    assert communication.get_logs(0) == []
+
+
+def test_jsonl_sink_rotates_and_keeps_backups(communication, tmp_path):
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+    # Several sessions, each writing more than max_bytes before it's flushed
+    for session in range(4):
+        communication.enable_log_file(str(log_dir / "trc.jsonl"), max_bytes=300, backups=2)
+        try:
+            for i in range(10):
+                communication.add_log(f"event {session}.{i}", "INFO", component="test")
+        finally:
+            communication.disable_log_file(5)
+
+    # Only the configured number of backups survive, each one rotated at max_bytes
+    names = sorted(p.name for p in log_dir.iterdir())
+    assert names[-2:] == ["trc.jsonl.1", "trc.jsonl.2"]
+    assert set(names) <= {"trc.jsonl", "trc.jsonl.1", "trc.jsonl.2"}
+    for name in names:
+        for line in (log_dir / name).read_text().splitlines():
+            assert json.loads(line)["component"] == "test"
+
+
+def test_jsonl_sink_drops_instead_of_blocking(communication, tmp_path, monkeypatch):
+    monkeypatch.setattr(communication, "LOG_CAPACITY", 1)
+    # A writer that never drains: the bounded queue (4 records) fills up
+    monkeypatch.setattr(communication._JsonlSink, "_run", lambda self: None)
+    sink = communication._JsonlSink(str(tmp_path / "trc.jsonl"), 0, 0)
+    for i in range(10):
+        sink.put({"event": i})
+    assert sink.dropped == 6
+
+
+def test_jsonl_sink_counts_records_it_cannot_write(communication, tmp_path):
+    sink = communication._JsonlSink(str(tmp_path / "missing-dir" / "trc.jsonl"), 0, 0)
+    sink.put({"event": "lost"})
+    sink.close(5)
+    assert sink.dropped == 1
+
+
+def test_subscription_changes_within_the_debounce_are_one_call(relay, monkeypatch):
+    communication, _ = relay
+    calls = []
+    monkeypatch.setattr(communication.relay, "subscribe", lambda channels, groups=(): calls.append(("sub", sorted(channels), sorted(groups))))
+    monkeypatch.setattr(communication.relay, "unsubscribe", lambda channels, groups=(): calls.append(("unsub", sorted(channels), sorted(groups))))
+    monkeypatch.setattr(communication._subscriptions, "delay", 30.0)
+
+    communication.startStreams(["alpha"], lambda ch, data: None)
+    communication.startStreams(["beta", "cg:services", "svc.*"], lambda ch, data: None)
+    communication.stopStreams(["beta"])
+    communication.flushSubscriptions()
+
+    # Four requests, at most one SDK call of each kind
+    assert calls == [("unsub", ["beta"], []), ("sub", ["alpha", "svc.*"], ["services"])]
+
+
+def test_group_and_wildcard_messages_route_to_the_joined_name(communication, monkeypatch):
+    monkeypatch.setattr(communication, "_auto_backfill", lambda channels: None)
+    communication.startStreams(["svc.*", "cg:services", "general"], lambda ch, data: None)
+
+    with communication._lock:
+        assert communication._route("svc.api", "svc.*") == "svc.*"
+        assert communication._route("billing", "services") == "cg:services"
+        assert communication._route("general", None) == "general"
+    assert communication.subscriptionOf("svc.api") == "svc.*"
+    assert communication.subscriptionOf("billing") == "cg:services"
@@ -0,0 +1,69 @@
+import context_builder
+
+
+def _msg(i, message="ok", user="alice"):
+    return {"timestamp": f"10:00:{i:02d}", "user": user, "message": message}
+
+
+def test_everything_fits_in_order():
+    messages = [_msg(0, "deploy started"), _msg(1, "deploy finished", user="bob")]
+    assert context_builder.build_context(messages, 1000) == (
+        "[10:00:00] alice: deploy started\n[10:00:01] bob: deploy finished"
+    )
+
+
+def test_budget_keeps_newest_and_reports_omitted():
+    messages = [_msg(i, f"message number {i}") for i in range(20)]
+    line_cost = context_builder.estimate_tokens(context_builder.format_message(messages[0])) + 1
+
+    text = context_builder.build_context(messages, line_cost * 3)
+
+    lines = text.split("\n")
+    assert lines[0] == "(17 older messages omitted to fit the context budget)"
+    assert [line.split(": ", 1)[1] for line in lines[1:]] == ["message number 17", "message number 18", "message number 19"]
+
+
+def test_repeated_lines_are_collapsed_with_newest_timestamp():
+    messages = [_msg(0, "start")] + [_msg(i, "ack", user="bot") for i in range(1, 38)] + [_msg(38, "done")]
+
+    lines = context_builder.build_context(messages, 1000).split("\n")
+
+    assert lines == [
+        "[10:00:00] alice: start",
+        "[10:00:37] bot: ack (x37 identical)",
+        "[10:00:38] alice: done",
+    ]
+
+
+def test_oversized_message_is_elided_keeping_head_and_tail():
+    trace = "Traceback (most recent call last):\n" + "  frame\n" * 2000 + "ValueError: bad config"
+
+    text = context_builder.build_context([_msg(0, trace)], 1000, max_message_tokens=100)
+
+    assert text.startswith("[10:00:00] alice: Traceback (most recent call last):")
+    assert text.endswith("ValueError: bad config")
+    assert "chars elided" in text
+    assert context_builder.estimate_tokens(text) < 120
+
+
+def test_custom_formatter():
+    text = context_builder.build_context([_msg(0, "disk full")], 100, formatter=lambda m: f"[{m['user']}]: {m['message']}")
+    assert text == "[alice]: disk full"
+
+
+def test_window_context_labels_carried_over_lines():
+    batch = [dict(_msg(0, "Traceback: worker crashed"), context=True), _msg(1, "restarting worker", user="bob")]
+
+    text = context_builder.build_window_context(batch, 1000)
+
+    carried, new = text.split("\n\n")
+    assert carried == (
+        "PREVIOUS CONTEXT (already analyzed - do not alert on these lines alone):\n"
+        "[10:00:00] alice: Traceback: worker crashed"
+    )
+    assert new == "NEW MESSAGES:\n[10:00:01] bob: restarting worker"
+
+
+def test_window_context_without_carry_over_has_only_new_messages():
+    text = context_builder.build_window_context([_msg(0, "disk at 91%")], 1000)
+    assert text == "NEW MESSAGES:\n[10:00:00] alice: disk at 91%"
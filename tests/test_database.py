@@ -1,8 +1,12 @@
+import os
 import sqlite3
+import threading
+import time
 
 import pytest
 
 import database
+import metrics
 
 
 @pytest.fixture
@@ -93,3 +97,627 @@ def test_clear_channel_history(db):
     assert database.clear_channel_history("general") is True
     assert database.get_local_history("general", limit=10) == []
     assert len(database.get_local_history("random", limit=10)) == 1
+
+
+def test_connection_is_reused_and_uses_wal(db):
+    conn = database.get_connection()
+    assert database.get_connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_connection_follows_db_name_changes(db, tmp_path, monkeypatch):
+    database.save_message("general", "alice", "hi", "10:00:00", "tt1")
+    first = database.get_connection()
+
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "other.db"))
+    database.init_db()
+    assert database.get_connection() is not first
+    assert database.get_local_history("general", limit=10) == []
+
+
+def test_close_connections_reconnects_lazily(db):
+    database.save_message("general", "alice", "hi", "10:00:00", "tt1")
+    conn = database.get_connection()
+
+    database.close_connections()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+
+    # Next call transparently opens a fresh connection
+    assert len(database.get_local_history("general", limit=10)) == 1
+
+
+def test_connections_are_per_thread(db):
+    import threading
+
+    seen = []
+    t = threading.Thread(target=lambda: seen.append(database.get_connection()))
+    t.start()
+    t.join()
+    assert seen[0] is not database.get_connection()
+
+
+def test_save_messages_bulk_inserts_and_ignores_duplicates(db):
+    database.save_message("general", "alice", "already here", "10:00:00", "tt1")
+    rows = [
+        ("general", "alice", "already here", "10:00:00", "tt1"),
+        ("general", "bob", "new", "10:00:01", "tt2"),
+        ("general", "bob", "newer", "10:00:02", "tt3"),
+    ]
+    assert database.save_messages(rows) == 2
+    assert [m["message"] for m in database.get_local_history("general", limit=10)] == [
+        "already here", "new", "newer"
+    ]
+
+
+def test_enqueue_message_is_synchronous_without_writer(db):
+    assert database.enqueue_message("general", "alice", "hi", "10:00:00", "tt1") is True
+    assert len(database.get_local_history("general", limit=10)) == 1
+
+
+def test_writer_group_commits_queued_messages(db):
+    database.start_writer()
+    try:
+        for i in range(1200):
+            database.enqueue_message("general", "alice", f"msg{i}", "10:00:00", f"tt{i}")
+        # Redelivery of an already-queued timetoken is ignored
+        database.enqueue_message("general", "alice", "msg0", "10:00:00", "tt0")
+        database.flush_writer()
+        assert len(database.get_local_history("general", limit=5000)) == 1200
+    finally:
+        database.stop_writer()
+
+    # Once stopped, writes fall back to synchronous mode
+    database.enqueue_message("general", "alice", "after", "10:00:00", "tt-after")
+    assert database.get_local_history("general", limit=1)[0]["message"] == "after"
+
+
+def test_flush_writer_returns_while_messages_keep_arriving(db):
+    database.start_writer()
+    stop = threading.Event()
+
+    def producer():
+        i = 0
+        while not stop.is_set():
+            database.enqueue_message("busy", "bot", f"tick{i}", "10:00:00", f"busy{i}")
+            i += 1
+
+    thread = threading.Thread(target=producer)
+    try:
+        database.enqueue_message("general", "alice", "before", "10:00:00", "tt-before")
+        thread.start()
+        assert database.flush_writer(timeout=5) is True
+        # The row queued before the flush is on disk, not just in the hot cache
+        conn = database.get_connection()
+        assert conn.execute("SELECT message FROM messages WHERE timetoken = 'tt-before'").fetchone()[0] == "before"
+    finally:
+        stop.set()
+        thread.join()
+        database.stop_writer()
+
+
+def test_fresh_database_is_at_latest_schema_version(db):
+    conn = sqlite3.connect(db)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    indexes = {row[1] for row in conn.execute("PRAGMA index_list(messages)")}
+    conn.close()
+
+    assert version == database.SCHEMA_VERSION
+    assert {"idx_messages_channel_id", "idx_messages_channel_user"} <= indexes
+
+
+def test_history_query_uses_channel_index(db):
+    conn = database.get_connection()
+    plan = " ".join(row[3] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT user FROM messages WHERE channel = ? ORDER BY id DESC LIMIT 5",
+        ("general",),
+    ))
+    assert "idx_messages_channel_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_epoch_is_derived_from_pubnub_timetoken(db):
+    database.save_message("general", "alice", "hi", "10:00:00", "17000000001234567")
+    database.save_messages([("general", "bob", "yo", "10:00:01", "17000000011234567")])
+
+    history = database.get_local_history("general", limit=10)
+    assert [m["epoch"] for m in history] == [1700000000, 1700000001]
+
+
+def test_migration_upgrades_legacy_database_in_chunks(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            user TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            timetoken TEXT UNIQUE NOT NULL
+        )
+    ''')
+    conn.executemany(
+        "INSERT INTO messages (channel, user, message, timestamp, timetoken) VALUES (?, ?, ?, ?, ?)",
+        [("general", "alice", f"m{i}", "10:00:00", str(17000000000000000 + i * 10_000_000)) for i in range(7)]
+        + [("general", "alice", "legacy", "10:00:00", "not-a-timetoken")],
+    )
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(database, "DB_NAME", db_path)
+    monkeypatch.setattr(database, "MIGRATION_CHUNK_SIZE", 3)
+    database.init_db()
+
+    history = database.get_local_history("general", limit=10)
+    assert [m["epoch"] for m in history] == [1700000000 + i for i in range(7)] + [None]
+    # Pre-existing rows are indexed for full-text search too
+    assert [r["message"] for r in database.search_messages("legacy")] == ["legacy"]
+    assert database.get_connection().execute("PRAGMA user_version").fetchone()[0] == database.SCHEMA_VERSION
+
+
+def test_search_messages_ranks_and_snippets_matches(db):
+    database.save_message("prod-logs", "svc", "GET /health 200", "10:00:00", "tt1")
+    database.save_message("prod-logs", "svc", "ERROR auth-service: token expired", "10:00:01", "tt2")
+    database.save_message("general", "alice", "auth-service error again?", "10:00:02", "tt3")
+
+    results = database.search_messages("auth-service error")
+    assert {r["timetoken"] for r in results} == {"tt2", "tt3"}
+    assert all("«" in r["snippet"] for r in results)
+
+    scoped = database.search_messages("error", channel="prod-logs")
+    assert [r["channel"] for r in scoped] == ["prod-logs"]
+
+
+def test_search_messages_prefix_and_since_filters(db):
+    database.save_message("general", "alice", "deploying build 41", "10:00:00", "17000000000000000")
+    database.save_message("general", "alice", "deployment finished", "10:00:01", "17000001000000000")
+
+    assert len(database.search_messages("deploy*")) == 2
+    recent = database.search_messages("deploy*", since=1700000050)
+    assert [r["message"] for r in recent] == ["deployment finished"]
+
+
+def test_search_index_follows_deletes(db):
+    database.save_message("general", "alice", "segfault in worker", "10:00:00", "tt1")
+    database.clear_channel_history("general")
+    assert database.search_messages("segfault") == []
+
+
+def test_search_messages_treats_operators_as_text(db):
+    database.save_message("general", "alice", 'he said "NOT" OR else', "10:00:00", "tt1")
+    assert len(database.search_messages('"NOT" OR')) == 1
+    assert database.search_messages("   ") == []
+
+
+def test_search_fallback_matches_wildcards_literally(db, monkeypatch):
+    # SQLite without FTS5 searches with LIKE instead
+    monkeypatch.setattr(database, "_fts_available", lambda conn: False)
+    database.save_message("general", "svc", "disk 100% full", "10:00:00", "tt1")
+    database.save_message("general", "svc", "disk 1000 blocks free", "10:00:01", "tt2")
+    database.save_message("general", "svc", "retry_count exceeded", "10:00:02", "tt3")
+    database.save_message("general", "svc", "retryXcount reset", "10:00:03", "tt4")
+    database.save_message("general", "svc", r"path C:\tmp\new", "10:00:04", "tt5")
+
+    assert [r["message"] for r in database.search_messages("100%")] == ["disk 100% full"]
+    assert [r["message"] for r in database.search_messages("retry_count")] == ["retry_count exceeded"]
+    assert [r["message"] for r in database.search_messages(r"C:\tmp")] == [r"path C:\tmp\new"]
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / "archive")
+    monkeypatch.setattr(database, "ARCHIVE_DIR", path)
+    return path
+
+
+def test_retention_policy_falls_back_to_default(db, monkeypatch):
+    monkeypatch.setattr(database, "DEFAULT_RETENTION_DAYS", None)
+    monkeypatch.setattr(database, "DEFAULT_RETENTION_ROWS", None)
+    assert database.get_retention_policy("general")["max_age_days"] is None
+
+    database.set_retention_policy("*", max_age_days=30)
+    database.set_retention_policy("prod-logs", max_rows=1000)
+
+    assert database.get_retention_policy("general") == {"max_age_days": 30, "max_rows": None, "source": "*"}
+    assert database.get_retention_policy("prod-logs")["max_rows"] == 1000
+
+
+def test_apply_retention_archives_rows_beyond_row_limit(db, archive_dir, monkeypatch):
+    monkeypatch.setattr(database, "RETENTION_BATCH_SIZE", 2)
+    for i in range(5):
+        database.save_message("general", "alice", f"msg{i}", "10:00:00", str(17000000000000000 + i))
+    database.save_message("random", "bob", "untouched", "10:00:00", "tt-random")
+    database.set_retention_policy("general", max_rows=2)
+
+    assert database.apply_retention() == {"general": 3}
+    assert [m["message"] for m in database.get_local_history("general", limit=10)] == ["msg3", "msg4"]
+    assert len(database.get_local_history("random", limit=10)) == 1
+
+    # Expired rows stay searchable in the compressed archive
+    hits = database.search_archive("msg1", channel="general")
+    assert [h["message"] for h in hits] == ["msg1"]
+    assert hits[0]["archived"] is True
+    assert database.search_messages("msg1") == []
+
+
+def test_apply_retention_by_age(db, archive_dir):
+    day = 86400
+    now = 1700000000 + 10 * day
+    old_tt = str(1700000000 * database.TIMETOKEN_TICKS_PER_SECOND)
+    new_tt = str((now - day) * database.TIMETOKEN_TICKS_PER_SECOND)
+    database.save_message("general", "alice", "old news", "10:00:00", old_tt)
+    database.save_message("general", "alice", "fresh", "10:00:00", new_tt)
+    database.set_retention_policy("general", max_age_days=7)
+
+    assert database.apply_retention("general", now=now) == {"general": 1}
+    assert [m["message"] for m in database.get_local_history("general", limit=10)] == ["fresh"]
+    assert [h["message"] for h in database.search_archive("old")] == ["old news"]
+
+
+def test_apply_retention_rerun_does_not_archive_a_batch_twice(db, archive_dir):
+    for i in range(3):
+        database.save_message("general", "alice", f"stale {i}", "10:00:00", str(17000000000000000 + i))
+    database.set_retention_policy("general", max_rows=0)
+    # A previous run archived the first two rows, then died before deleting them
+    conn = database.get_connection()
+    rows = conn.execute("SELECT id, user, message, timestamp, timetoken, epoch FROM messages ORDER BY id").fetchall()
+    database._archive_rows("general", rows[:2])
+
+    assert database.apply_retention("general") == {"general": 3}
+    assert sorted(h["message"] for h in database.search_archive("stale")) == ["stale 0", "stale 1", "stale 2"]
+    # Segments are renamed into place; no temp files are left behind
+    folder = database._archive_channel_dir("general")
+    assert all(name.endswith(".jsonl.gz") for name in os.listdir(folder))
+
+
+def test_compact_database_releases_free_pages(db, archive_dir):
+    database.save_messages([
+        ("general", "alice", "x" * 2000, "10:00:00", f"tt{i}") for i in range(200)
+    ])
+    database.set_retention_policy("general", max_rows=1)
+    database.apply_retention()
+
+    assert database.compact_database() > 0
+    conn = database.get_connection()
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+
+def test_compact_database_never_runs_a_full_vacuum(db, archive_dir):
+    conn = database.get_connection()
+    conn.execute("PRAGMA auto_vacuum = NONE")
+    conn.execute("VACUUM")
+    database.save_messages([
+        ("general", "alice", "x" * 2000, "10:00:00", f"tt{i}") for i in range(200)
+    ])
+    database.set_retention_policy("general", max_rows=1)
+    database.apply_retention()
+
+    # An older file is left alone by the background pass...
+    assert not database.incremental_vacuum_enabled()
+    assert database.compact_database() == 0
+    assert conn.execute("PRAGMA freelist_count").fetchone()[0] > 0
+    # ...and converted only on request
+    assert database.convert_to_incremental_vacuum() > 0
+    assert database.incremental_vacuum_enabled()
+
+
+def test_participants_roster_tracks_activity(db):
+    base = 1700000000
+    tt = lambda s: str((base + s) * database.TIMETOKEN_TICKS_PER_SECOND)
+    database.save_message("general", "alice", "hi", "10:00:00", tt(0))
+    database.save_messages([
+        ("general", "bob", "yo", "10:00:01", tt(10)),
+        ("general", "alice", "again", "10:00:02", tt(20)),
+        ("general", "alice", "again", "10:00:02", tt(20)),  # redelivery, ignored
+        ("general", "SYSTEM", "carol has joined", "10:00:03", tt(30)),
+    ])
+
+    roster = database.get_participants("general")
+    assert roster == [
+        {"user": "alice", "first_seen": base, "last_seen": base + 20, "message_count": 2},
+        {"user": "bob", "first_seen": base + 10, "last_seen": base + 10, "message_count": 1},
+    ]
+    assert database.get_known_users("general") == ["alice", "bob"]
+
+
+def test_known_users_active_within(db):
+    now_tt = str(int(time.time()) * database.TIMETOKEN_TICKS_PER_SECOND)
+    database.save_message("general", "alice", "old", "10:00:00", "17000000000000000")
+    database.save_message("general", "bob", "recent", "10:00:01", now_tt)
+
+    assert database.get_known_users("general", active_within=600) == ["bob"]
+
+
+def test_wipe_clears_participants(db):
+    database.save_message("general", "alice", "hi", "10:00:00", "tt1")
+    database.clear_channel_history("general")
+    assert database.get_known_users("general") == []
+
+
+def test_participants_backfilled_for_existing_history(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "pre_roster.db")
+    monkeypatch.setattr(database, "DB_NAME", db_path)
+    database.init_db()
+    conn = database.get_connection()
+    with conn:
+        conn.execute("DROP TABLE participants")
+        conn.execute("DROP TRIGGER messages_participants_insert")
+        conn.executemany(
+            "INSERT INTO messages (channel, user, message, timestamp, timetoken, epoch) VALUES (?, ?, ?, ?, ?, ?)",
+            [("general", "alice", "a", "10:00:00", "tt1", 100),
+             ("general", "alice", "b", "10:00:00", "tt2", 200),
+             ("general", "SYSTEM", "c", "10:00:00", "tt3", 300)],
+        )
+    conn.execute("PRAGMA user_version = 3")
+    monkeypatch.setattr(database, "MIGRATION_CHUNK_SIZE", 1)
+
+    database.init_db()
+    assert database.get_participants("general") == [
+        {"user": "alice", "first_seen": 100, "last_seen": 200, "message_count": 2}
+    ]
+
+
+def test_interrupted_backfill_migrations_rerun_without_double_counting(db, monkeypatch):
+    database.save_message("general", "alice", "disk full on db-1", "10:00:00", "17000000000000000")
+    database.save_message("general", "alice", "disk cleared", "10:00:00", "17000000010000000")
+    # As if the process died after the backfill chunks committed but before
+    # user_version was bumped past the full-text and roster migrations
+    database.get_connection().execute("PRAGMA user_version = 1")
+    monkeypatch.setattr(database, "MIGRATION_CHUNK_SIZE", 1)
+
+    database.init_db()
+
+    assert [r["message"] for r in database.search_messages("disk")] == ["disk cleared", "disk full on db-1"]
+    assert [p["message_count"] for p in database.get_participants("general")] == [2]
+
+
+def _delete_behind_cache(db_path):
+    """Remove every row without going through database.py, to prove reads are cached"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM messages")
+    conn.commit()
+    conn.close()
+
+
+def test_prewarmed_history_is_served_from_memory(db, monkeypatch):
+    monkeypatch.setattr(database, "HOT_HISTORY_SIZE", 5)
+    for i in range(8):
+        database.save_message("general", "alice", f"msg{i}", "10:00:00", f"tt{i}")
+    database.prewarm_history("general")
+    database.save_message("general", "alice", "msg8", "10:00:00", "tt8")
+
+    _delete_behind_cache(db)
+    assert [m["message"] for m in database.get_local_history("general", limit=3)] == ["msg6", "msg7", "msg8"]
+    # Deeper than the cache holds: falls back to SQLite
+    assert database.get_local_history("general", limit=10) == []
+
+
+def test_small_channel_cache_answers_any_limit(db):
+    database.save_message("general", "alice", "only", "10:00:00", "tt1")
+    database.prewarm_history("general")
+
+    _delete_behind_cache(db)
+    assert [m["message"] for m in database.get_local_history("general", limit=50)] == ["only"]
+
+
+def test_hot_cache_sees_queued_messages_before_commit(db):
+    database.prewarm_history("general")
+    database.start_writer()
+    try:
+        database.enqueue_message("general", "alice", "queued", "10:00:00", "tt1")
+        database.enqueue_message("general", "alice", "queued", "10:00:00", "tt1")
+        assert [m["message"] for m in database.get_local_history("general", limit=10)] == ["queued"]
+    finally:
+        database.stop_writer()
+    assert len(database._query_history("general", 10)) == 1
+
+
+def test_hot_cache_skips_a_republished_msg_id(db):
+    database.save_message("general", "bob", "deploying", "10:00:00", "tt1", msg_id="m-1")
+    database.prewarm_history("general")
+    database.start_writer()
+    try:
+        # An outbox republish gets a new timetoken but keeps its msg_id
+        database.enqueue_message("general", "bob", "deploying", "10:00:05", "tt2", msg_id="m-1")
+        database.enqueue_message("general", "bob", "rolled out", "10:00:06", "tt3", msg_id="m-2")
+        database.enqueue_message("general", "bob", "rolled out", "10:00:07", "tt4", msg_id="m-2")
+        assert [m["message"] for m in database.get_local_history("general", limit=10)] == ["deploying", "rolled out"]
+    finally:
+        database.stop_writer()
+    assert len(database._query_history("general", 10)) == 2
+
+
+def test_clear_channel_history_invalidates_hot_cache(db):
+    database.save_message("general", "alice", "hi", "10:00:00", "tt1")
+    database.prewarm_history("general")
+
+    database.clear_channel_history("general")
+    assert database.get_local_history("general", limit=10) == []
+    database.save_message("general", "bob", "after wipe", "10:00:01", "tt2")
+    assert [m["message"] for m in database.get_local_history("general", limit=10)] == ["after wipe"]
+
+
+def test_iter_history_pages_with_keyset_bounds(db):
+    for i in range(7):
+        database.save_message("general", "alice", f"msg{i}", "10:00:00", f"tt{i}")
+    database.save_message("random", "bob", "elsewhere", "10:00:00", "tt-r")
+
+    all_rows = list(database.iter_history("general", batch_size=3))
+    assert [m["message"] for m in all_rows] == [f"msg{i}" for i in range(7)]
+
+    ids = [m["id"] for m in all_rows]
+    window = database.iter_history("general", after_id=ids[1], before_id=ids[5], batch_size=2)
+    assert [m["message"] for m in window] == ["msg2", "msg3", "msg4"]
+
+
+def test_export_history_jsonl_gzip_and_csv(db, tmp_path):
+    import csv
+    import gzip
+    import json
+
+    database.save_message("general", "alice", "hello, world", "10:00:00", "tt1")
+    database.save_message("general", "bob", 'quote "this"', "10:00:01", "tt2")
+
+    jsonl_path = str(tmp_path / "general.jsonl.gz")
+    assert database.export_history("general", jsonl_path, fmt="jsonl", compress=True) == 2
+    with gzip.open(jsonl_path, "rt", encoding="utf-8") as f:
+        assert [json.loads(line)["user"] for line in f] == ["alice", "bob"]
+
+    csv_path = str(tmp_path / "general.csv")
+    assert database.export_history("general", csv_path, fmt="csv") == 2
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        assert [row["message"] for row in csv.DictReader(f)] == ["hello, world", 'quote "this"']
+
+    assert database.export_history("general", str(tmp_path / "x"), fmt="xml") == -1
+
+
+def test_sync_state_defaults_to_stored_timetokens(db):
+    assert database.get_sync_state("general") == {"high_water": None, "low_water": None}
+
+    database.save_message("general", "alice", "a", "10:00:00", "17000000000000005")
+    database.save_message("general", "alice", "b", "10:00:00", "17000000000000009")
+    database.save_message("general", "alice", "c", "10:00:00", "not-a-timetoken")
+    assert database.get_sync_state("general") == {
+        "high_water": "17000000000000009", "low_water": "17000000000000005"
+    }
+
+
+def test_update_sync_state_only_moves_outward(db):
+    database.update_sync_state("general", high_water="200", low_water="100")
+    database.update_sync_state("general", high_water="150", low_water="120")
+    assert database.get_sync_state("general") == {"high_water": "200", "low_water": "100"}
+
+    database.update_sync_state("general", high_water="300")
+    database.update_sync_state("general", low_water="50")
+    assert database.get_sync_state("general") == {"high_water": "300", "low_water": "50"}
+
+
+def _write_behind_cache(db_path, sql, params):
+    conn = sqlite3.connect(db_path)
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def test_topic_and_setting_reads_are_cached(db):
+    database.set_channel_topic("general", "ship v2")
+    database.update_setting("nick", "alice")
+    # Reads after the first come from memory, not SQLite
+    _write_behind_cache(db, "UPDATE channels SET topic = ? WHERE name = ?", ("stale", "general"))
+    _write_behind_cache(db, "UPDATE settings SET value = ? WHERE key = ?", ("stale", "nick"))
+
+    assert database.get_channel_topic("general") == "ship v2"
+    assert database.get_setting("nick") == "alice"
+
+
+def test_topic_cache_remembers_misses_and_writes_through(db):
+    assert database.get_channel_topic("general") is None
+    assert database.get_setting("theme", default="dark") == "dark"
+
+    database.set_channel_topic("general", "new objective")
+    database.update_setting("theme", 3)
+    assert database.get_channel_topic("general") == "new objective"
+    assert database.get_setting("theme", default="dark") == "3"
+
+
+def test_init_db_resets_metadata_caches(db):
+    database.set_channel_topic("general", "cached")
+    _write_behind_cache(db, "UPDATE channels SET topic = ? WHERE name = ?", ("from disk", "general"))
+
+    database.init_db()
+    assert database.get_channel_topic("general") == "from disk"
+
+
+def test_outbox_is_ordered_and_idempotent(db):
+    assert database.add_to_outbox("general", {"user": "alice", "message": "one"}, "m1", "timeout")
+    database.add_to_outbox("random", {"user": "alice", "message": "two"}, "m2")
+    # A retried enqueue of the same message doesn't duplicate it
+    database.add_to_outbox("general", {"user": "alice", "message": "one"}, "m1")
+
+    pending = database.get_outbox()
+    assert [(p["channel"], p["payload"]["message"]) for p in pending] == [("general", "one"), ("random", "two")]
+    assert pending[0]["last_error"] == "timeout"
+    assert database.count_outbox() == 2
+    assert [p["msg_id"] for p in database.get_outbox(limit=1)] == ["m1"]
+
+
+def test_outbox_attempts_and_removal(db):
+    database.add_to_outbox("general", {"message": "one"}, "m1")
+    database.add_to_outbox("general", {"message": "two"}, "m2")
+    first, second = database.get_outbox()
+
+    database.record_outbox_attempt(second["id"], "503")
+    database.remove_from_outbox([first["id"]])
+
+    remaining = database.get_outbox()
+    assert [(p["msg_id"], p["attempts"], p["last_error"]) for p in remaining] == [("m2", 1, "503")]
+
+
+def test_database_calls_are_instrumented(db):
+    metrics.reset()
+    database.save_message("general", "alice", "hi", "10:00:00", "tt1")
+    database.save_message("general", "alice", "hi", "10:00:00", "tt1")
+    database.save_messages([("general", "bob", "yo", "10:00:01", "tt2"), ("general", "bob", "yo", "10:00:01", "tt1")])
+
+    snap = metrics.snapshot()
+    assert snap["histograms"][metrics._key("trc_db_seconds", {"op": "save_message"})]["count"] == 2
+    assert snap["counters"][metrics._key("trc_db_rows_written_total", {})] == 2
+    assert snap["counters"][metrics._key("trc_db_duplicates_total", {})] == 2
+
+
+def test_get_latest_timetoken_ignores_non_relay_timetokens(db):
+    assert database.get_latest_timetoken("general") is None
+    database.save_message("general", "alice", "a", "10:00:00", "17000000000000002")
+    database.save_message("general", "alice", "b", "10:00:01", "17000000000000001")
+    database.save_message("general", "alice", "c", "10:00:02", "local-abc")
+    database.save_message("other", "bob", "d", "10:00:03", "17000000000000009")
+
+    assert database.get_latest_timetoken("general") == "17000000000000002"
+
+
+def test_cached_responses_expire_and_purge(db):
+    assert database.put_cached_response("k1", "pulse", "all green", expires_at=100.0)
+    assert database.put_cached_response("k2", "vision", "disk full", expires_at=200.0)
+
+    assert database.get_cached_response("k1", now=50.0) == ("all green", 100.0)
+    assert database.get_cached_response("k1", now=150.0) is None
+    assert database.purge_cached_responses(now=150.0) == 1
+    assert database.get_cached_response("k2", now=150.0) == ("disk full", 200.0)
+    assert database.purge_cached_responses(everything=True) == 1
+
+
+def test_history_after_pages_forward_oldest_first(db):
+    for i in range(5):
+        database.save_message("ops", "alice", f"m{i}", "10:00:00", f"tt{i}")
+    first = database.get_history_after("ops", 0, limit=10)
+    assert [m["message"] for m in first] == ["m0", "m1", "m2", "m3", "m4"]
+
+    # A short page is the oldest rows after the cursor, so paging skips nothing
+    page = database.get_history_after("ops", first[0]["id"], limit=2)
+    assert [m["message"] for m in page] == ["m1", "m2"]
+    page = database.get_history_after("ops", page[-1]["id"], limit=2)
+    assert [m["message"] for m in page] == ["m3", "m4"]
+    assert page[-1]["timetoken"] == "tt4"
+
+
+def test_channel_summary_accumulates_and_is_wiped_with_history(db):
+    assert database.get_channel_summary("ops") is None
+    assert database.save_channel_summary("ops", "db failover in progress", 10, "tt10", folded=10)
+    assert database.save_channel_summary("ops", "failover done; cache warming", 25, "tt25", folded=15)
+
+    stored = database.get_channel_summary("ops")
+    assert stored["summary"] == "failover done; cache warming"
+    assert (stored["last_id"], stored["last_timetoken"], stored["message_count"]) == (25, "tt25", 25)
+
+    database.clear_channel_history("ops")
+    assert database.get_channel_summary("ops") is None
+
+
+def test_msg_id_dedups_across_timetokens(db):
+    assert database.save_message("general", "bob", "hi", "10:00:00", "tt1", msg_id="m1") is True
+    # The same message republished from the outbox arrives with a new timetoken
+    assert database.save_message("general", "bob", "hi", "10:00:05", "tt2", msg_id="m1") is False
+    assert database.save_messages([("general", "bob", "hi", "10:00:05", "tt3", "m1"), ("general", "bob", "yo", "10:00:06", "tt4")]) == 1
+    assert [m["message"] for m in database.get_local_history("general", limit=10)] == ["hi", "yo"]
@@ -0,0 +1,121 @@
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def _key(name, **labels):
+    return metrics._key(name, labels)
+
+
+def test_counters_and_gauges_are_keyed_by_labels():
+    metrics.inc("trc_test_total", channel="a")
+    metrics.inc("trc_test_total", 2, channel="a")
+    metrics.inc("trc_test_total", channel="b")
+    metrics.set_gauge("trc_test_depth", 7)
+
+    snap = metrics.snapshot()
+    assert snap["counters"][_key("trc_test_total", channel="a")] == 3
+    assert snap["counters"][_key("trc_test_total", channel="b")] == 1
+    assert snap["gauges"][_key("trc_test_depth")] == 7
+
+
+def test_timed_records_latency_and_errors_per_function():
+    @metrics.timed("trc_test_seconds")
+    def ok():
+        return 42
+
+    @metrics.timed("trc_test_seconds")
+    def boom():
+        raise ValueError("nope")
+
+    assert ok() == 42
+    with pytest.raises(ValueError):
+        boom()
+
+    snap = metrics.snapshot()
+    assert snap["histograms"][_key("trc_test_seconds", op="ok")]["count"] == 1
+    assert snap["histograms"][_key("trc_test_seconds", op="boom")]["count"] == 1
+    assert snap["counters"][_key("trc_test_errors_total", op="boom")] == 1
+    assert _key("trc_test_errors_total", op="ok") not in snap["counters"]
+
+
+def test_timed_generator_is_timed_until_exhausted():
+    @metrics.timed("trc_test_seconds")
+    def gen():
+        yield 1
+        yield 2
+
+    it = gen()
+    assert _key("trc_test_seconds", op="gen") not in metrics.snapshot()["histograms"]
+    assert list(it) == [1, 2]
+    assert metrics.snapshot()["histograms"][_key("trc_test_seconds", op="gen")]["count"] == 1
+
+
+def test_histogram_quantiles_use_bucket_bounds():
+    for _ in range(90):
+        metrics.observe("trc_test_seconds", 0.002)
+    for _ in range(10):
+        metrics.observe("trc_test_seconds", 2.0)
+
+    hist = metrics.snapshot()["histograms"][_key("trc_test_seconds")]
+    assert hist["count"] == 100
+    assert hist["p50"] == 0.005
+    assert hist["p95"] == 2.5
+
+
+def test_gauge_callbacks_are_read_at_collection_time():
+    depth = {"value": 1}
+    metrics.gauge_callback("trc_test_live", lambda: depth["value"], pool="ui")
+    metrics.gauge_callback("trc_test_broken", lambda: 1 / 0)
+
+    depth["value"] = 5
+    gauges = metrics.snapshot()["gauges"]
+    assert gauges[_key("trc_test_live", pool="ui")] == 5
+    # A failing probe is skipped rather than breaking collection
+    assert _key("trc_test_broken") not in gauges
+
+
+def test_render_prometheus_text_format():
+    metrics.describe("trc_test_total", "Things counted")
+    metrics.inc("trc_test_total", channel='we"ird')
+    metrics.observe("trc_test_seconds", 0.02, op="save")
+
+    text = metrics.render_prometheus()
+    assert "# HELP trc_test_total Things counted" in text
+    assert "# TYPE trc_test_total counter" in text
+    assert 'trc_test_total{channel="we\\"ird"} 1' in text
+    assert "# TYPE trc_test_seconds histogram" in text
+    assert 'trc_test_seconds_bucket{op="save",le="0.01"} 0' in text
+    assert 'trc_test_seconds_bucket{op="save",le="0.025"} 1' in text
+    assert 'trc_test_seconds_bucket{op="save",le="+Inf"} 1' in text
+    assert 'trc_test_seconds_count{op="save"} 1' in text
+
+
+def test_write_prometheus_replaces_file(tmp_path):
+    path = tmp_path / "trc.prom"
+    metrics.inc("trc_test_total")
+    assert metrics.write_prometheus(str(path)) == {"success": True}
+    assert "trc_test_total 1" in path.read_text()
+    assert not (tmp_path / "trc.prom.tmp").exists()
+
+
+def test_http_exporter_serves_metrics_on_localhost():
+    metrics.inc("trc_test_total")
+    server = metrics.start_http_exporter(0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as resp:
+            assert resp.status == 200
+            assert "trc_test_total 1" in resp.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
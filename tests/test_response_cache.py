@@ -0,0 +1,70 @@
+import pytest
+
+import database
+import metrics
+import response_cache
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def _count(call, result):
+    return metrics.snapshot()["counters"].get(metrics._key("trc_ai_cache_total", {"call": call, "result": result}), 0)
+
+
+def _key(prompt, context="", blob=None):
+    return response_cache.make_key("response", "gemini-test", "be terse", prompt, context=context, blob=blob)
+
+
+def test_key_normalizes_prompt_but_not_context():
+    assert _key("What  broke?") == _key("what broke?\n")
+    assert _key("what broke?", context="[10:00] alice: 500s") != _key("what broke?", context="[10:01] alice: 500s")
+    assert _key("diagnose", blob=b"png-1") != _key("diagnose", blob=b"png-2")
+
+
+def test_hit_miss_and_lru_eviction():
+    cache = response_cache.ResponseCache(max_entries=2, persist=False)
+    assert cache.get("a", "response") is None
+    cache.put("a", "response", "answer a")
+    cache.put("b", "response", "answer b")
+    assert cache.get("a", "response") == "answer a"
+    cache.put("c", "response", "answer c")
+
+    # "b" was least recently used, so it made room for "c"
+    assert cache.get("b", "response") is None
+    assert len(cache) == 2
+    assert _count("response", "hit") == 1
+    assert _count("response", "miss") == 2
+
+
+def test_entries_expire_and_uncached_calls_are_ignored(monkeypatch):
+    cache = response_cache.ResponseCache(persist=False, ttl={"response": 60})
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+
+    cache.put("a", "response", "answer")
+    cache.put("b", "anomaly", "ALERT: nope")
+    cache.put("c", "response", "")
+    now[0] += 61
+
+    assert cache.get("a", "response") is None
+    assert len(cache) == 0
+    assert not cache.cacheable("anomaly")
+
+
+def test_persistent_tier_survives_a_new_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "test_trc_history.db"))
+    database.init_db()
+    response_cache.ResponseCache(persist=True).put("k", "pulse", "all green")
+
+    # A fresh cache (e.g. after a restart) finds it on disk, then serves it from memory
+    cache = response_cache.ResponseCache(persist=True)
+    assert cache.get("k", "pulse") == "all green"
+    assert len(cache) == 1
+
+    cache.clear()
+    assert response_cache.ResponseCache(persist=True).get("k", "pulse") is None
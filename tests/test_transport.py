@@ -0,0 +1,181 @@
+import threading
+import time
+
+import pytest
+
+import transport
+
+
+class _Recorder:
+    """Listener collecting what a transport delivers"""
+
+    def __init__(self):
+        self.messages = []
+        self.events = []
+        self.arrived = threading.Event()
+
+    def message(self, channel, subscription, payload, timetoken):
+        self.messages.append((channel, subscription, payload, timetoken))
+        self.arrived.set()
+
+    def status(self, event, detail=None):
+        self.events.append(event)
+
+
+def _local_pair():
+    bus = transport.LocalBus()
+    receiver, sender = transport.LocalTransport(bus), transport.LocalTransport(bus)
+    recorder = _Recorder()
+    receiver.add_listener(recorder)
+    return bus, receiver, sender, recorder
+
+
+def test_local_transport_delivers_to_subscribers_only():
+    _, receiver, sender, recorder = _local_pair()
+    receiver.subscribe(["general"])
+    assert recorder.events == [transport.CONNECTED]
+
+    tt = sender.publish("general", {"user": "alice", "message": "hi"})
+    sender.publish("random", {"user": "alice", "message": "elsewhere"})
+
+    assert recorder.messages == [("general", None, {"user": "alice", "message": "hi"}, tt)]
+
+
+def test_local_transport_routes_wildcards_and_groups():
+    _, receiver, sender, recorder = _local_pair()
+    sender.add_to_group("services", ["svc-db"])
+    receiver.subscribe(["api.*"], ["services"])
+
+    sender.publish("api.auth", {"message": "a"})
+    sender.publish("svc-db", {"message": "b"})
+    sender.publish("apiary", {"message": "c"})
+
+    assert [(ch, sub) for ch, sub, _, _ in recorder.messages] == [("api.auth", "api.*"), ("svc-db", "services")]
+    assert sender.list_group("services") == ["svc-db"]
+
+
+def test_local_transport_unsubscribe_and_stop():
+    _, receiver, sender, recorder = _local_pair()
+    receiver.subscribe(["a", "b"])
+    receiver.unsubscribe(["a"])
+    sender.publish("a", {"message": "dropped"})
+    sender.publish("b", {"message": "kept"})
+    receiver.stop()
+    sender.publish("b", {"message": "after stop"})
+
+    assert [p["message"] for _, _, p, _ in recorder.messages] == ["kept"]
+
+
+def test_local_publish_copies_payload_and_rejects_unserializable():
+    _, receiver, sender, recorder = _local_pair()
+    receiver.subscribe(["general"])
+    payload = {"message": "hi", "tags": ["x"]}
+    sender.publish("general", payload)
+    payload["tags"].append("mutated")
+    assert recorder.messages[0][2]["tags"] == ["x"]
+
+    with pytest.raises(transport.TransportError) as err:
+        sender.publish("general", {"message": object()})
+    assert err.value.status_code == 400
+
+
+def test_bus_history_bounds_and_order():
+    bus = transport.LocalBus(history_limit=5)
+    sender = transport.LocalTransport(bus)
+    tts = [sender.publish("general", {"n": i}) for i in range(8)]
+
+    # Only the newest history_limit messages are kept, oldest first
+    assert [p["n"] for p, _ in sender.history("general", 100)] == [3, 4, 5, 6, 7]
+    assert [p["n"] for p, _ in sender.history("general", 2)] == [6, 7]
+    # start is exclusive, end inclusive - the same paging contract as PubNub
+    assert [p["n"] for p, _ in sender.history("general", 100, start=tts[6])] == [3, 4, 5]
+    assert [p["n"] for p, _ in sender.history("general", 100, end=tts[5])] == [5, 6, 7]
+    assert tts == sorted(set(tts))
+
+
+def test_socket_relay_round_trip(tmp_path):
+    server = transport.SocketRelayServer("127.0.0.1:0").start()
+    receiver = transport.SocketTransport(server.address)
+    sender = transport.SocketTransport(server.address)
+    recorder = _Recorder()
+    receiver.add_listener(recorder)
+    try:
+        assert receiver.wait_connected(5) and sender.wait_connected(5)
+        receiver.subscribe(["general"])
+
+        tt = sender.publish("general", {"user": "alice", "message": "over tcp"})
+        assert recorder.arrived.wait(5)
+        assert recorder.messages == [("general", None, {"user": "alice", "message": "over tcp"}, tt)]
+        assert sender.history("general", 10) == [({"user": "alice", "message": "over tcp"}, tt)]
+
+        sender.add_to_group("services", ["svc-a"])
+        assert receiver.list_group("services") == ["svc-a"]
+    finally:
+        receiver.stop()
+        sender.stop()
+        server.stop()
+
+
+def test_socket_relay_requires_the_shared_token(monkeypatch):
+    monkeypatch.setattr(transport, "RECONNECT_BACKOFF_MIN", 0.01)
+    events = []
+    monkeypatch.setattr(transport.SocketTransport, "_status", lambda self, event, detail=None: events.append((self, event)))
+    server = transport.SocketRelayServer("127.0.0.1:0", token="s3cret").start()
+    trusted = transport.SocketTransport(server.address, token="s3cret")
+    intruder = transport.SocketTransport(server.address, token="guess")
+    anonymous = transport.SocketTransport(server.address)
+    try:
+        assert trusted.wait_connected(5)
+        tt = trusted.publish("general", {"message": "authenticated"})
+        assert trusted.history("general", 10) == [({"message": "authenticated"}, tt)]
+
+        assert not intruder.wait_connected(0.3)
+        with pytest.raises(transport.TransportError):
+            intruder.history("general", 10)
+        # A client without a token is dropped on its first request
+        assert anonymous.wait_connected(5)
+        with pytest.raises(transport.TransportError) as err:
+            anonymous.history("general", 10)
+        assert err.value.status_code == 403
+    finally:
+        trusted.stop()
+        intruder.stop()
+        anonymous.stop()
+        server.stop()
+    assert [event for source, event in events if source is intruder] == [transport.ACCESS_DENIED]
+
+
+def test_socket_transport_reports_errors_when_disconnected():
+    client = transport.SocketTransport("127.0.0.1:1")
+    try:
+        with pytest.raises(transport.TransportError) as err:
+            client.publish("general", {"message": "nobody home"})
+        assert err.value.status_code == 0
+    finally:
+        client.stop()
+
+
+def test_socket_transport_reports_an_unreachable_relay_once(monkeypatch):
+    monkeypatch.setattr(transport, "RECONNECT_BACKOFF_MIN", 0.01)
+    monkeypatch.setattr(transport, "RECONNECT_BACKOFF_MAX", 0.02)
+    events = []
+    # Record from the first attempt on, before a listener could be added
+    monkeypatch.setattr(transport.SocketTransport, "_status", lambda self, event, detail=None: events.append((self, event)))
+    client = transport.SocketTransport("127.0.0.1:1")
+    try:
+        time.sleep(0.3) # many failed attempts
+    finally:
+        client.stop()
+    # Other tests' clients may still be winding down; only count this one's
+    assert [event for source, event in events if source is client] == [transport.ERROR]
+
+
+def test_transport_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        transport.Transport()
+
+
+def test_create_transport_rejects_unknown_backend():
+    assert isinstance(transport.create_transport("local"), transport.LocalTransport)
+    with pytest.raises(ValueError):
+        transport.create_transport("carrier-pigeon")
@@ -0,0 +1,704 @@
+## transport.py module
+## relay transports behind communication.py: the PubNub network (default), an
+## in-process bus, and a small line-delimited JSON relay over TCP/UNIX sockets
+## for air-gapped LANs and offline benchmarks
+
+import os
+import abc
+import hmac
+import json
+import time
+import socket
+import threading
+import socketserver
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+# Messages kept per channel by the local bus / socket relay server
+HISTORY_LIMIT = 10000
+# Seconds a socket request waits for the relay's reply
+SOCKET_TIMEOUT = 10.0
+# Socket reconnects back off exponentially from RECONNECT_BACKOFF_MIN up to
+# RECONNECT_BACKOFF_MAX seconds
+RECONNECT_BACKOFF_MIN = 0.5
+RECONNECT_BACKOFF_MAX = 30.0
+DEFAULT_RELAY_ADDR = "127.0.0.1:8765"
+# Shared secret for the socket relay. When the server has one, a client must
+# send it before any other request or the connection is closed.
+RELAY_TOKEN_ENV = "TRC_RELAY_TOKEN"
+
+# Status events passed to listener.status(event, detail)
+CONNECTED = "connected"
+RECONNECTED = "reconnected"
+DISCONNECTED = "disconnected"
+ACCESS_DENIED = "access_denied"
+ERROR = "error"
+
+
+class TransportError(Exception):
+    """A relay operation failed. status_code is HTTP-style (0 = network failure)."""
+
+    def __init__(self, message, status_code=0):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _Clock:
+    """Issues strictly increasing timetokens (100ns ticks since the Unix epoch)"""
+
+    def __init__(self):
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            self._last = max(time.time_ns() // 100, self._last + 1)
+            return self._last
+
+
+class Transport(abc.ABC):
+    """What communication.py needs from a relay.
+
+    Listeners added with add_listener() receive
+    message(channel, subscription, payload, timetoken) for every delivered
+    message - subscription is the wildcard pattern or channel group name it
+    arrived through, or None for a directly subscribed channel - and
+    status(event, detail) for connection changes.
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _deliver(self, channel, subscription, payload, timetoken):
+        for listener in list(self._listeners):
+            listener.message(channel, subscription, payload, timetoken)
+
+    def _status(self, event, detail=None):
+        for listener in list(self._listeners):
+            listener.status(event, detail)
+
+    @abc.abstractmethod
+    def subscribe(self, channels, groups=()):
+        pass
+
+    @abc.abstractmethod
+    def unsubscribe(self, channels, groups=()):
+        pass
+
+    @abc.abstractmethod
+    def publish(self, channel, payload):
+        """Publish a JSON-serializable payload; returns its timetoken"""
+
+    @abc.abstractmethod
+    def history(self, channel, count, start=None, end=None):
+        """Return up to `count` of the newest (payload, timetoken) pairs with
+        end <= timetoken < start, in chronological order"""
+
+    @abc.abstractmethod
+    def add_to_group(self, group, channels):
+        pass
+
+    @abc.abstractmethod
+    def remove_from_group(self, group, channels):
+        pass
+
+    @abc.abstractmethod
+    def list_group(self, group):
+        pass
+
+    def stop(self):
+        pass
+
+
+def _matches(channel, channels, groups, group_members):
+    """Return (matched, subscription) for a channel against one subscriber's sets"""
+    if channel in channels:
+        return True, None
+    for pattern in channels:
+        if pattern.endswith(".*") and channel.startswith(pattern[:-1]):
+            return True, pattern
+    for group in groups:
+        if channel in group_members.get(group, ()):
+            return True, group
+    return False, None
+
+
+class LocalBus:
+    """In-process relay with per-channel bounded history, channel groups and
+    wildcard subscriptions. Delivery is synchronous on the publishing thread,
+    which keeps benchmarks and tests deterministic."""
+
+    def __init__(self, history_limit=HISTORY_LIMIT):
+        self.history_limit = history_limit
+        self._history = {}       # channel -> deque of (payload, timetoken)
+        self._groups = {}        # group -> set of channels
+        self._subscribers = {}   # sink -> {"channels": set, "groups": set}
+        self._clock = _Clock()
+        self._lock = threading.Lock()
+
+    def subscribe(self, sink, channels, groups=()):
+        with self._lock:
+            sub = self._subscribers.setdefault(sink, {"channels": set(), "groups": set()})
+            sub["channels"].update(channels)
+            sub["groups"].update(groups)
+
+    def unsubscribe(self, sink, channels, groups=()):
+        with self._lock:
+            sub = self._subscribers.get(sink)
+            if sub:
+                sub["channels"].difference_update(channels)
+                sub["groups"].difference_update(groups)
+
+    def detach(self, sink):
+        with self._lock:
+            self._subscribers.pop(sink, None)
+
+    def publish(self, channel, payload):
+        # Round-trip through JSON like a real relay: rejects unserializable
+        # payloads and never shares mutable objects between publisher and receivers
+        payload = json.loads(json.dumps(payload))
+        with self._lock:
+            timetoken = self._clock.next()
+            history = self._history.get(channel)
+            if history is None:
+                history = self._history[channel] = deque(maxlen=self.history_limit)
+            history.append((payload, timetoken))
+            targets = []
+            for sink, sub in self._subscribers.items():
+                matched, subscription = _matches(channel, sub["channels"], sub["groups"], self._groups)
+                if matched:
+                    targets.append((sink, subscription))
+        for sink, subscription in targets:
+            sink(channel, subscription, payload, timetoken)
+        return timetoken
+
+    def history(self, channel, count, start=None, end=None):
+        with self._lock:
+            items = list(self._history.get(channel, ()))
+        if start is not None:
+            items = [item for item in items if item[1] < int(start)]
+        if end is not None:
+            items = [item for item in items if item[1] >= int(end)]
+        return items[-count:] if count > 0 else []
+
+    def add_to_group(self, group, channels):
+        with self._lock:
+            self._groups.setdefault(group, set()).update(channels)
+
+    def remove_from_group(self, group, channels):
+        with self._lock:
+            self._groups.get(group, set()).difference_update(channels)
+
+    def list_group(self, group):
+        with self._lock:
+            return sorted(self._groups.get(group, ()))
+
+
+_default_bus = None
+_default_bus_lock = threading.Lock()
+
+
+def default_bus():
+    """The process-wide LocalBus shared by LocalTransports created without one"""
+    global _default_bus
+    with _default_bus_lock:
+        if _default_bus is None:
+            _default_bus = LocalBus()
+        return _default_bus
+
+
+class LocalTransport(Transport):
+    """Transport over a LocalBus (several transports on one bus talk to each other)"""
+
+    name = "local"
+
+    def __init__(self, bus=None):
+        super().__init__()
+        self.bus = bus or default_bus()
+        self._connected = False
+
+    def _on_bus(self, channel, subscription, payload, timetoken):
+        self._deliver(channel, subscription, payload, timetoken)
+
+    def subscribe(self, channels, groups=()):
+        self.bus.subscribe(self._on_bus, channels, groups)
+        if not self._connected:
+            self._connected = True
+            self._status(CONNECTED)
+
+    def unsubscribe(self, channels, groups=()):
+        self.bus.unsubscribe(self._on_bus, channels, groups)
+
+    def publish(self, channel, payload):
+        try:
+            return self.bus.publish(channel, payload)
+        except (TypeError, ValueError) as e:
+            raise TransportError(f"Invalid payload: {e}", 400) from e
+
+    def history(self, channel, count, start=None, end=None):
+        return self.bus.history(channel, count, start, end)
+
+    def add_to_group(self, group, channels):
+        self.bus.add_to_group(group, channels)
+
+    def remove_from_group(self, group, channels):
+        self.bus.remove_from_group(group, channels)
+
+    def list_group(self, group):
+        return self.bus.list_group(group)
+
+    def stop(self):
+        self.bus.detach(self._on_bus)
+
+
+def parse_address(address):
+    """'unix:/path/to/sock' -> (AF_UNIX, path); 'host:port' -> (AF_INET, (host, port))"""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+class _RelayHandler(socketserver.StreamRequestHandler):
+    """One client connection to a SocketRelayServer"""
+
+    def setup(self):
+        super().setup()
+        self._write_lock = threading.Lock()
+        self._authenticated = self.server.token is None
+
+    def _send(self, obj):
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        with self._write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def _on_bus(self, channel, subscription, payload, timetoken):
+        try:
+            self._send({"op": "msg", "channel": channel, "subscription": subscription,
+                        "message": payload, "timetoken": timetoken})
+        except OSError:
+            pass # Client went away; handle() cleans up
+
+    def handle(self):
+        bus = self.server.bus
+        try:
+            for line in self.rfile:
+                request = {}
+                try:
+                    request = json.loads(line)
+                    reply = self._dispatch(bus, request) if self._authenticated else self._authenticate(request)
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                reply["id"] = request.get("id") if isinstance(request, dict) else None
+                self._send(reply)
+                if not self._authenticated:
+                    break
+        except OSError:
+            pass
+        finally:
+            bus.detach(self._on_bus)
+
+    def _authenticate(self, request):
+        token = request.get("token") if request.get("op") == "auth" else None
+        if isinstance(token, str) and hmac.compare_digest(token.encode("utf-8"), self.server.token.encode("utf-8")):
+            self._authenticated = True
+            return {"ok": True}
+        return {"ok": False, "error": "Relay authentication failed", "code": 403}
+
+    def _dispatch(self, bus, request):
+        op = request.get("op")
+        if op == "sub":
+            bus.subscribe(self._on_bus, request.get("channels", []), request.get("groups", []))
+            return {"ok": True}
+        if op == "unsub":
+            bus.unsubscribe(self._on_bus, request.get("channels", []), request.get("groups", []))
+            return {"ok": True}
+        if op == "pub":
+            return {"ok": True, "timetoken": bus.publish(request["channel"], request["message"])}
+        if op == "history":
+            items = bus.history(request["channel"], request.get("count", 100), request.get("start"), request.get("end"))
+            return {"ok": True, "messages": [[payload, tt] for payload, tt in items]}
+        if op == "group_add":
+            bus.add_to_group(request["group"], request["channels"])
+            return {"ok": True}
+        if op == "group_remove":
+            bus.remove_from_group(request["group"], request["channels"])
+            return {"ok": True}
+        if op == "group_list":
+            return {"ok": True, "channels": bus.list_group(request["group"])}
+        return {"ok": False, "error": f"Unknown op: {op}"}
+
+
+class _TCPRelayServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class _UnixRelayServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+else:
+    _UnixRelayServer = None
+
+
+class SocketRelayServer:
+    """Relay server for SocketTransport clients: line-delimited JSON over TCP
+    or a UNIX socket, with in-memory history, backed by a LocalBus. With a
+    token, only clients presenting the same token are served."""
+
+    def __init__(self, address=DEFAULT_RELAY_ADDR, bus=None, token=None):
+        self.bus = bus or LocalBus()
+        family, target = parse_address(address)
+        self._unix_path = target if family == socket.AF_UNIX else None
+        if family == socket.AF_UNIX:
+            if _UnixRelayServer is None:
+                raise TransportError("UNIX sockets are not supported on this platform", 400)
+            if os.path.exists(target):
+                os.remove(target) # stale socket from a previous run
+            self._server = _UnixRelayServer(target, _RelayHandler)
+            self.address = f"unix:{target}"
+        else:
+            self._server = _TCPRelayServer(target, _RelayHandler)
+            host, port = self._server.server_address[:2]
+            self.address = f"{host}:{port}"
+        self._server.bus = self.bus
+        self._server.token = token or None
+        self._thread = None
+
+    def start(self):
+        """Serve from a daemon thread; returns self"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="trc-relay-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._unix_path:
+            try:
+                os.remove(self._unix_path)
+            except OSError:
+                pass
+
+
+class SocketTransport(Transport):
+    """Client for a SocketRelayServer. Reconnects with backoff in the
+    background and restores its subscriptions, reporting status events the
+    same way the PubNub transport does."""
+
+    name = "socket"
+
+    def __init__(self, address=DEFAULT_RELAY_ADDR, token=None):
+        super().__init__()
+        self.address = address
+        self.token = token or None
+        self._channels = set()
+        self._groups = set()
+        self._sock = None
+        self._write_lock = threading.Lock()
+        self._pending = {}       # request id -> Future
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="trc-relay-client", daemon=True)
+        self._thread.start()
+
+    def wait_connected(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def _run(self):
+        delay = RECONNECT_BACKOFF_MIN
+        ever_connected = False
+        failing = False # an outage was already reported; stay quiet while it lasts
+        while not self._stopped:
+            family, target = parse_address(self.address)
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.connect(target)
+            except OSError as e:
+                sock.close()
+                if not failing:
+                    failing = True
+                    self._status(ERROR, f"Cannot reach relay at {self.address}: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_BACKOFF_MAX)
+                continue
+
+            self._sock = sock
+            reader = threading.Thread(target=self._read, args=(sock,), name="trc-relay-reader", daemon=True)
+            reader.start()
+            if self.token:
+                try:
+                    self._request("auth", token=self.token)
+                except TransportError as e:
+                    # Rejected, or no answer: drop this connection and retry later
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    reader.join()
+                    self._sock = None
+                    self._fail_pending("Connection to relay lost")
+                    if not failing:
+                        failing = True
+                        self._status(ACCESS_DENIED if e.status_code == 403 else ERROR, str(e))
+                    time.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_BACKOFF_MAX)
+                    continue
+
+            delay = RECONNECT_BACKOFF_MIN
+            failing = False
+            self._connected.set()
+            with self._lock:
+                channels, groups = sorted(self._channels), sorted(self._groups)
+            try:
+                if channels or groups:
+                    self._request("sub", channels=channels, groups=groups)
+            except TransportError:
+                pass # reader will notice the broken connection
+            self._status(RECONNECTED if ever_connected else CONNECTED)
+            ever_connected = True
+
+            reader.join()
+            self._connected.clear()
+            self._sock = None
+            self._fail_pending("Connection to relay lost")
+            if not self._stopped:
+                self._status(DISCONNECTED)
+                failing = True # the disconnect is the state change; failed reconnects stay quiet
+
+    def _read(self, sock):
+        try:
+            with sock.makefile("r", encoding="utf-8") as lines:
+                for line in lines:
+                    message = json.loads(line)
+                    if message.get("op") == "msg":
+                        self._deliver(message["channel"], message.get("subscription"),
+                                      message["message"], message["timetoken"])
+                        continue
+                    with self._lock:
+                        future = self._pending.pop(message.get("id"), None)
+                    if future:
+                        future.set_result(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _fail_pending(self, reason):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(TransportError(reason, 0))
+
+    def _request(self, op, **fields):
+        sock = self._sock
+        if sock is None:
+            raise TransportError("Not connected to relay", 0)
+        future = Future()
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = future
+        data = (json.dumps(dict(fields, op=op, id=request_id)) + "\n").encode("utf-8")
+        try:
+            with self._write_lock:
+                sock.sendall(data)
+            reply = future.result(SOCKET_TIMEOUT)
+        except OSError as e:
+            raise TransportError(str(e), 0) from e
+        except FutureTimeout:
+            raise TransportError("Relay request timed out", 0)
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+        if not reply.get("ok"):
+            raise TransportError(reply.get("error", "Relay error"), reply.get("code", 400))
+        return reply
+
+    def subscribe(self, channels, groups=()):
+        with self._lock:
+            self._channels.update(channels)
+            self._groups.update(groups)
+        if self._connected.is_set():
+            self._request("sub", channels=list(channels), groups=list(groups))
+        # Otherwise sent on (re)connect
+
+    def unsubscribe(self, channels, groups=()):
+        with self._lock:
+            self._channels.difference_update(channels)
+            self._groups.difference_update(groups)
+        if self._connected.is_set():
+            self._request("unsub", channels=list(channels), groups=list(groups))
+
+    def publish(self, channel, payload):
+        return self._request("pub", channel=channel, message=payload)["timetoken"]
+
+    def history(self, channel, count, start=None, end=None):
+        reply = self._request("history", channel=channel, count=count, start=start, end=end)
+        return [(payload, tt) for payload, tt in reply["messages"]]
+
+    def add_to_group(self, group, channels):
+        self._request("group_add", group=group, channels=list(channels))
+
+    def remove_from_group(self, group, channels):
+        self._request("group_remove", group=group, channels=list(channels))
+
+    def list_group(self, group):
+        return self._request("group_list", group=group)["channels"]
+
+    def stop(self):
+        self._stopped = True
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class PubNubTransport(Transport):
+    """The PubNub network. The SDK is imported here, so the other transports
+    work without it installed."""
+
+    name = "pubnub"
+
+    def __init__(self, publish_key, subscribe_key, uuid):
+        super().__init__()
+        from pubnub.pnconfiguration import PNConfiguration
+        from pubnub.pubnub import PubNub
+        from pubnub.callbacks import SubscribeCallback
+        from pubnub.enums import PNStatusCategory, PNReconnectionPolicy
+        from pubnub.exceptions import PubNubException
+
+        self._exception = PubNubException
+
+        config = PNConfiguration()
+        config.publish_key = publish_key
+        config.subscribe_key = subscribe_key
+        config.uuid = uuid
+        config.ssl = True
+        config.reconnect_policy = PNReconnectionPolicy.EXPONENTIAL
+        config.daemon = True # Background subscribe threads die with the main process
+        self._pubnub = PubNub(config)
+
+        events = {
+            PNStatusCategory.PNConnectedCategory: CONNECTED,
+            PNStatusCategory.PNReconnectedCategory: RECONNECTED,
+            PNStatusCategory.PNUnexpectedDisconnectCategory: DISCONNECTED,
+            PNStatusCategory.PNAccessDeniedCategory: ACCESS_DENIED,
+        }
+        transport = self
+
+        class _Callback(SubscribeCallback):
+            def message(self, pn, message_result):
+                transport._deliver(message_result.channel, message_result.subscription,
+                                   message_result.message, message_result.timetoken)
+
+            def status(self, pn, status):
+                event = events.get(status.category)
+                if event:
+                    transport._status(event)
+                elif status.is_error():
+                    transport._status(ERROR, str(status.category))
+
+            def presence(self, pn, presence):
+                pass
+
+        self._pubnub.add_listener(_Callback())
+
+    def _call(self, fn):
+        """Run an SDK call, translating PubNubException into TransportError"""
+        try:
+            return fn()
+        except self._exception as e:
+            raise TransportError(str(e), getattr(e, "_status_code", 0) or 0) from e
+
+    def subscribe(self, channels, groups=()):
+        builder = self._pubnub.subscribe()
+        if channels:
+            builder = builder.channels(list(channels))
+        if groups:
+            builder = builder.channel_groups(list(groups))
+        self._call(builder.execute)
+
+    def unsubscribe(self, channels, groups=()):
+        builder = self._pubnub.unsubscribe()
+        if channels:
+            builder = builder.channels(list(channels))
+        if groups:
+            builder = builder.channel_groups(list(groups))
+        self._call(builder.execute)
+
+    def publish(self, channel, payload):
+        envelope = self._call(lambda: self._pubnub.publish().channel(channel).message(payload).sync())
+        return envelope.result.timetoken
+
+    def history(self, channel, count, start=None, end=None):
+        builder = self._pubnub.history().channel(channel).count(count).include_timetoken(True)
+        if start is not None:
+            builder = builder.start(int(start))
+        if end is not None:
+            builder = builder.end(int(end))
+        result = self._call(builder.sync).result
+        return [(item.entry, item.timetoken) for item in result.messages]
+
+    def add_to_group(self, group, channels):
+        self._call(lambda: self._pubnub.add_channel_to_channel_group()
+                   .channels(list(channels)).channel_group(group).sync())
+
+    def remove_from_group(self, group, channels):
+        self._call(lambda: self._pubnub.remove_channel_from_channel_group()
+                   .channels(list(channels)).channel_group(group).sync())
+
+    def list_group(self, group):
+        envelope = self._call(lambda: self._pubnub.list_channels_in_channel_group().channel_group(group).sync())
+        return envelope.result.channels
+
+    def stop(self):
+        self._pubnub.stop()
+
+
+def create_transport(kind, publish_key="demo", subscribe_key="demo", uuid=None, address=None, token=None):
+    """Build a transport by name: 'pubnub', 'local' or 'socket'"""
+    kind = (kind or "pubnub").lower()
+    if kind == "pubnub":
+        return PubNubTransport(publish_key, subscribe_key, uuid or f"trc-{os.getpid()}")
+    if kind == "local":
+        return LocalTransport()
+    if kind == "socket":
+        return SocketTransport(address or DEFAULT_RELAY_ADDR, token=token)
+    raise ValueError(f"Unknown transport '{kind}' (expected pubnub, local or socket)")
+
+
+## Run a standalone relay for SocketTransport clients:
+##   python transport.py [host:port | unix:/path/to/sock]
+## Binding anything but loopback or a UNIX socket requires TRC_RELAY_TOKEN,
+## which every client must then set too.
+if __name__ == '__main__':
+    import sys
+    address = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_RELAY_ADDR
+    token = os.getenv(RELAY_TOKEN_ENV)
+    family, target = parse_address(address)
+    if family != socket.AF_UNIX and target[0] not in ("127.0.0.1", "localhost", "::1") and not token:
+        sys.exit(f"Refusing to serve {address} without authentication: set {RELAY_TOKEN_ENV} "
+                 "(or bind 127.0.0.1 / a unix: socket)")
+    server = SocketRelayServer(address, token=token)
+    print(f"TRC relay listening on {server.address} (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()